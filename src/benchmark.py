@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import argparse
+import io
+import tempfile
+import numpy as np
+import pandas as pd
+from time import perf_counter
+from datetime import datetime, timedelta
+import weather
+from functions import MitgcmGrid, format_ascii_grid
+
+
+def load_mitgcm_grid(folder):
+    grid = MitgcmGrid()
+    grid.x = np.load(os.path.join(folder, "x.npy"))
+    grid.y = np.load(os.path.join(folder, "y.npy"))
+    grid.lat_grid = np.load(os.path.join(folder, "lat_grid.npy"))
+    grid.lon_grid = np.load(os.path.join(folder, "lon_grid.npy"))
+    return grid
+
+
+def synthetic_weather(folder, grid, days, variables, resolution=0.01, buffer=0.05):
+    """Daily weather files with random values on a regular lat/lng grid covering the lake grid."""
+    lat = np.arange(np.nanmin(grid.lat_grid) - buffer, np.nanmax(grid.lat_grid) + buffer, resolution)
+    lng = np.arange(np.nanmin(grid.lon_grid) - buffer, np.nanmax(grid.lon_grid) + buffer, resolution)
+    lng, lat = np.meshgrid(lng, lat)
+    start = datetime(2024, 1, 1)
+    for day in range(days):
+        time = pd.date_range(start + timedelta(days=day), periods=24, freq="h").values.astype("datetime64[s]")
+        data = {"time": time, "lat": lat, "lng": lng}
+        for variable in variables:
+            data[variable] = np.random.rand(len(time), lat.shape[0], lat.shape[1]).astype(np.float32)
+        weather.write_meteolakes_file(data, os.path.join(folder, "{}.npz".format((start + timedelta(days=day)).strftime("%Y%m%d"))))
+    return start, start + timedelta(days=days) - timedelta(hours=1)
+
+
+def benchmark_weather_files_to_grid(lakes, days, workers, variables):
+    static = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../static/mitgcm")
+    results = []
+    for lake in lakes:
+        grid = load_mitgcm_grid(os.path.join(static, lake, "grid"))
+        folder = tempfile.mkdtemp()
+        try:
+            start, end = synthetic_weather(folder, grid, days, variables)
+            weather.interpolation_weights_memo.clear()
+            weather.weather_files_to_grid(folder, variables, start, end, grid, 1)
+            for n in workers:
+                t = perf_counter()
+                weather.weather_files_to_grid(folder, variables, start, end, grid, n)
+                seconds = perf_counter() - t
+                results.append({"lake": lake, "grid": "x".join(str(i) for i in grid.lat_grid.shape), "workers": n,
+                                "seconds": round(seconds, 3), "days_per_second": round(days / seconds, 2)})
+                print("{:<12} {:>9} {:>3} workers {:>8.3f}s {:>8.2f} days/s".format(
+                    lake, results[-1]["grid"], n, seconds, days / seconds))
+        finally:
+            shutil.rmtree(folder)
+    return results
+
+
+def savetxt_writer(data, fmt):
+    f = io.StringIO()
+    for t in range(data.shape[0]):
+        f.write("TIME = {}\n".format(t))
+        np.savetxt(f, data[t], fmt=fmt)
+    return f.getvalue()
+
+
+def format_writer(data, fmt):
+    f = io.StringIO()
+    for t in range(data.shape[0]):
+        f.write("TIME = {}\n".format(t))
+        for j in range(data.shape[1]):
+            f.write(' '.join(fmt.replace("%", "{:") .replace("f", "f}").format(val) for val in data[t, j, :]))
+            f.write('\n')
+    return f.getvalue()
+
+
+def format_ascii_grid_writer(data, fmt):
+    return format_ascii_grid(data, fmt=fmt, headers=["TIME = {}\n".format(t) for t in range(data.shape[0])])
+
+
+def benchmark_ascii_writers(shapes, timesteps, fmt="%.2f", repeat=3):
+    results = []
+    for shape in shapes:
+        data = np.random.randn(timesteps, shape[0], shape[1]) * 100
+        reference = savetxt_writer(data, fmt)
+        for name, writer in [("savetxt", savetxt_writer), ("str.format", format_writer), ("format_ascii_grid", format_ascii_grid_writer)]:
+            seconds = []
+            for i in range(repeat):
+                t = perf_counter()
+                out = writer(data, fmt)
+                seconds.append(perf_counter() - t)
+            if out != reference:
+                raise ValueError("{} output differs from np.savetxt".format(name))
+            mb = len(out) / 1024 ** 2
+            results.append({"writer": name, "grid": "x".join(str(i) for i in shape), "timesteps": timesteps,
+                            "seconds": round(min(seconds), 4), "mb_per_second": round(mb / min(seconds), 2)})
+            print("{:<18} {:>9} {:>4} timesteps {:>8.4f}s {:>8.2f} MB/s".format(
+                name, results[-1]["grid"], timesteps, min(seconds), mb / min(seconds)))
+    return results
+
+
+if __name__ == "__main__":
+    static_lakes = sorted(os.listdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../static/mitgcm")))
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lakes', '-l', help="MitGCM lakes from static/mitgcm", nargs="+", default=[lake for lake in static_lakes if lake != "default"])
+    parser.add_argument('--days', '-d', help="Number of synthetic days of weather", type=int, default=14)
+    parser.add_argument('--workers', '-w', help="Worker counts to benchmark", type=int, nargs="+", default=sorted(set([1, 2, 4, 8, cores])))
+    parser.add_argument('--variables', '-v', help="Weather variables", nargs="+", default=["U", "V"])
+    parser.add_argument('--benchmarks', '-b', help="Benchmarks to run", nargs="+", choices=["interpolation", "writers"], default=["interpolation", "writers"])
+    parser.add_argument('--timesteps', '-t', help="Timesteps per block for the ASCII writer benchmark", type=int, default=24)
+    parser.add_argument('--output', '-o', help="Write the results to a JSON file", type=str, default=False)
+    args = parser.parse_args()
+    results = {}
+    if "interpolation" in args.benchmarks:
+        results["interpolation"] = benchmark_weather_files_to_grid(args.lakes, args.days, args.workers, args.variables)
+    if "writers" in args.benchmarks:
+        results["writers"] = benchmark_ascii_writers([(100, 100), (300, 600)], args.timesteps)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
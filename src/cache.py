@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+def cache_key(*parts):
+    """Content address of a cache entry, built from the parts that identify it."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class FileCache(object):
+    """
+    Size bounded on-disk cache that can be shared by concurrent runs.
+
+    Entries are files addressed by a key (see cache_key). A lock file in the cache folder guards reads,
+    writes and eviction. Entries stored with a ttl (seconds) expire, all others are immutable and are only
+    removed, least recently used first, once the cache grows beyond max_size bytes. Entries used within the
+    last grace seconds are never evicted, so the paths returned by get and put stay valid while they are read,
+    and .part files older than that are left over from failed downloads and removed.
+    """
+
+    def __init__(self, folder, max_size=20 * 1024 ** 3, suffix="", grace=3600):
+        self.folder = folder
+        self.max_size = max_size
+        self.suffix = suffix
+        self.grace = grace
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + self.suffix)
+
+    @contextmanager
+    def lock(self, shared=False):
+        with open(os.path.join(self.folder, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, key):
+        """Returns the path of a valid entry and marks it as recently used, or False if there is none."""
+        path = self.path(key)
+        with self.lock(shared=True):
+            if not os.path.isfile(path):
+                return False
+            if os.path.isfile(path + ".expires"):
+                with open(path + ".expires", "r") as f:
+                    if float(f.read()) < time.time():
+                        return False
+            os.utime(path)
+            return path
+
+    def put(self, key, file, ttl=None, move=False):
+        """Store a copy of file (or the file itself if move) under key and return the path of the entry."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        os.close(fd)
+        try:
+            if move:
+                shutil.move(file, temp)
+            else:
+                shutil.copyfile(file, temp)
+        except Exception:
+            os.remove(temp)
+            raise
+        with self.lock():
+            size = os.path.getsize(temp) - (os.path.getsize(path) if os.path.isfile(path) else 0)
+            os.replace(temp, path)
+            if ttl is None:
+                if os.path.isfile(path + ".expires"):
+                    os.remove(path + ".expires")
+            else:
+                with open(path + ".expires", "w") as f:
+                    f.write(str(time.time() + ttl))
+            usage = self.usage()
+            usage["total"] = usage["total"] + size
+            if usage["total"] > self.max_size or usage["scanned"] < time.time() - self.grace:
+                self.evict()
+            else:
+                self.save_usage(usage)
+        return path
+
+    def temporary_file(self):
+        """Path of a new empty file inside the cache folder, for downloads that are later stored with put(move=True)."""
+        fd, temp = tempfile.mkstemp(dir=self.folder, suffix=".part")
+        os.close(fd)
+        return temp
+
+    def usage(self):
+        """Running total of the entry sizes and the time of the last full scan, kept in .usage. Call while holding the lock."""
+        try:
+            with open(os.path.join(self.folder, ".usage"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"total": 0, "scanned": 0}
+
+    def save_usage(self, usage):
+        with open(os.path.join(self.folder, ".usage"), "w") as f:
+            json.dump(usage, f)
+
+    def evict(self):
+        """
+        Scan the cache, remove stale .part files and least recently used entries until it fits in max_size and
+        reset the running total. put only calls it when the total exceeds max_size or the last scan is older than
+        grace. Call while holding the lock.
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.folder):
+            for file in files:
+                if file in (".lock", ".usage") or file.endswith(".expires"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if file.endswith(".part"):
+                    if stat.st_mtime < now - self.grace:
+                        os.remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total = total + stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size or mtime >= now - self.grace:
+                break
+            os.remove(path)
+            if os.path.isfile(path + ".expires"):
+                os.remove(path + ".expires")
+            total = total - size
+        self.save_usage({"total": total, "scanned": now})
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from collections import deque
+import multiprocessing
+
+
+def init_renderer():
+    matplotlib.use("Agg", force=True)
+
+
+class Diagnostics(object):
+    """
+    Renders diagnostic figures off the critical path. Pipeline stages submit a renderer (a module level
+    function of this file) together with the plain data it needs, figures are then drawn by a background
+    pool of processes, or inline if processes is 0. With enabled=False (--no-figures) records are dropped.
+    At most max_pending figures (default twice the processes) are queued, beyond that figure() waits for the
+    oldest one so the data held by queued figures stays bounded. Call close() to wait for all figures to be written.
+    """
+
+    def __init__(self, enabled=True, processes=1, max_pending=None):
+        self.enabled = enabled
+        self.processes = processes
+        self.max_pending = max_pending or 2 * max(1, processes)
+        self.pool = None
+        self.pending = deque()
+
+    def figure(self, renderer, *args):
+        if not self.enabled:
+            return
+        if self.processes == 0:
+            renderer(*args)
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.get_context("forkserver").Pool(self.processes, initializer=init_renderer)
+        self.pending.append(self.pool.apply_async(renderer, args))
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().get()
+
+    def close(self):
+        """Wait for the queued figures, raising the first rendering error."""
+        pending, self.pending = self.pending, deque()
+        try:
+            for result in pending:
+                result.get()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+
+def render_river_inputs(file, rivers, show=False):
+    fig, (ax1, ax2) = plt.subplots(1, 2)
+    fig.suptitle('Model river inputs.')
+    ax1.title.set_text('Flow (m3/s)')
+    ax2.title.set_text('Temperature (°C)')
+    for river in rivers:
+        ax1.plot(river["time"], river["flow"], label="{} ({})".format(river["name"], river["type"]))
+        ax2.plot(river["time"], river["temperature"], label="{} ({})".format(river["name"], river["type"]))
+    plt.legend()
+    fig.set_size_inches(18.5, 10.5)
+    plt.savefig(file)
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def render_upwelling(file, values, clusters, title, xlabel):
+    plt.imshow(values, cmap='seismic')
+    plt.colorbar(label="Temperature (°C)")
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.tight_layout()
+    plt.contour(list(range(clusters.shape[1])), list(range(clusters.shape[0])), clusters, levels=[0, 1], colors='k',
+                linewidths=1, linestyles='dashed')
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    plt.savefig(file, bbox_inches='tight')
+    plt.close()
+
+
+def render_localised_currents(file, values, clusters, title):
+    plt.imshow(values, cmap='viridis', interpolation='nearest')
+    plt.colorbar(label="Velocity (m/s)")
+    plt.title(title)
+    plt.tight_layout()
+    plt.contour(list(range(clusters.shape[1])), list(range(clusters.shape[0])), clusters, levels=[0, 1], colors='r',
+                linewidths=1, linestyles='dashed')
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    plt.savefig(file, bbox_inches='tight')
+    plt.close()
+
+
+def render_heatmaps(file, title, panels, rows, cols):
+    """panels: list of (title, 2D array), drawn as a rows x cols grid of heatmaps."""
+    fig = plt.figure(figsize=(18, 8))
+    fig.suptitle(title)
+    for j, (name, data) in enumerate(panels):
+        plt.subplot(rows, cols, j + 1)
+        plt.imshow(np.asarray(data), cmap='coolwarm', interpolation='nearest')
+        plt.title(name)
+        plt.colorbar()
+    plt.tight_layout()
+    plt.savefig(file)
+    plt.close(fig)
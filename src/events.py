@@ -6,13 +6,14 @@ import xarray as xr
 import numpy as np
 from datetime import timedelta, datetime, timezone
 from dateutil.relativedelta import relativedelta, SU
-import matplotlib.pyplot as plt
 import scipy.ndimage
 from scipy.cluster.vq import kmeans, vq
 from functions import get_closest_index, convert_from_unit
+from diagnostics import Diagnostics, render_upwelling, render_localised_currents
 
 
-def upwelling(folder, parameters):
+def upwelling(folder, parameters, diagnostics=False):
+    diagnostics = diagnostics or Diagnostics(processes=0)
     files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".nc")]
     files.sort()
     events = []
@@ -60,23 +61,18 @@ def upwelling(folder, parameters):
                                 event["properties"]["max_centroid"] = diff
 
                         # Plot results
-                        cluster_labels, _ = vq(data, centroids)
-                        plot_values = np.array(nc.variables["R1"][time_index, 0, depth_index, :])
-                        plot_values[plot_values == -999] = np.nan
-                        plt.imshow(plot_values, cmap='seismic')
-                        plt.colorbar(label="Temperature (°C)")
-                        plt.title("Upwelling {}".format(time[time_index]))
-                        plt.xlabel("Centroid difference: {}°C".format(round(diff, 1)))
-                        plt.tight_layout()
-                        out = np.zeros(len(values))
-                        out[:] = np.nan
-                        out[mask] = cluster_labels
-                        out = out.reshape(plot_values.shape)
-                        plt.contour(list(range(out.shape[1])), list(range(out.shape[0])), out, levels=[0, 1], colors='k',
-                                    linewidths=1, linestyles='dashed')
-                        os.makedirs(os.path.join(folder, "events"), exist_ok=True)
-                        plt.savefig(os.path.join(folder, "events/upwelling_{}".format(time[time_index].isoformat())), bbox_inches='tight')
-                        plt.close()
+                        if diagnostics.enabled:
+                            cluster_labels, _ = vq(data, centroids)
+                            plot_values = np.array(nc.variables["R1"][time_index, 0, depth_index, :])
+                            plot_values[plot_values == -999] = np.nan
+                            out = np.zeros(len(values))
+                            out[:] = np.nan
+                            out[mask] = cluster_labels
+                            out = out.reshape(plot_values.shape)
+                            diagnostics.figure(render_upwelling,
+                                               os.path.join(folder, "events/upwelling_{}".format(time[time_index].isoformat())),
+                                               plot_values, out, "Upwelling {}".format(time[time_index]),
+                                               "Centroid difference: {}°C".format(round(diff, 1)))
                     elif event is not None:
                         events.append(event)
                         event = None
@@ -88,7 +84,8 @@ def upwelling(folder, parameters):
     return events
 
 
-def localised_currents(folder, parameters):
+def localised_currents(folder, parameters, diagnostics=False):
+    diagnostics = diagnostics or Diagnostics(processes=0)
     files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".nc")]
     files.sort()
     events = []
@@ -142,21 +139,16 @@ def localised_currents(folder, parameters):
                     else:
                         event["end"] = time[time_index].isoformat()
 
-                    data = labeled_array.copy()
-                    for i, c in enumerate(cluster_sizes):
-                        if c >= minCells and c <= maxCells:
-                            data[data == i + 1] = 1
-                        else:
-                            data[data == i + 1] = 0
-                    plt.imshow(raw_values, cmap='viridis', interpolation='nearest')
-                    plt.colorbar(label="Velocity (m/s)")
-                    plt.title("Localised currents {}".format(time[time_index]))
-                    plt.tight_layout()
-                    plt.contour(list(range(data.shape[1])), list(range(data.shape[0])), data, levels=[0, 1], colors='r',
-                                linewidths=1, linestyles='dashed')
-                    os.makedirs(os.path.join(folder, "events"), exist_ok=True)
-                    plt.savefig(os.path.join(folder, "events/localisedCurrents_{}".format(time[time_index].isoformat())), bbox_inches='tight')
-                    plt.close()
+                    if diagnostics.enabled:
+                        data = labeled_array.copy()
+                        for i, c in enumerate(cluster_sizes):
+                            if c >= minCells and c <= maxCells:
+                                data[data == i + 1] = 1
+                            else:
+                                data[data == i + 1] = 0
+                        diagnostics.figure(render_localised_currents,
+                                           os.path.join(folder, "events/localisedCurrents_{}".format(time[time_index].isoformat())),
+                                           raw_values, data, "Localised currents {}".format(time[time_index]))
                 elif event is not None:
                     events.append(event)
                     event = None
@@ -165,7 +157,7 @@ def localised_currents(folder, parameters):
     return events
 
 
-def main(folder, docker):
+def main(folder, docker, figures=True, processes=None):
     event_functions = {
         "upwelling": upwelling,
         "localisedCurrents": localised_currents
@@ -177,8 +169,12 @@ def main(folder, docker):
         return
     events = []
     if docker in ["eawag/delft3d-flow:6.03.00.62434", "eawag/delft3d-flow:6.02.10.142612"]:
-        for event_definition in properties["events"]:
-            events.extend(event_functions[event_definition["type"]](folder, event_definition["parameters"]))
+        diagnostics = Diagnostics(enabled=figures, processes=processes or os.cpu_count() or 1)
+        try:
+            for event_definition in properties["events"]:
+                events.extend(event_functions[event_definition["type"]](folder, event_definition["parameters"], diagnostics))
+        finally:
+            diagnostics.close()
     else:
         raise ValueError("Postprocessing not defined for docker image {}".format(docker))
     with open(os.path.join(folder, "events.json"), 'w') as f:
@@ -189,5 +185,6 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--folder', '-f', help="Simulation folder", type=str)
     parser.add_argument('--docker', '-d', help="Docker image e.g. eawag/delft3d-flow:6.02.10.142612", type=str, default="eawag/delft3d-flow:6.02.10.142612")
+    parser.add_argument('--no-figures', help="Skip rendering event figures", action='store_true')
     args = parser.parse_args()
-    main(vars(args)["folder"], vars(args)["docker"])
+    main(vars(args)["folder"], vars(args)["docker"], figures=not vars(args)["no_figures"])
@@ -2,41 +2,163 @@ import os
 import re
 import json
 import time
+import hashlib
 import boto3
 import shutil
 import pylake
+import paramiko
 import netCDF4
+import random
+import fnmatch
 import logging
+import zipfile
 import requests
+import threading
 import traceback
 import subprocess
 import numpy as np
 import xarray as xr
 import pandas as pd
 import matplotlib.pyplot as plt
-from requests import get
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
 from botocore.exceptions import ClientError
+from cache import cache_key
+from diagnostics import Diagnostics, render_heatmaps
 from datetime import datetime, timedelta, timezone
 
 
-def download_data(query, attempts=3, timeout=120, sleep=30, download=False):
-    print(query)
+RETRY_STATUS = [429, 500, 502, 503, 504]
+http_lock = threading.Lock()
+http_sessions = {}
+http_statistics = {}
+
+
+def http_session():
+    """Shared session with a keep-alive connection pool, one per process."""
+    with http_lock:
+        if os.getpid() not in http_sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[os.getpid()] = session
+        return http_sessions[os.getpid()]
+
+
+def http_endpoint(url):
+    url = urlparse(url)
+    return "/".join([url.netloc] + url.path.split("/")[1:3])
+
+
+def record_http(url, seconds, retry=False, failed=False):
+    endpoint = http_endpoint(url)
+    with http_lock:
+        stats = http_statistics.setdefault(endpoint, {"requests": 0, "retries": 0, "failures": 0, "seconds": 0.0})
+        stats["requests"] = stats["requests"] + 1
+        stats["retries"] = stats["retries"] + int(retry)
+        stats["failures"] = stats["failures"] + int(failed)
+        stats["seconds"] = stats["seconds"] + seconds
+
+
+def retry_after(response):
+    if response is None or "Retry-After" not in response.headers:
+        return False
+    value = response.headers["Retry-After"]
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return False
+
+
+def http_get(url, attempts=5, timeout=120, sleep=30, backoff=1, method="GET", **kwargs):
+    """
+    GET (or another method) with the shared session. Connection errors, timeouts and transient status codes (RETRY_STATUS) are retried
+    after Retry-After if the server sends it, otherwise with exponential backoff and full jitter capped at sleep
+    seconds. Other responses are returned straight away. Raises the last exception if no response was received.
+    """
+    url = url.replace("\\", "/")
     for attempt in range(attempts):
+        start = time.perf_counter()
+        error = False
+        response = None
         try:
-            response = requests.get(query, timeout=timeout)
-            if response.status_code == 200:
-                if download:
-                    with open(download, "w") as file:
-                        file.write(response.text)
-                return response.json()
-            else:
-                raise ValueError("Unable to download data, HTTP error code {}".format(response.status_code))
-        except Exception as e:
-            print("Attempt {}/{} failed. Sleeping for {}s.".format(attempt + 1, attempts, sleep))
-            print(e)
-            if attempt == attempts - 1:
-                return False
-            time.sleep(sleep)
+            response = http_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+        failed = bool(error) or response.status_code in RETRY_STATUS
+        record_http(url, time.perf_counter() - start, retry=attempt > 0, failed=failed)
+        if not failed:
+            return response
+        if attempt == attempts - 1:
+            if error:
+                raise error
+            return response
+        wait = retry_after(response)
+        if wait is False:
+            wait = random.uniform(0, min(sleep, backoff * 2 ** attempt))
+        print("Attempt {}/{} failed ({}). Sleeping for {:.1f}s.".format(attempt + 1, attempts, error if error else "HTTP error code {}".format(response.status_code), wait))
+        if response is not None:
+            response.close()
+        time.sleep(wait)
+
+
+def log_http_statistics(log):
+    with http_lock:
+        statistics = dict(http_statistics)
+    if len(statistics) > 0:
+        log.info("Download statistics:")
+    for endpoint, stats in sorted(statistics.items()):
+        log.info("{}: {} requests, {} retries, {} failed, mean latency {:.2f}s".format(
+            endpoint, stats["requests"], stats["retries"], stats["failures"], stats["seconds"] / stats["requests"]), indent=1)
+
+
+def download_data(query, attempts=5, timeout=120, sleep=30, download=False):
+    print(query)
+    try:
+        response = http_get(query, attempts=attempts, timeout=timeout, sleep=sleep)
+        if response.status_code == 200:
+            if download:
+                with open(download, "w") as file:
+                    file.write(response.text)
+            return response.json()
+        else:
+            raise ValueError("Unable to download data, HTTP error code {}".format(response.status_code))
+    except Exception as e:
+        print(e)
+        return False
+
+
+def load_npz(file, mmap_mode="r"):
+    """
+    Read the arrays of an uncompressed .npz file (np.savez) as memory maps, so loading is constant time
+    and data is only read from disk when accessed. Compressed or object members are read into memory.
+    """
+    arrays = {}
+    with zipfile.ZipFile(file) as z, open(file, "rb") as f:
+        for info in z.infolist():
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type == zipfile.ZIP_STORED:
+                f.seek(info.header_offset)
+                header = f.read(30)
+                f.seek(info.header_offset + 30 + int.from_bytes(header[26:28], "little") + int.from_bytes(header[28:30], "little"))
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                if not dtype.hasobject and np.prod(shape) > 0:
+                    arrays[name] = np.memmap(file, dtype=dtype, mode=mmap_mode, shape=shape,
+                                             order="F" if fortran_order else "C", offset=f.tell())
+                    continue
+            with z.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+    return arrays
 
 
 def convert_to_unit(time, units):
@@ -60,7 +182,19 @@ def convert_from_unit(time, units):
         raise ValueError("Unrecognised time unit.")
 
 
-def upload_file(file_name, bucket, object_name=None):
+s3_clients = {}
+
+
+def s3_client(endpoint_url=None):
+    """boto3 S3 client shared by the threads of a process (an endpoint_url, or AWS_ENDPOINT_URL, selects a local S3 stand-in)."""
+    key = (os.getpid(), endpoint_url)
+    with http_lock:
+        if key not in s3_clients:
+            s3_clients[key] = boto3.client('s3', endpoint_url=endpoint_url)
+        return s3_clients[key]
+
+
+def upload_file(file_name, bucket, object_name=None, endpoint_url=None):
     """Upload a file to an S3 bucket
 
     :param file_name: File to upload
@@ -74,26 +208,323 @@ def upload_file(file_name, bucket, object_name=None):
         object_name = os.path.basename(file_name)
 
     # Upload the file
-    s3_client = boto3.client('s3')
     try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
+        response = s3_client(endpoint_url).upload_file(file_name, bucket, object_name)
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
-def download_file(url, file_name):
+def s3_object_exists(client, bucket, key):
     try:
-        url = url.replace("\\", "/")
-        response = get(url)
-        if response.status_code != 200:
-            return response.status_code
-        with open(file_name, "wb") as file:
-            file.write(response.content)
-        return response.status_code
-    except:
-        return 400
+        client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey", "NotFound"]:
+            return False
+        raise
+
+
+class S3MultipartWriter(object):
+    """
+    Write-only, unseekable file object that streams what is written to an S3 object as a multipart upload.
+    Parts of part_size bytes (at least 5 MiB) are uploaded by parallel_n threads while writing continues, at most
+    parallel_n parts are held in memory. close() completes the upload, abort() cancels it.
+    """
+
+    def __init__(self, client, bucket, key, part_size=16 * 1024 ** 2, parallel_n=4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.position = 0
+        self.buffer = bytearray()
+        self.parts = []
+        self.slots = threading.Semaphore(parallel_n)
+        self.executor = ThreadPoolExecutor(parallel_n)
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def upload_part(self, number, data):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            self.slots.release()
+
+    def submit(self, data):
+        self.slots.acquire()
+        self.parts.append(self.executor.submit(self.upload_part, len(self.parts) + 1, data))
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position = self.position + len(data)
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if len(self.buffer) > 0 or len(self.parts) == 0:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        try:
+            parts = [part.result() for part in self.parts]
+        finally:
+            self.executor.shutdown()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts})
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def file_sha256(file):
+    sha = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024 ** 2), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def static_folders(model):
+    """Static folders a model run is staged from, static/{type}/default then static/{model}."""
+    parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    return [os.path.join(parent_dir, "static", model.split("/")[0], "default"), os.path.join(parent_dir, "static", model)]
+
+
+def resume_digests(params):
+    """Content hashes a resumed setup is keyed on, of the static folders and of a local restart file (False if none)."""
+    restart = False
+    if params["restart"] and os.path.isfile(params["restart"]):
+        restart = path_digest([params["restart"]])
+    return path_digest(static_folders(params["model"])), restart
+
+
+def static_files(folder, sources):
+    """Files of folder (relative paths) that are unchanged copies of the same file in one of the static source folders (later sources win)."""
+    candidates = {}
+    for source in sources:
+        for root, _, names in os.walk(source):
+            for name in names:
+                candidates[os.path.relpath(os.path.join(root, name), source)] = os.path.join(root, name)
+    out = {}
+    for relative, source in candidates.items():
+        file = os.path.join(folder, relative)
+        if os.path.isfile(file) and os.path.getsize(file) == os.path.getsize(source):
+            sha = file_sha256(file)
+            if sha == file_sha256(source):
+                out[relative] = sha
+    return out
+
+
+def upload_folder_zip(folder, bucket, object_name, static=None, static_prefix=None, endpoint_url=None, parallel_n=4):
+    """
+    Zip folder (as shutil.make_archive) straight into a multipart S3 upload, without staging the archive on disk.
+
+    With static ({relative path: sha256}, see static_files) those files are stored once under static_prefix/{sha256},
+    only if missing from the bucket, and replaced in the archive by a static-files.json manifest that
+    restore_static_files reads. Returns the number of static files uploaded.
+    """
+    client = s3_client(endpoint_url)
+    static = static or {}
+    uploaded = 0
+    for relative, sha in sorted(static.items()):
+        key = "{}/{}".format(static_prefix, sha)
+        if not s3_object_exists(client, bucket, key):
+            client.upload_file(os.path.join(folder, relative), bucket, key)
+            uploaded = uploaded + 1
+    writer = S3MultipartWriter(client, bucket, object_name, parallel_n=parallel_n)
+    try:
+        with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            for root, dirs, names in os.walk(folder):
+                dirs.sort()
+                for name in sorted(dirs):
+                    z.write(os.path.join(root, name), os.path.relpath(os.path.join(root, name), folder))
+                for name in sorted(names):
+                    relative = os.path.relpath(os.path.join(root, name), folder)
+                    if relative not in static:
+                        z.write(os.path.join(root, name), relative)
+            if static:
+                z.writestr("static-files.json", json.dumps({"prefix": static_prefix, "files": static}, indent=1, sort_keys=True))
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return uploaded
+
+
+def restore_static_files(folder, bucket, endpoint_url=None):
+    """Download the static files listed in the static-files.json manifest of an unpacked simulation folder."""
+    manifest = os.path.join(folder, "static-files.json")
+    if not os.path.isfile(manifest):
+        return 0
+    with open(manifest, "r") as f:
+        manifest = json.load(f)
+    client = s3_client(endpoint_url)
+    for relative, sha in manifest["files"].items():
+        os.makedirs(os.path.dirname(os.path.join(folder, relative)), exist_ok=True)
+        client.download_file(bucket, "{}/{}".format(manifest["prefix"], sha), os.path.join(folder, relative))
+    return len(manifest["files"])
+
+
+def link_file(src, dst):
+    """Hard-link src to dst (replacing dst), copying instead where a link is not possible, e.g. across file systems."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def stage_static_files(source, folder, materialise=(), link=True):
+    """
+    Stage a static folder into a run folder. Files are hard-linked (see link_file) unless link is False or their
+    relative path matches one of the materialise patterns, i.e. templates rewritten in place, which get real copies.
+    An existing destination is always unlinked first so nothing is ever written through a link into static/.
+    Returns a list of (relative path, "linked" or "copied").
+    """
+    staged = []
+    for root, dirs, names in os.walk(source):
+        dirs.sort()
+        relative_root = os.path.relpath(root, source)
+        os.makedirs(os.path.join(folder, relative_root), exist_ok=True)
+        for name in sorted(names):
+            relative = os.path.normpath(os.path.join(relative_root, name))
+            src, dst = os.path.join(source, relative), os.path.join(folder, relative)
+            if link and not any(fnmatch.fnmatch(relative, pattern) for pattern in materialise):
+                link_file(src, dst)
+                staged.append((relative, "linked"))
+            else:
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                shutil.copy2(src, dst)
+                staged.append((relative, "copied"))
+    return staged
+
+
+def file_md5(file, start=0, length=None, block=8 * 1024 ** 2):
+    md5 = hashlib.md5()
+    with open(file, "rb") as f:
+        f.seek(start)
+        remaining = os.path.getsize(file) - start if length is None else length
+        while remaining > 0:
+            data = f.read(min(block, remaining))
+            if not data:
+                break
+            md5.update(data)
+            remaining = remaining - len(data)
+    return md5
+
+
+def verify_etag(file, etag, part_sizes=[8, 16, 5, 10, 25, 50, 64, 100]):
+    """
+    Check a file against an S3 ETag: the MD5 of the file, or for multipart uploads ("{md5}-{parts}") the MD5 of
+    the part MD5s, trying the usual part sizes (MiB). Returns None if the ETag cannot be checked.
+    """
+    etag = (etag or "").strip('"')
+    if re.fullmatch(r"[0-9a-f]{32}", etag):
+        return file_md5(file).hexdigest() == etag
+    match = re.fullmatch(r"([0-9a-f]{32})-(\d+)", etag)
+    if not match:
+        return None
+    size = os.path.getsize(file)
+    parts = int(match.group(2))
+    for part_size in [p * 1024 ** 2 for p in part_sizes]:
+        if -(-size // part_size) == parts:
+            digest = hashlib.md5(b"".join(file_md5(file, i * part_size, part_size).digest() for i in range(parts)))
+            if digest.hexdigest() == match.group(1):
+                return True
+    return None
+
+
+def download_range(url, file_name, start, end):
+    response = http_get(url, headers={"Range": "bytes={}-{}".format(start, end)}, stream=True)
+    try:
+        if response.status_code != 206:
+            raise ValueError("Range request {}-{} for {} failed with HTTP status {}".format(start, end, url, response.status_code))
+        with open(file_name, "r+b") as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=1024 ** 2):
+                f.write(chunk)
+            if f.tell() != end + 1:
+                raise ValueError("Incomplete range {}-{} for {}".format(start, end, url))
+    finally:
+        response.close()
+
+
+def download_file(url, file_name, parallel_n=8, part_size=64 * 1024 ** 2, head=None):
+    """
+    Download url to file_name and return the HTTP status code, the file is only written if it is 200.
+
+    Files larger than part_size served with byte ranges are fetched as up to parallel_n concurrent range requests,
+    others are streamed to disk in chunks. The result is checked against Content-Length and the ETag before it
+    replaces file_name. Network errors and failed checks raise.
+    """
+    if head is None:
+        head = http_get(url, method="HEAD", allow_redirects=True)
+    if head.status_code != 200:
+        return head.status_code
+    size = int(head.headers["Content-Length"]) if "Content-Length" in head.headers else None
+    temp = file_name + ".part"
+    try:
+        if size is not None and size > part_size and parallel_n > 1 and head.headers.get("Accept-Ranges") == "bytes":
+            with open(temp, "wb") as f:
+                f.truncate(size)
+            ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+            with ThreadPoolExecutor(min(parallel_n, len(ranges))) as executor:
+                list(executor.map(lambda r: download_range(url, temp, r[0], r[1]), ranges))
+        else:
+            response = http_get(url, stream=True)
+            try:
+                if response.status_code != 200:
+                    return response.status_code
+                with open(temp, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=1024 ** 2):
+                        file.write(chunk)
+            finally:
+                response.close()
+        if size is not None and os.path.getsize(temp) != size:
+            raise ValueError("Downloaded {} bytes of {} from {}".format(os.path.getsize(temp), size, url))
+        if verify_etag(temp, head.headers.get("ETag")) is False:
+            raise ValueError("Checksum of {} does not match its ETag".format(url))
+        os.replace(temp, file_name)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return 200
+
+
+def mirror_file(url, file_name, cache=False, parallel_n=8):
+    """
+    Fetch url to file_name through a local mirror (FileCache). Entries are keyed by the url and the version the
+    server reports (ETag, Last-Modified, size), so each version is downloaded once and hard-linked into place.
+    Returns the HTTP status code, e.g. 403 or 404 if the file does not exist.
+    """
+    head = http_get(url, method="HEAD", allow_redirects=True)
+    if head.status_code != 200 or not cache:
+        return download_file(url, file_name, parallel_n, head=head)
+    key = cache_key("mirror", url, head.headers.get("ETag"), head.headers.get("Last-Modified"), head.headers.get("Content-Length"))
+    path = cache.get(key)
+    if not path:
+        temp = cache.temporary_file()
+        try:
+            status_code = download_file(url, temp, parallel_n, head=head)
+            if status_code != 200:
+                return status_code
+            path = cache.put(key, temp, move=True)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    link_file(path, file_name)
+    return 200
 
 
 def closest_sunday(input_date):
@@ -133,9 +564,15 @@ def verify_args(args):
               {"name": "bucket", "type": valid_bucket, "default": False},
               {"name": "restart", "type": valid_file, "default": False},
               {"name": "run", "type": valid_bool, "default": False},
+              {"name": "threads", "type": valid_threads, "default": 1},
               {"name": "api", "type": valid_string, "default": False},
               {"name": "today", "type": valid_date, "default": datetime.now()},
               {"name": "log", "type": valid_path, "default": False},
+              {"name": "cache", "type": valid_path, "default": False},
+              {"name": "figures", "type": valid_bool, "default": True},
+              {"name": "resume", "type": valid_bool, "default": False},
+              {"name": "static_dedup", "type": valid_bool, "default": False},
+              {"name": "link_static", "type": valid_bool, "default": True},
               ]
 
     for i in range(len(checks)):
@@ -151,7 +588,7 @@ def boolean_string(s):
 
 
 def get_ice():
-    response = get("https://alplakes-eawag.s3.eu-central-1.amazonaws.com/simulations/ice.json")
+    response = http_get("https://alplakes-eawag.s3.eu-central-1.amazonaws.com/simulations/ice.json")
     if response.status_code == 200:
         json_data = response.json()
         return json_data
@@ -224,6 +661,22 @@ def valid_bucket(check, args):
             raise Exception("A valid key: {} format boolean must be provided.".format(check["name"]))
 
 
+def valid_threads(check, args):
+    """Resolves auto to the core count. nPx_nPy (a MITgcm tile layout) is kept as is, and only accepted for MITgcm."""
+    if check["name"] not in args:
+        return check["default"]
+    threads = str(args[check["name"]])
+    if threads == "auto":
+        return os.cpu_count() or 1
+    if threads.isdigit() and int(threads) > 0:
+        return int(threads)
+    if re.fullmatch(r"\d+_\d+", threads):
+        if args["model"].split("/")[0] != "mitgcm":
+            raise Exception("A {} layout nPx_nPy is only supported for MITgcm, use a core count or auto.".format(check["name"]))
+        return threads
+    raise Exception("A valid key: {} format core count, auto or nPx_nPy (MITgcm) must be provided.".format(check["name"]))
+
+
 def valid_path(check, args):
     if check["name"] not in args:
         if "default" in check:
@@ -283,6 +736,8 @@ class logger(object):
         else:
             self.path = False
         self.stage = 1
+        self.stage_lock = threading.Lock()
+        self.current = threading.local()
 
     def info(self, string, indent=0):
         out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + string
@@ -298,18 +753,24 @@ class logger(object):
             with open(self.path, "a") as file:
                 file.write(out + "\n")
 
+    def current_stage(self):
+        """Stage begun by the calling thread, stages of a pipeline can run concurrently."""
+        return getattr(self.current, "stage", self.stage - 1)
+
     def begin_stage(self, string):
         self.newline()
-        out = datetime.now().strftime("%H:%M:%S.%f") + "   Stage {}: ".format(self.stage) + string
-        self.stage = self.stage + 1
+        with self.stage_lock:
+            self.current.stage = self.stage
+            self.stage = self.stage + 1
+        out = datetime.now().strftime("%H:%M:%S.%f") + "   Stage {}: ".format(self.current.stage) + string
         print('\033[95m' + out + '\033[0m')
         if self.path:
             with open(self.path, "a") as file:
                 file.write(out + "\n")
-        return self.stage - 1
+        return self.current.stage
 
     def end_stage(self):
-        out = datetime.now().strftime("%H:%M:%S.%f") + "   Stage {}: Completed.".format(self.stage - 1)
+        out = datetime.now().strftime("%H:%M:%S.%f") + "   Stage {}: Completed.".format(self.current_stage())
         print('\033[92m' + out + '\033[0m')
         if self.path:
             with open(self.path, "a") as file:
@@ -323,7 +784,7 @@ class logger(object):
                 file.write(out + "\n")
 
     def error(self):
-        out = datetime.now().strftime("%H:%M:%S.%f") + "   ERROR: Script failed on stage {}".format(self.stage - 1)
+        out = datetime.now().strftime("%H:%M:%S.%f") + "   ERROR: Script failed on stage {}".format(self.current_stage())
         print('\033[91m' + out + '\033[0m')
         if self.path:
             with open(self.path, "a") as file:
@@ -394,22 +855,141 @@ def run_simulation(bucket, model, lake, restart, docker, simulation_dir, simulat
         raise RuntimeError("Simulation failed.")
 
 
-def upload_results(simulation_dir, api_server_folder, api_server, api_user, api_password):
-    cmd = ("sshpass -p {} ssh {}@{} mkdir -p {}"
-           .format(api_password, api_user, api_server, api_server_folder))
+def path_digest(paths, *parts):
+    """Content hash of files and directory trees (relative names and bytes), plus any extra parts."""
+    h = hashlib.sha256(json.dumps(parts, default=str).encode("utf-8"))
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(os.path.join(root, file) for root, _, names in os.walk(path) for file in names)
+        for file in files:
+            h.update(os.path.relpath(file, os.path.dirname(path)).encode("utf-8"))
+            h.update(bytes.fromhex(file_sha256(file)))
+    return h.hexdigest()
+
 
-    process = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+def docker_image_id(image):
+    """Id of a local docker image, or False if it does not exist."""
+    process = subprocess.run(["docker", "image", "inspect", "--format", "{{.Id}}", image], capture_output=True, text=True)
     if process.returncode != 0:
-        print(process.returncode, process.stdout)
-        raise RuntimeError("Create folder failed.")
+        return False
+    return process.stdout.strip()
 
-    cmd = ("sshpass -p {} scp -r -o StrictHostKeyChecking=no {}/postprocess/* {}@{}:{}"
-           .format(api_password, simulation_dir, api_user, api_server, api_server_folder))
 
-    process = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+def remove_old_docker_images(prefix, keep, n=3, digest=12):
+    """
+    Remove local images named prefix followed by a hex digest of the given length (repository:tag), except the n
+    most recent and those in keep. Matching the whole tag keeps the images of lakes whose name extends this one
+    (geneva, geneva_1000). Returns the removed images, images that cannot be removed (e.g. used by a container)
+    are skipped.
+    """
+    repository = prefix.split(":")[0]
+    process = subprocess.run(["docker", "image", "ls", "--format", "{{.Repository}}:{{.Tag}}", repository], capture_output=True, text=True)
     if process.returncode != 0:
-        print(process.returncode, process.stdout)
-        raise RuntimeError("Upload files failed.")
+        return []
+    pattern = re.compile(re.escape(prefix) + "[0-9a-f]{{{}}}".format(digest))
+    images = [image for image in process.stdout.split() if pattern.fullmatch(image)]
+    removed = []
+    for image in images[n:]:
+        if image not in keep and subprocess.run(["docker", "rmi", image], capture_output=True).returncode == 0:
+            removed.append(image)
+    return removed
+
+
+def sftp_makedirs(sftp, folder):
+    parts = []
+    while folder not in ["", "/"]:
+        try:
+            sftp.stat(folder)
+            break
+        except IOError:
+            parts.append(folder)
+            folder = os.path.dirname(folder)
+    for part in reversed(parts):
+        sftp.mkdir(part)
+
+
+def sftp_write_atomic(sftp, file, remote_file):
+    """Upload to a temporary name next to remote_file then rename, so readers never see a partial file."""
+    temp = "{}.part-{}-{}".format(remote_file, os.getpid(), threading.get_ident())
+    try:
+        sftp.put(file, temp, confirm=True)
+        sftp.posix_rename(temp, remote_file)
+    except BaseException:
+        try:
+            sftp.remove(temp)
+        except IOError:
+            pass
+        raise
+
+
+def read_remote_manifest(sftp, remote_file):
+    try:
+        with sftp.open(remote_file, "r") as f:
+            return json.loads(f.read().decode("utf-8"))
+    except (IOError, ValueError):
+        return {}
+
+
+def upload_results(simulation_dir, api_server_folder, api_server, api_user, api_password, port=22, parallel_n=4,
+                   manifest=".published.json", log=False):
+    """
+    Publish {simulation_dir}/postprocess to api_server_folder over SFTP. A manifest of the published files (size and
+    sha256) is kept in the remote folder, only new or changed files are sent, over parallel_n SFTP channels, and each
+    one is written under a temporary name and renamed into place. Returns the list of uploaded files.
+    """
+    if not log:
+        log = logger()
+    local_folder = os.path.join(simulation_dir, "postprocess")
+    files = {}
+    for root, dirs, names in os.walk(local_folder):
+        for name in names:
+            relative = os.path.relpath(os.path.join(root, name), local_folder)
+            files[relative] = {"size": os.path.getsize(os.path.join(root, name)), "sha256": file_sha256(os.path.join(root, name))}
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(api_server, port=port, username=api_user, password=api_password, look_for_keys=False, allow_agent=False)
+    try:
+        sftp = client.open_sftp()
+        sftp_makedirs(sftp, api_server_folder)
+        manifest_file = "{}/{}".format(api_server_folder.rstrip("/"), manifest)
+        published = read_remote_manifest(sftp, manifest_file)
+        remote = {}
+        for relative, properties in files.items():
+            remote_file = "{}/{}".format(api_server_folder.rstrip("/"), relative.replace(os.sep, "/"))
+            if published.get(relative) == properties:
+                try:
+                    if sftp.stat(remote_file).st_size == properties["size"]:
+                        continue
+                except IOError:
+                    pass
+            remote[relative] = remote_file
+        log.info("Publishing {} of {} files to {}:{}".format(len(remote), len(files), api_server, api_server_folder), indent=1)
+        for folder in sorted(set(os.path.dirname(r) for r in remote.values())):
+            sftp_makedirs(sftp, folder)
+
+        channels = threading.local()
+        opened = []
+
+        def upload(relative):
+            if not hasattr(channels, "sftp"):
+                channels.sftp = client.open_sftp()
+                opened.append(channels.sftp)
+            sftp_write_atomic(channels.sftp, os.path.join(local_folder, relative), remote[relative])
+            published[relative] = files[relative]
+            log.info("Published {}".format(relative), indent=2)
+
+        try:
+            with ThreadPoolExecutor(max(1, min(parallel_n, len(remote)))) as executor:
+                list(executor.map(upload, sorted(remote)))
+        finally:
+            for channel in opened:
+                channel.close()
+            with sftp.open(manifest_file + ".part", "w") as f:
+                f.write(json.dumps(published, indent=1, sort_keys=True))
+            sftp.posix_rename(manifest_file + ".part", manifest_file)
+        return sorted(remote)
+    finally:
+        client.close()
 
 
 def thermocline(file, overwrite=False):
@@ -757,6 +1337,21 @@ def get_closest_index(value, array):
     return (np.abs(array - value)).argmin()
 
 
+def mitgcm_dz_file(path_grid):
+    """dz.npy of a grid folder, or dz.csv (comma separated, any number of rows) if there is no dz.npy."""
+    file = os.path.join(path_grid, "dz.npy")
+    if not os.path.isfile(file) and os.path.isfile(os.path.join(path_grid, "dz.csv")):
+        return os.path.join(path_grid, "dz.csv")
+    return file
+
+
+def load_mitgcm_dz(path_grid):
+    file = mitgcm_dz_file(path_grid)
+    if file.endswith(".csv"):
+        return np.loadtxt(file, delimiter=",", encoding="utf-8-sig").ravel()
+    return np.load(file)
+
+
 class MitgcmGrid:
     """Class representing an MITgcm grid, with optional loading from .npy files."""
 
@@ -771,7 +1366,7 @@ class MitgcmGrid:
 
     def load_from_path(self, path_grid: str):
         """
-        Load grid data from a given folder containing .npy files.
+        Load grid data from a given folder containing .npy files (dz may be given as dz.csv instead).
 
         Args:
             path_grid (str): Path to the folder containing the grid files.
@@ -785,7 +1380,7 @@ class MitgcmGrid:
             self.y = np.load(os.path.join(path_grid, 'y.npy'))
             self.lat_grid = np.load(os.path.join(path_grid, 'lat_grid.npy'))
             self.lon_grid = np.load(os.path.join(path_grid, 'lon_grid.npy'))
-            self.dz = np.round(np.load(os.path.join(path_grid, 'dz.npy')), 3)
+            self.dz = np.round(load_mitgcm_dz(path_grid), 3)
             with open(os.path.join(path_grid, 'parameters.json'), 'r') as file:
                 self.parameters = json.load(file)
         except FileNotFoundError as e:
@@ -794,6 +1389,69 @@ class MitgcmGrid:
             raise RuntimeError(f"Error loading grid data: {e}") from e
 
 
+def mitgcm_tile_wet_cells(bathy, nPx, nPy):
+    """Wet (bathy < 0) cell count of each tile of an nPx x nPy decomposition, ordered as exch2 numbers tiles (from 1, row by row)."""
+    Ny, Nx = bathy.shape
+    return np.count_nonzero(bathy.reshape(nPy, Ny // nPy, nPx, Nx // nPx) < 0, axis=(1, 3)).ravel()
+
+
+def mitgcm_size_overlap(size_file):
+    """Tile overlap (OLx, OLy) declared in a MITgcm SIZE.h."""
+    overlap = {}
+    with open(size_file, "r") as f:
+        for match in re.finditer(r"PARAMETER\s*::\s*(OLx|OLy)\s*=\s*(\d+)", f.read()):
+            overlap[match.group(1)] = int(match.group(2))
+    if len(overlap) != 2:
+        raise ValueError("OLx and OLy not found in {}".format(size_file))
+    return overlap["OLx"], overlap["OLy"]
+
+
+def mitgcm_decomposition(bathy, nPx, nPy, blank=True, overlap=(3, 3)):
+    """
+    Describe an nPx x nPy decomposition of the grid: tiles without wet cells are blanked (if blank), the cost of
+    the run is taken as the cells each process computes (tile plus overlap) and the load imbalance as the largest
+    over the mean wet cell count of the active tiles. overlap is (OLx, OLy) from SIZE.h, MITgcm rejects tiles
+    narrower than the overlap.
+    """
+    Ny, Nx = bathy.shape
+    if Nx % nPx != 0 or Ny % nPy != 0:
+        raise ValueError("Grid division must be an integer of number of cells.")
+    sNx, sNy = Nx // nPx, Ny // nPy
+    if sNx < overlap[0] or sNy < overlap[1]:
+        raise ValueError("Tiles of {}x{} cells are smaller than the overlap {}x{}.".format(sNx, sNy, overlap[0], overlap[1]))
+    wet = mitgcm_tile_wet_cells(bathy, nPx, nPy)
+    land = wet == 0 if blank else np.zeros(len(wet), dtype=bool)
+    active = wet[~land]
+    return {"nPx": nPx, "nPy": nPy, "sNx": sNx, "sNy": sNy,
+            "blank": [int(i) + 1 for i in np.where(land)[0]],
+            "active": len(active),
+            "cost": (sNx + 2 * overlap[0]) * (sNy + 2 * overlap[1]),
+            "imbalance": float(active.max() / active.mean()) if len(active) > 0 and active.mean() > 0 else 1.0}
+
+
+def optimise_mitgcm_decomposition(bathy, cores, blank=True, overlap=(3, 3)):
+    """
+    Search all (nPx, nPy) that divide the grid into tiles at least as large as the overlap for the decomposition
+    with at most cores active tiles that minimises the cells per process, preferring fewer active tiles and then
+    a lower wet cell imbalance.
+    """
+    Ny, Nx = bathy.shape
+    best = None
+    for nPx in [n for n in range(1, Nx + 1) if Nx % n == 0 and Nx // n >= overlap[0]]:
+        for nPy in [n for n in range(1, Ny + 1) if Ny % n == 0 and Ny // n >= overlap[1]]:
+            if nPx * nPy > cores and not blank:
+                break
+            decomposition = mitgcm_decomposition(bathy, nPx, nPy, blank, overlap)
+            if decomposition["active"] == 0 or decomposition["active"] > cores:
+                continue
+            key = (decomposition["cost"], decomposition["active"], decomposition["imbalance"])
+            if best is None or key < best[0]:
+                best = (key, decomposition)
+    if best is None:
+        raise ValueError("No valid decomposition of the {}x{} grid found for {} cores".format(Nx, Ny, cores))
+    return best[1]
+
+
 def get_mitgcm_grid(path_folder_grid: str) -> MitgcmGrid:
     grid = MitgcmGrid()
     grid.load_from_path(path_folder_grid)
@@ -957,19 +1615,84 @@ def delft3d_mesh_mask(X, Y, xq, yq):
     return Path(verts, codes).contains_points(pts).reshape(shape)
 
 
-def modify_arguments(param_name: str, values, file_path, wrap=9):
+def format_ascii_grid(data, fmt="%.2f", delimiter=" ", newline="\n", headers=None):
     """
-    Function to modify run-time parameters, based on variable name, with the
-    assumption that they are stored the file as '!varName!'
-      param_name  - parameter name that should be replaced in the config file
-      values - values replacing the param_name in the config file
-      fileIn  - 00-template_mitgcm configuration
-      fileOut - output run-time configuration
+    Render a (rows, cols) or (time, rows, cols) block as text, identical to np.savetxt(f, data[t], fmt=fmt,
+    delimiter=delimiter, newline=newline) for each timestep, each optionally preceded by headers[t].
+    Fixed point formats ("%.nf") are rendered digit by digit with numpy, values whose rounding can't be
+    decided exactly that way (ties, NaN, inf, huge values) are formatted by Python. Other formats use a
+    single % operation for the whole block.
     """
-
-    with open(file_path, 'r') as infile:
-        content = infile.read()
-
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    if headers is None:
+        headers = [""] * data.shape[0]
+    fixed = re.fullmatch(r"%\.(\d+)f", fmt)
+    if not fixed or len(delimiter) != 1 or len(newline) != 1:
+        grid = (delimiter.join([fmt] * data.shape[2]) + newline) * data.shape[1]
+        values = data.reshape(data.shape[0], -1).tolist()
+        return (("%s" + grid) * data.shape[0]) % tuple(chain.from_iterable([header] + v for header, v in zip(headers, values)))
+
+    decimals = int(fixed.group(1))
+    values = data.ravel()
+    scaled = np.abs(values) * 10 ** decimals
+    with np.errstate(invalid="ignore"):
+        rounded = np.floor(scaled)
+        fraction = scaled - rounded
+        exact = (scaled < 2 ** 50) & (np.abs(fraction - 0.5) > 1e-12 * (scaled + 1))
+    rounded = np.where(exact, rounded + (fraction > 0.5), 0).astype(np.int64)
+    integer, fraction = np.divmod(rounded, 10 ** decimals)
+    largest = int(np.max(integer, initial=0))
+    if largest < 2 ** 31 and decimals < 10:
+        integer, fraction = integer.astype(np.int32), fraction.astype(np.int32)
+    digits = np.ones(len(values), dtype=np.int8)
+    for k in range(1, len(str(largest))):
+        digits += integer >= 10 ** k
+    max_digits = int(np.max(digits, initial=1))
+    negative = np.signbit(values)
+    inexact = np.where(~exact)[0]
+    tokens = [(fmt % values[i]).encode("ascii") for i in inexact]
+    width = max([max_digits + 1 + (decimals + 1 if decimals > 0 else 0)] + [len(t) for t in tokens]) + 1
+
+    # One row per character position (right aligned) so every assignment is contiguous, 0 marks padding
+    chars = np.zeros((width, len(values)), dtype=np.uint8)
+    chars[-1] = ord(delimiter)
+    chars[-1, data.shape[2] - 1::data.shape[2]] = ord(newline)
+    row = width - 2
+    for k in range(decimals):
+        quotient = fraction // 10
+        chars[row] = (fraction - quotient * 10).astype(np.uint8) + np.uint8(48)
+        fraction = quotient
+        row = row - 1
+    if decimals > 0:
+        chars[row] = ord(".")
+        row = row - 1
+    for k in range(max_digits):
+        quotient = integer // 10
+        chars[row - k] = ((integer - quotient * 10).astype(np.uint8) + np.uint8(48)) * (digits > k)
+        integer = quotient
+    for k in range(1, max_digits + 1):
+        chars[row - k] += ((digits == k) & negative) * np.uint8(ord("-"))
+    chars = np.ascontiguousarray(chars.T)
+    for i, token in zip(inexact, tokens):
+        chars[i, :-1] = 0
+        chars[i, width - 1 - len(token):-1] = np.frombuffer(token, dtype=np.uint8)
+
+    size = data.shape[1] * data.shape[2]
+    out = []
+    for t, header in enumerate(headers):
+        block = chars[t * size:(t + 1) * size]
+        out.append(header)
+        out.append(block[block != 0].tobytes().decode("ascii"))
+    return "".join(out)
+
+
+TEMPLATE_PLACEHOLDER = re.compile(r"![A-Za-z_][A-Za-z0-9_]*!")
+
+
+def format_argument(values, wrap=9):
+    """Text for a template value, numeric arrays are written comma separated (1D arrays wrap every wrap values)."""
     if isinstance(values, np.ndarray):
         if values.ndim == 1:
             lines = []
@@ -977,22 +1700,95 @@ def modify_arguments(param_name: str, values, file_path, wrap=9):
                 chunk = values[i:i + wrap]
                 line_str = ",".join(str(v) for v in chunk if not np.isnan(v))
                 lines.append(line_str)
-            str_values = "\n".join(lines)
+            return "\n".join(lines)
         else:
             lines = []
             for row in values:
                 row_str = ",".join(str(v) for v in row if not np.isnan(v))
                 lines.append(row_str)
-            str_values = "\n".join(lines)
-    else:
-        str_values = str(values)
+            return "\n".join(lines)
+    return str(values)
+
 
-    modified_content = content.replace(param_name, str_values)
+def modify_arguments(param_name: str, values, file_path, wrap=9):
+    """
+    Function to modify run-time parameters, based on variable name, with the
+    assumption that they are stored the file as '!varName!'
+      param_name  - parameter name that should be replaced in the config file
+      values - values replacing the param_name in the config file
+      fileIn  - 00-template_mitgcm configuration
+      fileOut - output run-time configuration
+    """
+
+    with open(file_path, 'r') as infile:
+        content = infile.read()
+
+    modified_content = content.replace(param_name, format_argument(values, wrap))
 
     with open(file_path, 'w') as outfile:
         outfile.write(modified_content)
 
 
+def render_template(file_path, replacements, overwrite=None, wrap=9):
+    """
+    Replace all '!name!' placeholders of a template file in a single pass and write it back once.
+
+    Args:
+        file_path (str): Template, rendered in place.
+        replacements (dict): {'!name!': value}, values are formatted as in modify_arguments.
+        overwrite (dict): Optional {parameter_name: new_value} applied afterwards as in overwrite_defaults.
+
+    Raises:
+        KeyError: If the template contains placeholders without a value, before anything is written.
+    """
+    with open(file_path, 'r') as infile:
+        content = infile.read()
+
+    missing = sorted(set(m.group(0) for m in TEMPLATE_PLACEHOLDER.finditer(content)) - set(replacements))
+    if missing:
+        raise KeyError("Unresolved placeholders in {}: {}".format(file_path, ", ".join(missing)))
+
+    text = {key: format_argument(value, wrap) for key, value in replacements.items()}
+    content = TEMPLATE_PLACEHOLDER.sub(lambda m: text[m.group(0)], content)
+    if overwrite:
+        content = "".join(overwrite_lines(content.splitlines(keepends=True), overwrite))
+
+    with open(file_path, 'w') as outfile:
+        outfile.write(content)
+
+
+def overwrite_lines(lines, param_dict):
+    updated_lines = []
+    found_keys = set()
+
+    for line in lines:
+        stripped = line.lstrip()
+        for key, value in param_dict.items():
+            if stripped.startswith(key) and "=" in stripped:
+                found_keys.add(key)
+                # Split into before '=' and after '='
+                before_eq, after_eq = line.split("=", 1)
+
+                # Preserve spacing after '='
+                leading_after = len(after_eq) - len(after_eq.lstrip())
+                spaces_after_eq = after_eq[:leading_after]
+
+                # Identify the old value
+                parts = after_eq.lstrip().split(maxsplit=1)
+                old_value = parts[0]
+                rest = parts[1] if len(parts) > 1 else ""
+
+                # Rebuild the line
+                line = f"{before_eq}={spaces_after_eq}{value}{(' ' + rest) if rest else ''}\n"
+                break
+        updated_lines.append(line)
+
+    missing_keys = set(param_dict.keys()) - found_keys
+    if missing_keys:
+        raise KeyError(f"The following parameters were not found in the file: {', '.join(sorted(missing_keys))}")
+    return updated_lines
+
+
 def overwrite_defaults(param_dict, file_path):
     """
         Update parameter values in a file while maintaining formatting and spacing,
@@ -1002,35 +1798,8 @@ def overwrite_defaults(param_dict, file_path):
             param_dict (dict): Dictionary of {parameter_name: new_value}
             file_path (str): Path to the text file to modify.
         """
-    updated_lines = []
-    found_keys = set()
-
     with open(file_path, "r") as f:
-        for line in f:
-            stripped = line.lstrip()
-            for key, value in param_dict.items():
-                if stripped.startswith(key) and "=" in stripped:
-                    found_keys.add(key)
-                    # Split into before '=' and after '='
-                    before_eq, after_eq = line.split("=", 1)
-
-                    # Preserve spacing after '='
-                    leading_after = len(after_eq) - len(after_eq.lstrip())
-                    spaces_after_eq = after_eq[:leading_after]
-
-                    # Identify the old value
-                    parts = after_eq.lstrip().split(maxsplit=1)
-                    old_value = parts[0]
-                    rest = parts[1] if len(parts) > 1 else ""
-
-                    # Rebuild the line
-                    line = f"{before_eq}={spaces_after_eq}{value}{(' ' + rest) if rest else ''}\n"
-                    break
-            updated_lines.append(line)
-
-    missing_keys = set(param_dict.keys()) - found_keys
-    if missing_keys:
-        raise KeyError(f"The following parameters were not found in the file: {', '.join(sorted(missing_keys))}")
+        updated_lines = overwrite_lines(f, param_dict)
 
     with open(file_path, "w") as f:
         f.writelines(updated_lines)
@@ -1168,22 +1937,18 @@ def extract_data_from_output_file(file_path, variable, pattern, depth=1):
         return timestamps, data
 
 
-def plot_input_heatmaps(inputs, folder):
+def plot_input_heatmaps(inputs, folder, processes=None):
     out_folder = os.path.join(folder, "plots", "inputs")
     os.makedirs(out_folder, exist_ok=True)
-    for i in range(len(inputs[0]["timestamps"])):
-        out_file = os.path.join(out_folder, "{}.png".format(inputs[0]["timestamps"][i]))
-        if not os.path.exists(out_file):
-            fig = plt.figure(figsize=(18, 8))
-            fig.suptitle(inputs[0]["timestamps"][i])
-            for j in range(len(inputs)):
-                plt.subplot(3, 3, j + 1)
-                plt.imshow(inputs[j]["data"][min(i, len(inputs[j]["data"]) - 1)], cmap='coolwarm', interpolation='nearest')
-                plt.title(inputs[j]["file"].split(".")[0])
-                plt.colorbar()
-            plt.tight_layout()
-            plt.savefig(out_file)
-            plt.close()
+    diagnostics = Diagnostics(processes=processes or os.cpu_count() or 1)
+    try:
+        for i in range(len(inputs[0]["timestamps"])):
+            out_file = os.path.join(out_folder, "{}.png".format(inputs[0]["timestamps"][i]))
+            if not os.path.exists(out_file):
+                panels = [(inputs[j]["file"].split(".")[0], inputs[j]["data"][min(i, len(inputs[j]["data"]) - 1)]) for j in range(len(inputs))]
+                diagnostics.figure(render_heatmaps, out_file, inputs[0]["timestamps"][i], panels, 3, 3)
+    finally:
+        diagnostics.close()
 
 
 def plot_input_linegraph(inputs, nan_value=-999.0):
@@ -1211,22 +1976,18 @@ def plot_input_linegraph(inputs, nan_value=-999.0):
     plt.show()
 
 
-def plot_output_heatmaps(inputs, folder):
+def plot_output_heatmaps(inputs, folder, processes=None):
     out_folder = os.path.join(folder, "plots", "outputs")
     os.makedirs(out_folder, exist_ok=True)
-    for i in range(len(inputs[0]["timestamps"])):
-        out_file = os.path.join(out_folder, "{}.png".format(inputs[0]["timestamps"][i]))
-        if not os.path.exists(out_file):
-            fig = plt.figure(figsize=(18, 8))
-            fig.suptitle(inputs[0]["timestamps"][i])
-            for j in range(len(inputs)):
-                plt.subplot(1, 3, j + 1)
-                plt.imshow(inputs[j]["data"][i], cmap='coolwarm', interpolation='nearest')
-                plt.title(inputs[j]["name"])
-                plt.colorbar()
-            plt.tight_layout()
-            plt.savefig(out_file)
-            plt.close()
+    diagnostics = Diagnostics(processes=processes or os.cpu_count() or 1)
+    try:
+        for i in range(len(inputs[0]["timestamps"])):
+            out_file = os.path.join(out_folder, "{}.png".format(inputs[0]["timestamps"][i]))
+            if not os.path.exists(out_file):
+                panels = [(inputs[j]["name"], inputs[j]["data"][i]) for j in range(len(inputs))]
+                diagnostics.figure(render_heatmaps, out_file, inputs[0]["timestamps"][i], panels, 1, 3)
+    finally:
+        diagnostics.close()
 
 
 def plot_output_linegraph(inputs):
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import numpy as np
+from cache import cache_key
+from functions import load_npz, MitgcmGrid, SWANGrid, ch1903_to_latlng, utm_to_latlng, read_delft3d_grd, read_delft3d_dep, delft3d_mesh_mask, mitgcm_dz_file
+
+BUNDLE_VERSION = 1
+
+
+def static_digest(files, *parts):
+    """Content hash of the static input files (and any extra parts) a bundle is built from."""
+    h = hashlib.sha256(json.dumps([BUNDLE_VERSION, parts], sort_keys=True, default=str).encode("utf-8"))
+    for file in files:
+        h.update(os.path.basename(file).encode("utf-8"))
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1024 ** 2), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def encode_metadata(metadata):
+    return np.frombuffer(json.dumps(metadata, sort_keys=True).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_metadata(array):
+    return json.loads(np.asarray(array).tobytes().decode("utf-8"))
+
+
+def load_bundle(name, files, build, cache=False, parts=()):
+    """
+    Arrays of a geometry bundle. With a cache the bundle is compiled once into a single .npz, addressed by
+    the content of its static inputs, and memory-mapped on later runs. Returns (arrays, built).
+    """
+    if not cache:
+        return build(), True
+    key = cache_key("geometry", BUNDLE_VERSION, name, static_digest(files, *parts))
+    path = cache.get(key)
+    if path:
+        return load_npz(path), False
+    arrays = build()
+    temp = cache.temporary_file()
+    with open(temp, "wb") as f:
+        np.savez(f, **arrays)
+    return load_npz(cache.put(key, temp, move=True)), True
+
+
+def mitgcm_grid_files(folder):
+    return [os.path.join(folder, file) for file in ["x.npy", "y.npy", "lat_grid.npy", "lon_grid.npy"]] + \
+        [mitgcm_dz_file(folder), os.path.join(folder, "parameters.json")]
+
+
+def build_mitgcm_grid(folder):
+    grid = MitgcmGrid()
+    grid.load_from_path(folder)
+    return {"x": grid.x, "y": grid.y, "lat_grid": grid.lat_grid, "lon_grid": grid.lon_grid, "dz": grid.dz,
+            "metadata": encode_metadata(grid.parameters)}
+
+
+def mitgcm_grid(folder, cache=False):
+    """MitgcmGrid of a grid folder (see MitgcmGrid.load_from_path). Returns (grid, built)."""
+    files = mitgcm_grid_files(folder)
+    for file in files:
+        if not os.path.isfile(file):
+            raise FileNotFoundError("Missing grid file: {}".format(file))
+    arrays, built = load_bundle("mitgcm_grid", files, lambda: build_mitgcm_grid(folder), cache)
+    grid = MitgcmGrid()
+    grid.x = arrays["x"]
+    grid.y = arrays["y"]
+    grid.lat_grid = arrays["lat_grid"]
+    grid.lon_grid = arrays["lon_grid"]
+    grid.dz = arrays["dz"]
+    grid.parameters = decode_metadata(arrays["metadata"])
+    return grid, built
+
+
+def build_meteo_grid(grid):
+    gx = np.arange(grid["minx"], grid["maxx"] + grid["dx"], grid["dx"])
+    gy = np.arange(grid["miny"], grid["maxy"] + grid["dy"], grid["dy"])
+    gxx, gyy = np.meshgrid(gx, gy)
+    return {"gx": gx, "gy": gy, "gxx": gxx, "gyy": gyy}
+
+
+def meteo_grid(grid, cache=False):
+    """Delft3D equidistant meteo grid (gx, gy, gxx, gyy) from the grid section of properties.json. Returns (arrays, built)."""
+    parts = [grid[k] for k in ["minx", "miny", "maxx", "maxy", "dx", "dy"]]
+    return load_bundle("meteo_grid", [], lambda: build_meteo_grid(grid), cache, parts)
+
+
+def swan_grid_files(source_type, source_dir, lake):
+    if source_type == "delft3d-flow":
+        return [os.path.join(source_dir, "{}_grid.grd".format(lake))]
+    elif source_type == "mitgcm":
+        return mitgcm_grid_files(os.path.join(source_dir, "grid"))
+    raise ValueError("Unknown grid source type: {}".format(source_type))
+
+
+def regular_grid_from_delft3d(X, Y, grid_props):
+    valid = (X != 0) | (Y != 0)
+    x_valid = X[valid]
+    y_valid = Y[valid]
+
+    resolution = float(grid_props.get("resolution", 500))
+    x0 = float(np.floor(x_valid.min() / resolution) * resolution)
+    y0 = float(np.floor(y_valid.min() / resolution) * resolution)
+    x1 = float(np.ceil(x_valid.max() / resolution) * resolution)
+    y1 = float(np.ceil(y_valid.max() / resolution) * resolution)
+    Nx = int(round((x1 - x0) / resolution))
+    Ny = int(round((y1 - y0) / resolution))
+    x_centres = x0 + resolution * (np.arange(Nx) + 0.5)
+    y_centres = y0 + resolution * (np.arange(Ny) + 0.5)
+    return x0, y0, resolution, x_centres, y_centres
+
+
+def build_swan_grid(source_type, source_dir, lake, grid_props):
+    if source_type == "delft3d-flow":
+        X, Y, Mx, My = read_delft3d_grd(os.path.join(source_dir, "{}_grid.grd".format(lake)))
+        system = grid_props.get("system", "CH1903")
+        x0, y0, resolution, x_centres, y_centres = regular_grid_from_delft3d(X, Y, grid_props)
+        xx, yy = np.meshgrid(x_centres, y_centres)
+        if system == "CH1903":
+            lat_grid, lon_grid = ch1903_to_latlng(xx, yy)
+        elif system == "UTM":
+            zone_number = grid_props.get("zone_number", 32)
+            zone_letter = grid_props.get("zone_letter", "T")
+            lat_grid, lon_grid = utm_to_latlng(xx, yy, zone_number, zone_letter)
+        else:
+            raise ValueError("Coordinate system {} not supported for Delft3D source.".format(system))
+        metadata = {"x0": x0, "y0": y0, "dx": resolution, "dy": resolution, "Nx": len(x_centres), "Ny": len(y_centres),
+                    "rotation": 0.0, "system": system, "parameters": {"buffer": grid_props.get("buffer", 0.02)},
+                    "source_nodes": [Mx, My]}
+        return {"x": x_centres, "y": y_centres, "lat_grid": lat_grid, "lon_grid": lon_grid, "metadata": encode_metadata(metadata)}
+    elif source_type == "mitgcm":
+        mitgcm = MitgcmGrid()
+        mitgcm.load_from_path(os.path.join(source_dir, "grid"))
+        params = mitgcm.parameters
+        res = float(params["resolution"])
+        metadata = {"x0": float(mitgcm.x.min()) - res / 2.0, "y0": float(mitgcm.y.min()) - res / 2.0, "dx": res, "dy": res,
+                    "Nx": int(params["Nx"]), "Ny": int(params["Ny"]), "rotation": float(params.get("rotation", 0.0)),
+                    "system": grid_props.get("system", "UTM"), "parameters": params}
+        return {"x": mitgcm.x, "y": mitgcm.y, "lat_grid": mitgcm.lat_grid, "lon_grid": mitgcm.lon_grid, "metadata": encode_metadata(metadata)}
+    raise ValueError("Unknown grid source type: {}".format(source_type))
+
+
+def swan_grid(source_type, source_dir, lake, grid_props, cache=False):
+    """Regular SWANGrid derived from a Delft3D or MITgcm grid source. Returns (grid, metadata, built)."""
+    files = swan_grid_files(source_type, source_dir, lake)
+    arrays, built = load_bundle("swan_grid", files, lambda: build_swan_grid(source_type, source_dir, lake, grid_props), cache, [source_type, grid_props])
+    metadata = decode_metadata(arrays["metadata"])
+    g = SWANGrid()
+    g.grid_type = "regular"
+    for k in ["x0", "y0", "dx", "dy", "Nx", "Ny", "rotation", "system", "parameters"]:
+        setattr(g, k, metadata[k])
+    g.lat_grid = arrays["lat_grid"]
+    g.lon_grid = arrays["lon_grid"]
+    g.x = arrays["x"]
+    g.y = arrays["y"]
+    return g, metadata, built
+
+
+def build_swan_bathymetry(source_type, source_dir, lake, grid):
+    if source_type == "delft3d-flow":
+        from scipy.interpolate import griddata
+        X, Y, Mx, My = read_delft3d_grd(os.path.join(source_dir, "{}_grid.grd".format(lake)))
+        bathy = read_delft3d_dep(os.path.join(source_dir, "{}_depths.dep".format(lake)), Mx, My)
+        valid = (X != 0) & ~np.isnan(bathy)
+        points = np.column_stack([X[valid], Y[valid]])
+        values = bathy[valid]
+        xx, yy = np.meshgrid(grid.x, grid.y)
+        inside = delft3d_mesh_mask(X, Y, xx, yy)
+        bathy_interp = griddata(points, values, (xx, yy), method='linear')
+        bathy_near = griddata(points, values, (xx, yy), method='nearest')
+        depth = np.where(np.isnan(bathy_interp), bathy_near, bathy_interp)
+        return {"bathymetry": np.where(inside, depth, -999.0), "mask": inside}
+    elif source_type == "mitgcm":
+        raw = np.fromfile(os.path.join(source_dir, "grid", "bathy.bin"), dtype=">f8")
+        bathy_raw = raw.reshape((grid.Ny, grid.Nx))
+        return {"bathymetry": np.where(bathy_raw >= 0, 0.0, -bathy_raw), "mask": bathy_raw < 0}
+    raise ValueError("Unknown source type for bathymetry: {}".format(source_type))
+
+
+def swan_bathymetry(source_type, source_dir, lake, grid_props, grid, cache=False):
+    """SWAN bathymetry (-999 outside the lake) and lake mask on the regular SWAN grid. Returns (arrays, built)."""
+    if source_type == "delft3d-flow":
+        files = [os.path.join(source_dir, "{}_grid.grd".format(lake)), os.path.join(source_dir, "{}_depths.dep".format(lake))]
+    elif source_type == "mitgcm":
+        files = swan_grid_files(source_type, source_dir, lake) + [os.path.join(source_dir, "grid", "bathy.bin")]
+    else:
+        raise ValueError("Unknown source type for bathymetry: {}".format(source_type))
+    return load_bundle("swan_bathymetry", files, lambda: build_swan_bathymetry(source_type, source_dir, lake, grid), cache, [source_type, grid_props])
@@ -30,9 +30,14 @@ if __name__ == "__main__":
     parser.add_argument('--restart', '-z', help='Link to restart file, if using local file.', type=str, default=False)
     parser.add_argument('--profile', '-p', help='Name of profile to start from should be in {lake}/profiles.', type=str, default=False)
     parser.add_argument('--run', '-r', help='Run the simulation.', action='store_true')
-    parser.add_argument('--threads', '-th', help='Number of threads', default=1)
+    parser.add_argument('--threads', '-th', help='Number of threads, a core count or auto, for MITgcm also nPx_nPy', default=1)
     parser.add_argument('--api', '-a', help="Url of Alplakes API", type=str, default="http://eaw-alplakes2:8000")
     parser.add_argument('--today', '-t', help="Today's date e.g. 20220102", type=str, default=datetime.now().strftime("%Y%m%d"))
     parser.add_argument('--log', '-l', help="Log directory", type=str, default=False)
+    parser.add_argument('--cache', '-c', help="Cache directory shared between runs", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "../cache"))
+    parser.add_argument('--resume', help='Keep the existing simulation directory and skip stages completed with the same inputs.', action='store_true')
+    parser.add_argument('--static-dedup', help='Upload unchanged static files once, content addressed, and reference them from the uploaded zip.', action='store_true')
+    parser.add_argument('--copy-static', help='Copy static files into the run folder instead of hard-linking the ones that are never modified.', dest="link_static", action='store_false')
+    parser.add_argument('--no-figures', help="Skip rendering diagnostic figures", dest="figures", action='store_false')
     args = parser.parse_args()
     main(vars(args))
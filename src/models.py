@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import glob
 import json
 import shutil
 import subprocess
@@ -7,13 +8,17 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 from scipy.interpolate import interp1d, griddata
-from distutils.dir_util import copy_tree
+import multiprocessing
 from datetime import datetime, timedelta
 
 import river
 import secchi
 import weather
-from functions import logger, ch1903_to_latlng, download_file, upload_file, utm_to_latlng, get_mitgcm_grid, modify_arguments, calculate_specific_humidity, compute_longwave_radiation, overwrite_defaults, SWANGrid, read_delft3d_grd, read_delft3d_dep, delft3d_mesh_mask
+import geometry
+from cache import FileCache
+from pipeline import Pipeline
+from diagnostics import Diagnostics
+from functions import logger, path_digest, docker_image_id, remove_old_docker_images, mitgcm_size_overlap, mitgcm_decomposition, optimise_mitgcm_decomposition, log_http_statistics, format_ascii_grid, ch1903_to_latlng, mirror_file, stage_static_files, upload_folder_zip, static_files, static_folders, resume_digests, utm_to_latlng, render_template, calculate_specific_humidity, compute_longwave_radiation
 
 
 class Delft3D(object):
@@ -23,6 +28,8 @@ class Delft3D(object):
         self.simulation_dir = ""
         self.restart_file = ""
         self.profile = "None"
+        self.templates = ["Simulation_Web.mdf"]
+        self.diagnostics = Diagnostics(enabled=params.get("figures", True))
         self.files = [
             {"filename": 'CloudCoverage.amc', "parameter": "CLCT", "quantity": "cloudiness", "unit": "%", "adjust": 0,
              "min": 0, "max": 100},
@@ -53,16 +60,25 @@ class Delft3D(object):
         self.log.info("Creating input files from {} to {}".format(params["start"], params["end"] - timedelta(seconds=1)))
 
     def process(self):
-        self.initialise_simulation_directory()
-        self.copy_static_data()
-        self.collect_restart_file()
-        self.load_properties()
-        self.update_control_file()
-        self.weather_data_files()
-        self.secchi_data_files()
-        self.river_data_files()
+        resume = self.params.get("resume", False)
+        self.initialise_simulation_directory(remove=not resume)
+        static_digest, restart_digest = resume_digests(self.params) if resume else (False, False)
+        stages = Pipeline(self, static_digest, resume=resume)
+        stages.add(self.copy_static_data, checkpoint=False)
+        stages.add(self.collect_restart_file, after=[self.copy_static_data], params=["start", "restart", "profile", "bucket"], inputs=[restart_digest], outputs=["restart_file", "profile"], checkpoint=False)
+        stages.add(self.load_properties, after=[self.copy_static_data], checkpoint=False)
+        stages.add(self.update_control_file, after=[self.collect_restart_file, self.load_properties], checkpoint=False)
+        stages.add(self.weather_data_files, after=[self.load_properties], params=["start", "end", "today", "api"])
+        stages.add(self.secchi_data_files, after=[self.load_properties], params=["start", "end"])
+        stages.add(self.river_data_files, after=[self.load_properties], params=["start", "end", "today", "api"])
+        try:
+            stages.execute()
+        finally:
+            self.diagnostics.close()
+        log_http_statistics(self.log)
         if self.params["upload"]:
-            self.upload_data()
+            stages.add(self.upload_data, after=[self.update_control_file, self.weather_data_files, self.secchi_data_files, self.river_data_files], params=["bucket", "static_dedup"])
+            stages.execute()
         if self.params["run"]:
             self.run_simulation()
         return self.simulation_dir
@@ -90,10 +106,8 @@ class Delft3D(object):
             self.log.begin_stage("Copying static data to simulation folder.")
             parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
             static = os.path.join(parent_dir, "static", self.params["model"])
-            shutil.copytree(static, self.simulation_dir, dirs_exist_ok=True)
-            for root, _, filenames in os.walk(static):
-                for file in filenames:
-                    self.log.info("Copied {} to simulation folder.".format(file), indent=1)
+            for file, mode in stage_static_files(static, self.simulation_dir, self.templates, link=self.params.get("link_static", True)):
+                self.log.info("{} {} to simulation folder.".format(mode.capitalize(), file), indent=1)
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -128,10 +142,10 @@ class Delft3D(object):
             bucket = "https://{}.s3.{}.amazonaws.com".format(self.params["bucket"], region)
             file = os.path.join(bucket, "simulations", components[0], "restart-files", components[1], self.restart_file)
             self.log.info("File location: {}".format(file), indent=2)
-            status_code = download_file(file, os.path.join(self.simulation_dir, self.restart_file))
+            status_code = mirror_file(file, os.path.join(self.simulation_dir, self.restart_file), cache=self.file_cache("restart"))
             if status_code == 200:
-                self.log.info("Successfully downloaded restart file.", indent=2)
-            elif status_code == 403:
+                self.log.info("Successfully collected restart file.", indent=2)
+            elif status_code in [403, 404]:
                 self.log.warning("Restart file doesn't exist on server.", indent=1)
                 if os.path.exists(os.path.join(self.simulation_dir, "profiles", "default.txt")):
                     self.log.warning("Using default restart profile", indent=1)
@@ -139,7 +153,7 @@ class Delft3D(object):
                 else:
                     raise ValueError("Not restart file and no default restart profile.")
             else:
-                raise ValueError("Unable to download restart file, please check your internet connection.")
+                raise ValueError("Unable to download restart file, HTTP status {}.".format(status_code))
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -193,7 +207,7 @@ class Delft3D(object):
             self.log.error()
             raise
 
-    def weather_data_files(self, buffer=10, no_data_value="-999.00"):
+    def weather_data_files(self, buffer=10, no_data_value="-999.00", parallel_n=8, processes=None):
         try:
             self.log.begin_stage("Creating weather data files.")
 
@@ -202,9 +216,8 @@ class Delft3D(object):
             if "system" not in grid:
                 raise ValueError("System must be defined.")
             minx, miny, maxx, maxy, system = grid["minx"], grid["miny"], grid["maxx"], grid["maxy"], grid["system"]
-            gx = np.arange(minx, maxx + grid["dx"], grid["dx"])
-            gy = np.arange(miny, maxy + grid["dy"], grid["dy"])
-            gxx, gyy = np.meshgrid(gx, gy)
+            meteo_grid, built = geometry.meteo_grid(grid, cache=self.file_cache("geometry"))
+            gx, gy, gxx, gyy = meteo_grid["gx"], meteo_grid["gy"], meteo_grid["gxx"], meteo_grid["gyy"]
 
             self.log.info("Define buffer region to fill grid", indent=1)
             minx = minx - buffer * grid["dx"]
@@ -245,21 +258,41 @@ class Delft3D(object):
             self.log.info("Writing weather data to simulation files.", indent=1)
             variables = [file["parameter"] for file in self.files]
             days = [self.params["start"]+timedelta(days=x) for x in range((min(self.params["today"], self.params["end"]) - self.params["start"]).days+1)]
-            for day in days:
-                self.log.info("Collecting data for {} from remote API.".format(day), indent=2)
-                if day >= datetime(2024, 7, 30):
-                    data = weather.download_meteolakes_icon_area(minx, miny, maxx, maxy, day, variables, self.params["api"], self.params["today"])
-                else:
-                    data = weather.download_meteolakes_cosmo_area(minx, miny, maxx, maxy, day, variables, self.params["api"], self.params["today"])
-                for file in self.files:
-                    self.log.info("Processing parameter " + file["parameter"], indent=3)
-                    weather.write_weather_data_to_file(data["time"], data["variables"][file["parameter"]]["data"], data["lat"], data["lng"], gxx, gyy, system, file, self.simulation_dir, no_data_value, warning=self.log.warning)
+            cache = self.file_cache("meteo")
+            weights_cache = self.file_cache("weights")
+            if processes is None:
+                processes = os.cpu_count() or 1
+            processes = max(1, min(processes, len(self.files)))
+            if processes == 1:
+                for day, data, seconds in weather.download_meteolakes_area_days(minx, miny, maxx, maxy, days, variables, self.params["api"], self.params["today"], cache=cache, parallel_n=parallel_n):
+                    self.log.info("Collected data for {} from remote API in {:.1f}s.".format(day, seconds), indent=2)
+                    for file in self.files:
+                        self.log.info("Processing parameter " + file["parameter"], indent=3)
+                        weather.write_weather_data_to_file(data["time"], data[file["parameter"]], data["lat"], data["lng"], gxx, gyy, system, file, self.simulation_dir, no_data_value, warning=self.log.warning, cache=weights_cache)
+            else:
+                weather_folder = os.path.join(self.simulation_dir, "weather")
+                for day, data, seconds in weather.download_meteolakes_area_days(minx, miny, maxx, maxy, days, variables, self.params["api"], self.params["today"], download=weather_folder, cache=cache, parallel_n=parallel_n):
+                    self.log.info("Collected data for {} from remote API in {:.1f}s.".format(day, seconds), indent=2)
+                self.log.info("Processing parameters {} with {} processes".format(", ".join(variables), processes), indent=2)
+                weather_files = sorted(glob.glob(os.path.join(weather_folder, "*.npz")))
+                with multiprocessing.get_context("forkserver").Pool(processes) as pool:
+                    warnings = pool.starmap(weather.write_weather_files_to_file, [(weather_files, gxx, gyy, system, file, self.simulation_dir, no_data_value, weights_cache) for file in self.files])
+                for file, file_warnings in zip(self.files, warnings):
+                    for warning in file_warnings:
+                        self.log.warning("{}: {}".format(file["parameter"], warning), indent=3)
+                shutil.rmtree(weather_folder)
 
             self.log.end_stage()
         except Exception as e:
             self.log.error()
             raise
 
+    def file_cache(self, name):
+        if "cache" in self.params and self.params["cache"]:
+            self.log.info("Using {} cache: {}".format(name, os.path.join(self.params["cache"], name)), indent=1)
+            return FileCache(os.path.join(self.params["cache"], name))
+        return False
+
     def secchi_data_files(self, no_data_value="-999.00"):
         try:
             self.log.begin_stage("Creating secchi data file.")
@@ -304,7 +337,7 @@ class Delft3D(object):
             self.log.error()
             raise
 
-    def river_data_files(self, pre_days=7, post_days=2):
+    def river_data_files(self, pre_days=7, post_days=2, parallel_n=8):
         try:
             self.log.begin_stage("Creating river data file.")
             if "rivers" not in self.properties:
@@ -325,7 +358,11 @@ class Delft3D(object):
                 self.properties = river.empty_arrays(self.properties, self.params["start"], self.params["end"])
 
                 self.log.info("Collecting river data from {} to {}".format(start, end), indent=1)
-                self.properties = river.download_bafu_hydrodata(self.properties, start, end, self.params["api"], self.params["today"], log=self.log)
+                store = False
+                if "cache" in self.params and self.params["cache"]:
+                    store = os.path.join(self.params["cache"], "hydrodata")
+                    self.log.info("Using hydrodata store: {}".format(store), indent=1)
+                self.properties = river.download_bafu_hydrodata(self.properties, start, end, self.params["api"], self.params["today"], log=self.log, store=store, parallel_n=parallel_n)
 
                 self.log.info("Cleaning, smoothing and resampling downloaded data.", indent=1)
                 self.properties = river.clean_smooth_resample(self.properties, start, end, log=self.log)
@@ -335,7 +372,7 @@ class Delft3D(object):
                     self.properties = river.forecast(self.properties, log=self.log)
 
                 self.log.info("Map station data to rivers and compute flow balance.", indent=1)
-                self.properties = river.flow_balance(self.properties, self.simulation_dir, log=self.log)
+                self.properties = river.flow_balance(self.properties, self.simulation_dir, log=self.log, diagnostics=self.diagnostics)
 
                 self.log.info("Write river data to files.", indent=1)
                 self.properties = river.write_river_data_to_file(self.properties, self.simulation_dir)
@@ -347,20 +384,19 @@ class Delft3D(object):
     def upload_data(self):
         try:
             self.log.begin_stage("Uploading simulation inputs to S3 bucket.")
-            self.log.info("Zipping simulation folder.", indent=1)
-            zipfile = self.simulation_dir + ".zip"
-            if os.path.isfile(zipfile):
-                self.log.info("Removing existing zip file.", indent=2)
-                os.remove(zipfile)
-            shutil.make_archive(self.simulation_dir, 'zip', self.simulation_dir)
-            self.log.info("Uploading file to bucket.", indent=1)
             upload_path = os.path.join("simulations",
                                        self.params["model"].split("/")[0],
                                        "simulation-files",
-                                       os.path.basename(zipfile))
-            upload_file(zipfile, self.params["bucket"], object_name=upload_path)
-            self.log.info("Removing zip file.", indent=1)
-            os.remove(zipfile)
+                                       os.path.basename(self.simulation_dir) + ".zip")
+            static, static_prefix = None, None
+            if self.params.get("static_dedup", False):
+                static = static_files(self.simulation_dir, static_folders(self.params["model"]))
+                static_prefix = "simulations/{}/static-files".format(self.params["model"].split("/")[0])
+                self.log.info("Referencing {} unchanged static files from {}".format(len(static), static_prefix), indent=1)
+            self.log.info("Streaming zipped simulation folder to {}".format(upload_path), indent=1)
+            uploaded = upload_folder_zip(self.simulation_dir, self.params["bucket"], upload_path, static=static, static_prefix=static_prefix)
+            if static:
+                self.log.info("Uploaded {} new static files.".format(uploaded), indent=2)
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -421,6 +457,7 @@ class MitGCM(object):
         self.initial_temperature = np.array([0])
         self.initial_salinity = np.array([0])
         self.default_salinity = 0.050
+        self.templates = ["run_config/*", "code/*", "entrypoint.sh"]
 
         if "log" in params and params["log"]:
             log_prefix = "{}_{}_{}".format(params["model"].replace("/", "_"), params["start"], params["end"])
@@ -434,16 +471,22 @@ class MitGCM(object):
         self.log.info("Creating input files from {} to {}".format(params["start"], params["end"] - timedelta(seconds=1)))
 
     def process(self):
-        self.initialise_simulation_directory()
-        self.copy_static_data()
-        self.load_properties()
-        self.load_grid()
-        self.collect_restart_file()
-        self.initial_conditions()
-        self.update_control_files()
-        self.weather_data_files()
+        resume = self.params.get("resume", False)
+        self.initialise_simulation_directory(remove=not resume)
+        static_digest, restart_digest = resume_digests(self.params) if resume else (False, False)
+        stages = Pipeline(self, static_digest, resume=resume)
+        stages.add(self.copy_static_data, checkpoint=False)
+        stages.add(self.load_properties, after=[self.copy_static_data], checkpoint=False)
+        stages.add(self.load_grid, after=[self.load_properties], checkpoint=False)
+        stages.add(self.collect_restart_file, after=[self.copy_static_data], params=["start", "restart", "profile", "bucket"], inputs=[restart_digest], outputs=["restart_id", "profile"], checkpoint=False)
+        stages.add(self.initial_conditions, after=[self.load_grid, self.collect_restart_file], checkpoint=False)
+        stages.add(self.update_control_files, after=[self.initial_conditions], params=["threads"], checkpoint=False)
+        stages.add(self.weather_data_files, after=[self.load_grid], params=["start", "end", "today", "api"])
+        stages.execute()
+        log_http_statistics(self.log)
         if self.params["upload"]:
-            self.upload_data()
+            stages.add(self.upload_data, after=[self.update_control_files, self.weather_data_files], params=["bucket", "static_dedup"])
+            stages.execute()
         if self.params["run"]:
             self.run_simulation()
         return self.simulation_dir
@@ -472,16 +515,12 @@ class MitGCM(object):
             parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
             self.log.info("Copying default files to simulation folder.", indent=1)
             default = os.path.join(parent_dir, "static", self.params["model"].split("/")[0], "default")
-            shutil.copytree(default, self.simulation_dir, dirs_exist_ok=True)
-            for root, _, filenames in os.walk(default):
-                for file in filenames:
-                    self.log.info("Copied {} to simulation folder.".format(file), indent=2)
+            for file, mode in stage_static_files(default, self.simulation_dir, self.templates, link=self.params.get("link_static", True)):
+                self.log.info("{} {} to simulation folder.".format(mode.capitalize(), file), indent=2)
             self.log.info("Copying model files to simulation folder.", indent=1)
             model = os.path.join(parent_dir, "static", self.params["model"])
-            shutil.copytree(model, self.simulation_dir, dirs_exist_ok=True)
-            for root, _, filenames in os.walk(model):
-                for file in filenames:
-                    self.log.info("Copied {} to simulation folder.".format(file), indent=2)
+            for file, mode in stage_static_files(model, self.simulation_dir, self.templates, link=self.params.get("link_static", True)):
+                self.log.info("{} {} to simulation folder.".format(mode.capitalize(), file), indent=2)
             os.makedirs(os.path.join(self.simulation_dir, "run"), exist_ok=True)
             self.log.end_stage()
         except Exception as e:
@@ -520,16 +559,17 @@ class MitGCM(object):
             bucket = "https://{}.s3.{}.amazonaws.com".format(self.params["bucket"], region)
             file = os.path.join(bucket, "simulations", components[0], "restart-files", components[1], restart_file)
             self.log.info("File location: {}".format(file), indent=2)
-            status_code1 = download_file(file, os.path.join(self.simulation_dir, "run", restart_file))
-            status_code2 = download_file(file.replace(".data", ".meta"), os.path.join(self.simulation_dir, "run", restart_file.replace(".data", ".meta")))
+            cache = self.file_cache("restart")
+            status_code1 = mirror_file(file, os.path.join(self.simulation_dir, "run", restart_file), cache=cache)
+            status_code2 = mirror_file(file.replace(".data", ".meta"), os.path.join(self.simulation_dir, "run", restart_file.replace(".data", ".meta")), cache=cache)
             if status_code1 == 200 and status_code2 == 200:
                 self.restart_id = self.params["start"].strftime("%Y%m%d")
-                self.log.info("Successfully downloaded restart files.", indent=2)
-            elif status_code1 == 403 or status_code2 == 403:
+                self.log.info("Successfully collected restart files.", indent=2)
+            elif status_code1 in [403, 404] or status_code2 in [403, 404]:
                 self.log.warning("Restart files doesn't exist on server.", indent=1)
                 self.log.warning("Using default 4 degree starting temperature", indent=1)
             else:
-                raise ValueError("Unable to download restart file, please check your internet connection.")
+                raise ValueError("Unable to download restart files, HTTP status {} and {}.".format(status_code1, status_code2))
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -550,7 +590,8 @@ class MitGCM(object):
 
     def load_grid(self):
         self.log.begin_stage("Loading grid.")
-        self.grid = get_mitgcm_grid(os.path.join(self.simulation_dir, "grid"))
+        self.grid, built = geometry.mitgcm_grid(os.path.join(self.simulation_dir, "grid"), cache=self.file_cache("geometry"))
+        self.log.info("{} grid bundle: {}x{} cells".format("Built" if built else "Loaded", self.grid.lat_grid.shape[1], self.grid.lat_grid.shape[0]), indent=1)
         self.log.end_stage()
 
     def initial_conditions(self):
@@ -580,89 +621,72 @@ class MitGCM(object):
             start_time_in_second_from_ref_date = (self.params["start"] - origin).total_seconds()
             end_time_in_second_from_ref_date = (self.params["end"] - origin).total_seconds()
 
+            overwrite = self.properties["overwrite"] if "overwrite" in self.properties else {}
+
             self.log.info("Editing run_config/data.cal", indent=1)
-            modify_arguments('!reference_date!', origin.strftime('%Y%m%d'), os.path.join(self.simulation_dir, 'run_config/data.cal'))
+            render_template(os.path.join(self.simulation_dir, 'run_config/data.cal'), {'!reference_date!': origin.strftime('%Y%m%d')})
 
             self.log.info("Editing run_config/data.exf", indent=1)
-            file_path = os.path.join(self.simulation_dir, 'run_config/data.exf')
-            modify_arguments('!start_date!', self.params["start"].strftime('%Y%m%d'), file_path)
-            if "overwrite" in self.properties and "data.exf" in self.properties["overwrite"]:
-                overwrite_defaults(self.properties["overwrite"]["data.exf"], file_path)
+            render_template(os.path.join(self.simulation_dir, 'run_config/data.exf'), {'!start_date!': self.params["start"].strftime('%Y%m%d')},
+                            overwrite=overwrite.get("data.exf"))
 
             self.log.info("Editing run_config/data", indent=1)
-            file_path = os.path.join(self.simulation_dir, 'run_config/data')
-            modify_arguments('!initial_temperature!', self.initial_temperature, file_path)
-            modify_arguments('!initial_salinity!', self.initial_salinity, file_path)
-            modify_arguments('!start_time!', start_time_in_second_from_ref_date, file_path)
-            modify_arguments('!end_time!', end_time_in_second_from_ref_date, file_path)
-            if self.restart_id:
-                modify_arguments('!pickup_number!', self.restart_id, file_path)
-            else:
-                modify_arguments('!pickup_number!', "", file_path)
-            modify_arguments('!grid_resolution!', self.grid.parameters["resolution"], file_path)
-            modify_arguments('!time_step!', self.properties["timestep"], file_path)
-            modify_arguments('!dz_grid!', self.grid.dz, file_path)
-            if "overwrite" in self.properties and "data" in self.properties["overwrite"]:
-                overwrite_defaults(self.properties["overwrite"]["data"], file_path)
+            render_template(os.path.join(self.simulation_dir, 'run_config/data'), {
+                '!initial_temperature!': self.initial_temperature,
+                '!initial_salinity!': self.initial_salinity,
+                '!start_time!': start_time_in_second_from_ref_date,
+                '!end_time!': end_time_in_second_from_ref_date,
+                '!pickup_number!': self.restart_id if self.restart_id else "",
+                '!grid_resolution!': self.grid.parameters["resolution"],
+                '!time_step!': self.properties["timestep"],
+                '!dz_grid!': self.grid.dz,
+            }, overwrite=overwrite.get("data"))
 
             threads = self.params["threads"]
             Nx = int(self.grid.parameters["Nx"])
             Ny = int(self.grid.parameters["Ny"])
+            exch2_path = os.path.join(self.simulation_dir, 'run_config/data.exch2')
+            exch2 = os.path.isfile(exch2_path)
+            if exch2:
+                with open(os.path.join(self.simulation_dir, "binary_data", "bathy.bin"), 'rb') as fid:
+                    bathy = np.reshape(np.fromfile(fid, dtype='>f8'), (Ny, Nx))
+            else:
+                bathy = np.full((Ny, Nx), -1.0)
+
+            size_file = os.path.join(self.simulation_dir, "code/SIZE.h")
+            overlap = mitgcm_size_overlap(size_file)
             nPxy = str(threads).split("_")
             if len(nPxy) > 1:
                 self.log.info("Using multiple threads.", indent=1)
-                nPx, nPy = int(nPxy[0]), int(nPxy[1])
-            elif int(nPxy[0]) > 1:
-                raise ValueError("For multiple threads you must specify nPx_nPy where Nx is factorable by nPx and Ny is factorable by nPy")
+                decomposition = mitgcm_decomposition(bathy, int(nPxy[0]), int(nPxy[1]), blank=exch2, overlap=overlap)
+            elif int(threads) > 1:
+                cores = int(threads)
+                self.log.info("Optimising the domain decomposition for {} cores, tiles of at least {}x{} cells.".format(cores, overlap[0], overlap[1]), indent=1)
+                decomposition = optimise_mitgcm_decomposition(bathy, cores, blank=exch2, overlap=overlap)
             else:
-                self.log.info("Single threaded, for multiple threads set the thread parameter to nPx_nPy", indent=1)
-                nPx, nPy = 1, 1
+                self.log.info("Single threaded, for multiple threads set the thread parameter to a core count, auto or nPx_nPy", indent=1)
+                decomposition = mitgcm_decomposition(bathy, 1, 1, blank=exch2, overlap=overlap)
+            nPx, nPy, sNx, sNy = decomposition["nPx"], decomposition["nPy"], decomposition["sNx"], decomposition["sNy"]
+            self.log.info("Decomposition {}x{} tiles of {}x{} cells, {} active, predicted wet cell imbalance {:.2f}".format(
+                nPx, nPy, sNx, sNy, decomposition["active"], decomposition["imbalance"]), indent=2)
 
-            if Nx % nPx != 0 or Ny % nPy != 0:
-                raise ValueError("Grid division must be an integer of number of cells.")
-            sNx = int(Nx / nPx)
-            sNy = int(Ny / nPy)
-
-            exch2_path = os.path.join(self.simulation_dir, 'run_config/data.exch2')
-            if os.path.isfile(exch2_path):
+            if exch2:
                 self.log.info("Editing run_config/data.exch2. Using exch2 to avoid computing empty grid regions", indent=1)
-
-                with open(os.path.join(self.simulation_dir, "binary_data", "bathy.bin"), 'rb') as fid:
-                    bathy = np.fromfile(fid, dtype='>f8')
-
-                bathy = np.reshape(bathy, (Ny, Nx))
-                core_number = np.zeros(bathy.shape)
-                mean_bathy = np.zeros(bathy.shape)
-                for i in range(nPx):
-                    for j in range(nPy):
-                        core_number[j * int(sNy): (j + 1) * int(sNy), i * int(sNx): (i + 1) * int(sNx)] = int(
-                            1 + i + j * int(nPx))
-                        mean_bathy[j * int(sNy): (j + 1) * int(sNy), i * int(sNx): (i + 1) * int(sNx)] = np.mean(
-                            bathy[j * int(sNy): (j + 1) * int(sNy), i * int(sNx): (i + 1) * int(sNx)])
-                land_cores = sorted(set(core_number[mean_bathy >= 2]))
-
-                nPx = (nPx * nPy) - len(land_cores)
+                land_cores = decomposition["blank"]
+                nPx = decomposition["active"]
                 nPy = 1
-                modify_arguments('!Nx!', Nx, exch2_path)
-                modify_arguments('!Ny!', Ny, exch2_path)
                 if len(land_cores) > 0:
-                    modify_arguments('!blank_list!', f'blankList(1:{len(land_cores)})=   {",".join(map(str, map(int, land_cores)))},', exch2_path)
+                    blank_list = f'blankList(1:{len(land_cores)})=   {",".join(map(str, land_cores))},'
                 else:
-                    modify_arguments('!blank_list!', "", exch2_path)
+                    blank_list = ""
+                render_template(exch2_path, {'!Nx!': Nx, '!Ny!': Ny, '!blank_list!': blank_list})
                 self.log.info("Ignoring {} chunks with no lake data, actually using {} cores".format(len(land_cores), nPx), indent=2)
             else:
                 self.log.info("exch2 files not available, computing entire grid.", indent=1)
 
             self.log.info("Editing code/SIZE.h", indent=1)
-            size_file = os.path.join(self.simulation_dir, "code/SIZE.h")
             Nr = np.count_nonzero(~np.isnan(self.grid.dz))
-            modify_arguments('!nPx!', nPx, size_file)
-            modify_arguments('!nPy!', nPy, size_file)
-            modify_arguments('!Nx!', Nx, size_file)
-            modify_arguments('!Ny!', Ny, size_file)
-            modify_arguments('!Nr!', Nr, size_file)
-            modify_arguments('!sNx!', sNx, size_file)
-            modify_arguments('!sNy!', sNy, size_file)
+            render_template(size_file, {'!nPx!': nPx, '!nPy!': nPy, '!Nx!': Nx, '!Ny!': Ny, '!Nr!': Nr, '!sNx!': sNx, '!sNy!': sNy})
 
             self.log.info("Editing code/swfrac.F", indent=1)
             if "secchi" not in self.properties or not isinstance(self.properties["secchi"], list):
@@ -674,18 +698,17 @@ class MitGCM(object):
                 secchi = secchi + ",\n     &                    {} _d 0".format(self.properties["secchi"][i])
             secchi = secchi + " /"
 
-            modify_arguments('!depths!', depths, swfrac_file)
-            modify_arguments('!secchi!', secchi, swfrac_file)
+            render_template(swfrac_file, {'!depths!': depths, '!secchi!': secchi})
 
             self.log.info("Editing entrypoint.sh", indent=1)
-            modify_arguments('!cores!', nPx * nPy, os.path.join(self.simulation_dir, "entrypoint.sh"))
+            render_template(os.path.join(self.simulation_dir, "entrypoint.sh"), {'!cores!': nPx * nPy})
 
             self.log.end_stage()
         except Exception as e:
             self.log.error()
             raise
 
-    def weather_data_files(self):
+    def weather_data_files(self, parallel_n=8):
         try:
             self.log.begin_stage("Creating weather data files.")
 
@@ -707,43 +730,26 @@ class MitGCM(object):
             self.log.info("Collecting weather data for region: [{}, {}] [{}, {}]".format(minx, miny, maxx, maxy), indent=1)
             variables = ['T_2M', 'U', 'V', 'GLOB', 'RELHUM_2M', 'PMSL', 'CLCT', 'PS']
             days = [self.params["start"]+timedelta(days=x) for x in range((min(self.params["today"], self.params["end"]) - self.params["start"]).days+1)]
-            for day in days:
-                self.log.info("Collecting data for {} from remote API.".format(day), indent=2)
-                if day >= datetime(2024, 7, 30):
-                    weather.download_meteolakes_icon_area(minx, miny, maxx, maxy, day, variables, self.params["api"], self.params["today"], download=os.path.join(self.simulation_dir, "weather"))
-                else:
-                    weather.download_meteolakes_cosmo_area(minx, miny, maxx, maxy, day, variables, self.params["api"], self.params["today"], download=os.path.join(self.simulation_dir, "weather"))
+            cache = self.file_cache("meteo")
+            weights_cache = self.file_cache("weights")
+            for day, data, seconds in weather.download_meteolakes_area_days(minx, miny, maxx, maxy, days, variables, self.params["api"], self.params["today"], download=os.path.join(self.simulation_dir, "weather"), cache=cache, parallel_n=parallel_n):
+                self.log.info("Collected data for {} from remote API in {:.1f}s.".format(day, seconds), indent=2)
 
             self.log.info("Writing weather data to simulation files.", indent=1)
             binary_folder = os.path.join(self.simulation_dir, "binary_data")
             weather_folder = os.path.join(self.simulation_dir, "weather")
             os.makedirs(binary_folder, exist_ok=True)
 
-            def process_variable(var_name, output_name, zero_nan_slice=False):
-                self.log.info(f'Interpolating {var_name} to grid...', indent=2)
-                data = weather.weather_files_to_grid(weather_folder, var_name, self.params["start"], self.params["end"], self.grid, 1, zero_nan_slice)
-                weather.write_binary(os.path.join(binary_folder, f'{output_name}.bin'), data, endian_type=endian_type)
-                return data
-
-            process_variable('U', 'u10')
-            process_variable('V', 'v10')
-            process_variable('GLOB', 'swdown', zero_nan_slice=True)
-
-            atemp = process_variable('T_2M', 'atemp')
-            apress = process_variable('PS', 'apressure')
-
-            self.log.info('Computing specific humidity (aqh)...', indent=2)
-            relhum = process_variable('RELHUM_2M', 'relhum')
-            aqh = calculate_specific_humidity(atemp, relhum, apress)
-            weather.write_binary(os.path.join(binary_folder, 'aqh.bin'), aqh, endian_type=endian_type)
-
-            self.log.info('Computing longwave radiation (lwdown)...', indent=2)
-            clct = process_variable('CLCT', 'clct')
             if "a_lw" in self.properties:
-                lwr = compute_longwave_radiation(atemp, relhum, clct, a=self.properties["a_lw"])
+                a_lw = self.properties["a_lw"]
             else:
-                lwr = compute_longwave_radiation(atemp, relhum, clct)
-            weather.write_binary(os.path.join(binary_folder, 'lwdown.bin'), lwr, endian_type=endian_type)
+                a_lw = 1.09
+            self.log.info('Interpolating U, V, GLOB, T_2M, PS, RELHUM_2M and CLCT to grid and computing specific humidity (aqh) and longwave radiation (lwdown)...', indent=2)
+            weather.stream_weather_files_to_binary(weather_folder, {'U': 'u10', 'V': 'v10', 'GLOB': 'swdown', 'T_2M': 'atemp', 'PS': 'apressure', 'RELHUM_2M': 'relhum', 'CLCT': 'clct'},
+                                                   self.params["start"], self.params["end"], self.grid, binary_folder, endian_type=endian_type, zero_nan_slice=['GLOB'],
+                                                   derived={'aqh': lambda grids: calculate_specific_humidity(grids['T_2M'], grids['RELHUM_2M'], grids['PS']),
+                                                            'lwdown': lambda grids: compute_longwave_radiation(grids['T_2M'], grids['RELHUM_2M'], grids['CLCT'], a=a_lw)},
+                                                   cache=weights_cache)
 
             shutil.rmtree(weather_folder)
             self.log.end_stage()
@@ -751,23 +757,28 @@ class MitGCM(object):
             self.log.error()
             raise
 
+    def file_cache(self, name):
+        if "cache" in self.params and self.params["cache"]:
+            self.log.info("Using {} cache: {}".format(name, os.path.join(self.params["cache"], name)), indent=1)
+            return FileCache(os.path.join(self.params["cache"], name))
+        return False
+
     def upload_data(self):
         try:
             self.log.begin_stage("Uploading simulation inputs to S3 bucket.")
-            self.log.info("Zipping simulation folder.", indent=1)
-            zipfile = self.simulation_dir + ".zip"
-            if os.path.isfile(zipfile):
-                self.log.info("Removing existing zip file.", indent=2)
-                os.remove(zipfile)
-            shutil.make_archive(self.simulation_dir, 'zip', self.simulation_dir)
-            self.log.info("Uploading file to bucket.", indent=1)
             upload_path = os.path.join("simulations",
                                        self.params["model"].split("/")[0],
                                        "simulation-files",
-                                       os.path.basename(zipfile))
-            upload_file(zipfile, self.params["bucket"], object_name=upload_path)
-            self.log.info("Removing zip file.", indent=1)
-            os.remove(zipfile)
+                                       os.path.basename(self.simulation_dir) + ".zip")
+            static, static_prefix = None, None
+            if self.params.get("static_dedup", False):
+                static = static_files(self.simulation_dir, static_folders(self.params["model"]))
+                static_prefix = "simulations/{}/static-files".format(self.params["model"].split("/")[0])
+                self.log.info("Referencing {} unchanged static files from {}".format(len(static), static_prefix), indent=1)
+            self.log.info("Streaming zipped simulation folder to {}".format(upload_path), indent=1)
+            uploaded = upload_folder_zip(self.simulation_dir, self.params["bucket"], upload_path, static=static, static_prefix=static_prefix)
+            if static:
+                self.log.info("Uploaded {} new static files.".format(uploaded), indent=2)
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -776,21 +787,28 @@ class MitGCM(object):
     def run_simulation(self):
         try:
             self.log.begin_stage("Running simulation.")
-            self.log.info("Building docker container.", indent=1)
-            docker = "{}_{}".format(self.docker, self.params["model"].split("/")[1])
-            process = subprocess.Popen(
-                ["docker", "build", "-t", docker, "."],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                cwd=self.simulation_dir,
-                bufsize=1
-            )
-            for line in process.stdout:
-                print(line, end='')
-            process.wait()
-            if process.returncode != 0:
-                raise RuntimeError("Docker build failed with exit code {}".format(process.returncode))
+            prefix = "{}_{}_".format(self.docker, self.params["model"].split("/")[1])
+            build_inputs = [os.path.join(self.simulation_dir, path) for path in ["Dockerfile", "entrypoint.sh", "code"]]
+            docker = prefix + path_digest(build_inputs, docker_image_id(self.docker) or self.docker)[:12]
+            if docker_image_id(docker):
+                self.log.info("Docker image {} is up to date, skipping build.".format(docker), indent=1)
+            else:
+                self.log.info("Building docker container {}.".format(docker), indent=1)
+                process = subprocess.Popen(
+                    ["docker", "build", "-t", docker, "."],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                    cwd=self.simulation_dir,
+                    bufsize=1
+                )
+                for line in process.stdout:
+                    print(line, end='')
+                process.wait()
+                if process.returncode != 0:
+                    raise RuntimeError("Docker build failed with exit code {}".format(process.returncode))
+                for image in remove_old_docker_images(prefix, [docker]):
+                    self.log.info("Removed old docker image {}.".format(image), indent=2)
 
             self.log.info("Running simulation as a subprocess.", indent=1)
             process = subprocess.Popen(["docker", "run",
@@ -829,7 +847,7 @@ class SWAN(object):
         self.grid = None
         self.restart_file = ""
         self.hotstart = False
-        self._grid_source_data = {}
+        self.templates = ["control.swn"]
 
         if "log" in params and params["log"]:
             log_prefix = "{}_{}_{}".format(params["model"].replace("/", "_"), params["start"], params["end"])
@@ -843,16 +861,22 @@ class SWAN(object):
         self.log.info("Creating input files from {} to {}".format(params["start"], params["end"] - timedelta(seconds=1)))
 
     def process(self):
-        self.initialise_simulation_directory()
-        self.copy_static_data()
-        self.load_properties()
-        self.collect_restart_file()
-        self.load_grid()
-        self.load_bathymetry()
-        self.weather_data_files()
-        self.update_control_file()
+        resume = self.params.get("resume", False)
+        self.initialise_simulation_directory(remove=not resume)
+        static_digest, restart_digest = resume_digests(self.params) if resume else (False, False)
+        stages = Pipeline(self, static_digest, resume=resume)
+        stages.add(self.copy_static_data, checkpoint=False)
+        stages.add(self.load_properties, after=[self.copy_static_data], checkpoint=False)
+        stages.add(self.collect_restart_file, after=[self.copy_static_data], params=["start", "restart", "bucket"], inputs=[restart_digest], outputs=["restart_file", "hotstart"], checkpoint=False)
+        stages.add(self.load_grid, after=[self.load_properties], checkpoint=False)
+        stages.add(self.load_bathymetry, after=[self.load_grid], checkpoint=False)
+        stages.add(self.weather_data_files, after=[self.load_grid], params=["start", "end", "today", "api"])
+        stages.add(self.update_control_file, after=[self.collect_restart_file, self.load_bathymetry], checkpoint=False)
+        stages.execute()
+        log_http_statistics(self.log)
         if self.params["upload"]:
-            self.upload_data()
+            stages.add(self.upload_data, after=[self.update_control_file, self.weather_data_files], params=["bucket", "static_dedup"])
+            stages.execute()
         if self.params["run"]:
             self.run_simulation()
         return self.simulation_dir
@@ -881,14 +905,12 @@ class SWAN(object):
             parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
             self.log.info("Copying default files to simulation folder.", indent=1)
             default = os.path.join(parent_dir, "static", self.params["model"].split("/")[0], "default")
-            files = copy_tree(default, self.simulation_dir)
-            for file in files:
-                self.log.info("Copied {} to simulation folder.".format(os.path.basename(file)), indent=2)
+            for file, mode in stage_static_files(default, self.simulation_dir, self.templates, link=self.params.get("link_static", True)):
+                self.log.info("{} {} to simulation folder.".format(mode.capitalize(), file), indent=2)
             self.log.info("Copying model files to simulation folder.", indent=1)
             model = os.path.join(parent_dir, "static", self.params["model"])
-            files = copy_tree(model, self.simulation_dir)
-            for file in files:
-                self.log.info("Copied {} to simulation folder.".format(os.path.basename(file)), indent=2)
+            for file, mode in stage_static_files(model, self.simulation_dir, self.templates, link=self.params.get("link_static", True)):
+                self.log.info("{} {} to simulation folder.".format(mode.capitalize(), file), indent=2)
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -936,14 +958,14 @@ class SWAN(object):
             bucket = "https://{}.s3.{}.amazonaws.com".format(self.params["bucket"], region)
             url = os.path.join(bucket, "simulations", components[0], "restart-files", components[1], self.restart_file)
             self.log.info("File location: {}".format(url), indent=2)
-            status_code = download_file(url, dst)
+            status_code = mirror_file(url, dst, cache=self.file_cache("restart"))
             if status_code == 200:
                 self.hotstart = True
-                self.log.info("Successfully downloaded hotstart file.", indent=2)
-            elif status_code == 403:
+                self.log.info("Successfully collected hotstart file.", indent=2)
+            elif status_code in [403, 404]:
                 self.log.warning("Hotstart file doesn't exist on server; cold start (INIT DEFAULT).", indent=1)
             else:
-                raise ValueError("Unable to download hotstart file, please check your internet connection.")
+                raise ValueError("Unable to download hotstart file, HTTP status {}.".format(status_code))
             self.log.end_stage()
         except Exception as e:
             self.log.error()
@@ -953,101 +975,26 @@ class SWAN(object):
         try:
             self.log.begin_stage("Loading SWAN grid.")
             grid_props = self.properties["grid"]
-            parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
-
-            if "source" in grid_props:
-                source = grid_props["source"]
-                source_type = source.split("/")[0]
-                lake = source.split("/")[1]
-                source_dir = os.path.join(parent_dir, "static", source)
-                if source_type == "delft3d-flow":
-                    self._load_grid_from_delft3d(source_dir, lake, grid_props)
-                elif source_type == "mitgcm":
-                    self._load_grid_from_mitgcm(source_dir, grid_props)
-                else:
-                    raise ValueError("Unknown grid source type: {}".format(source_type))
-            else:
+            if "source" not in grid_props:
                 raise ValueError("No grid source provided")
-
+            source_type, lake, source_dir = self.grid_source()
+            self.grid, metadata, built = geometry.swan_grid(source_type, source_dir, lake, grid_props, cache=self.file_cache("geometry"))
+            self.log.info("{} grid bundle from {}".format("Built" if built else "Loaded", grid_props["source"]), indent=1)
+            if "source_nodes" in metadata:
+                self.log.info("Curvilinear source: {}x{} nodes".format(*metadata["source_nodes"]), indent=2)
+                self.log.info("Regular grid: {}x{} cells at {}m resolution".format(self.grid.Nx, self.grid.Ny, int(self.grid.dx)), indent=2)
+            else:
+                self.log.info("Grid dimensions: {}x{} cells, {}m resolution".format(self.grid.Nx, self.grid.Ny, self.grid.dx), indent=2)
             self.log.info("Grid type: {}, system: {}".format(self.grid.grid_type, self.grid.system), indent=1)
             self.log.end_stage()
         except Exception as e:
             self.log.error()
             raise
 
-    def _load_grid_from_delft3d(self, source_dir, lake, grid_props):
-        grd_src = os.path.join(source_dir, "{}_grid.grd".format(lake))
-        X, Y, Mx, My = read_delft3d_grd(grd_src)
-        self.log.info("Curvilinear source: {}x{} nodes".format(Mx, My), indent=2)
-
-        self._grid_source_data = {"X": X, "Y": Y, "Mx": Mx, "My": My, "source_dir": source_dir, "lake": lake}
-
-        system = grid_props.get("system", "CH1903")
-        valid = (X != 0) | (Y != 0)
-        x_valid = X[valid]
-        y_valid = Y[valid]
-
-        resolution = float(grid_props.get("resolution", 500))
-        x0 = float(np.floor(x_valid.min() / resolution) * resolution)
-        y0 = float(np.floor(y_valid.min() / resolution) * resolution)
-        x1 = float(np.ceil(x_valid.max() / resolution) * resolution)
-        y1 = float(np.ceil(y_valid.max() / resolution) * resolution)
-        Nx = int(round((x1 - x0) / resolution))
-        Ny = int(round((y1 - y0) / resolution))
-        x_centres = x0 + resolution * (np.arange(Nx) + 0.5)
-        y_centres = y0 + resolution * (np.arange(Ny) + 0.5)
-        self.log.info("Regular grid: {}x{} cells at {}m resolution".format(Nx, Ny, int(resolution)), indent=2)
-
-        xx, yy = np.meshgrid(x_centres, y_centres)
-        if system == "CH1903":
-            lat_grid, lon_grid = ch1903_to_latlng(xx, yy)
-        elif system == "UTM":
-            zone_number = grid_props.get("zone_number", 32)
-            zone_letter = grid_props.get("zone_letter", "T")
-            lat_grid, lon_grid = utm_to_latlng(xx, yy, zone_number, zone_letter)
-        else:
-            raise ValueError("Coordinate system {} not supported for Delft3D source.".format(system))
-
-        g = SWANGrid()
-        g.grid_type = "regular"
-        g.x0 = x0
-        g.y0 = y0
-        g.dx = resolution
-        g.dy = resolution
-        g.Nx = Nx
-        g.Ny = Ny
-        g.rotation = 0.0
-        g.system = system
-        g.lat_grid = lat_grid
-        g.lon_grid = lon_grid
-        g.x = x_centres
-        g.y = y_centres
-        g.parameters = {"buffer": grid_props.get("buffer", 0.02)}
-        self.grid = g
-
-    def _load_grid_from_mitgcm(self, source_dir, grid_props):
-        mitgcm_grid = get_mitgcm_grid(os.path.join(source_dir, "grid"))
-        params = mitgcm_grid.parameters
-        res = float(params["resolution"])
-
-        g = SWANGrid()
-        g.grid_type = "regular"
-        g.Nx = int(params["Nx"])
-        g.Ny = int(params["Ny"])
-        g.dx = res
-        g.dy = res
-        g.rotation = float(params.get("rotation", 0.0))
-        g.system = grid_props.get("system", "UTM")
-        g.lat_grid = mitgcm_grid.lat_grid
-        g.lon_grid = mitgcm_grid.lon_grid
-        g.x = mitgcm_grid.x
-        g.y = mitgcm_grid.y
-        g.x0 = float(mitgcm_grid.x.min()) - res / 2.0
-        g.y0 = float(mitgcm_grid.y.min()) - res / 2.0
-        g.parameters = mitgcm_grid.parameters
-        self.log.info("Grid dimensions: {}x{} cells, {}m resolution".format(g.Nx, g.Ny, res), indent=2)
-        self.grid = g
-
+    def grid_source(self):
+        source = self.properties["grid"]["source"]
+        parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        return source.split("/")[0], source.split("/")[1], os.path.join(parent_dir, "static", source)
 
     def load_bathymetry(self):
         try:
@@ -1056,43 +1003,15 @@ class SWAN(object):
             if "source" not in grid_props:
                 raise ValueError("Inline bathymetry not supported; specify a 'source' in properties.json grid section.")
 
-            source = grid_props["source"]
-            source_type = source.split("/")[0]
-            lake = source.split("/")[1]
-            parent_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
-            source_dir = os.path.join(parent_dir, "static", source)
-
-            if source_type == "delft3d-flow":
-                from scipy.interpolate import griddata
-                X = self._grid_source_data["X"]
-                Y = self._grid_source_data["Y"]
-                Mx = self._grid_source_data["Mx"]
-                My = self._grid_source_data["My"]
-                dep_path = os.path.join(source_dir, "{}_depths.dep".format(lake))
-                self.log.info("Reading depths from {}".format(os.path.basename(dep_path)), indent=1)
-                bathy = read_delft3d_dep(dep_path, Mx, My)
-                valid = (X != 0) & ~np.isnan(bathy)
-                points = np.column_stack([X[valid], Y[valid]])
-                values = bathy[valid]
-                xx, yy = np.meshgrid(self.grid.x, self.grid.y)
-                inside = delft3d_mesh_mask(X, Y, xx, yy)
-                bathy_interp = griddata(points, values, (xx, yy), method='linear')
-                bathy_near = griddata(points, values, (xx, yy), method='nearest')
-                depth = np.where(np.isnan(bathy_interp), bathy_near, bathy_interp)
-                bathy_swan = np.where(inside, depth, -999.0)
-                self.log.info("Interpolated bathymetry onto {}x{} regular grid ({} lake cells)".format(
-                    self.grid.Ny, self.grid.Nx, int(inside.sum())), indent=1)
-            elif source_type == "mitgcm":
-                bathy_bin = os.path.join(source_dir, "grid", "bathy.bin")
-                self.log.info("Reading bathymetry from bathy.bin", indent=1)
-                raw = np.fromfile(bathy_bin, dtype=">f8")
-                bathy_raw = raw.reshape((self.grid.Ny, self.grid.Nx))
-                bathy_swan = np.where(bathy_raw >= 0, 0.0, -bathy_raw)
-            else:
-                raise ValueError("Unknown source type for bathymetry: {}".format(source_type))
+            source_type, lake, source_dir = self.grid_source()
+            bathymetry, built = geometry.swan_bathymetry(source_type, source_dir, lake, grid_props, self.grid, cache=self.file_cache("geometry"))
+            bathy_swan = bathymetry["bathymetry"]
+            self.log.info("{} bathymetry bundle on {}x{} regular grid ({} lake cells)".format(
+                "Built" if built else "Loaded", self.grid.Ny, self.grid.Nx, int(bathymetry["mask"].sum())), indent=1)
 
             out_path = os.path.join(self.simulation_dir, "bottom.bot")
-            np.savetxt(out_path, bathy_swan, fmt="%.3f")
+            with open(out_path, "w") as f:
+                f.write(format_ascii_grid(bathy_swan, fmt="%.3f"))
             self.log.info("Wrote bathymetry ({} rows x {} cols) to bottom.bot".format(
                 bathy_swan.shape[0], bathy_swan.shape[1]), indent=1)
             self.log.end_stage()
@@ -1100,7 +1019,7 @@ class SWAN(object):
             self.log.error()
             raise
 
-    def weather_data_files(self):
+    def weather_data_files(self, parallel_n=8):
         try:
             self.log.begin_stage("Creating weather data files.")
             buffer = self.grid.parameters["buffer"]
@@ -1117,23 +1036,19 @@ class SWAN(object):
             days = [self.params["start"] + timedelta(days=x)
                     for x in range((min(self.params["today"], self.params["end"]) - self.params["start"]).days + 1)]
 
-            for day in days:
-                self.log.info("Downloading weather for {}.".format(day.strftime("%Y%m%d")), indent=2)
-                if day >= datetime(2024, 7, 30):
-                    weather.download_meteolakes_icon_area(minlat, minlon, maxlat, maxlon, day, variables,
-                                                          self.params["api"], self.params["today"], download=weather_folder)
-                else:
-                    weather.download_meteolakes_cosmo_area(minlat, minlon, maxlat, maxlon, day, variables,
-                                                           self.params["api"], self.params["today"], download=weather_folder)
-
-            self.log.info("Interpolating U wind to SWAN grid.", indent=1)
-            u_data = weather.weather_files_to_grid(weather_folder, 'U', self.params["start"], self.params["end"], self.grid, 1, False)
+            cache = self.file_cache("meteo")
+            weights_cache = self.file_cache("weights")
+            for day, data, seconds in weather.download_meteolakes_area_days(minlat, minlon, maxlat, maxlon, days, variables,
+                                                                            self.params["api"], self.params["today"],
+                                                                            download=weather_folder, cache=cache,
+                                                                            parallel_n=parallel_n):
+                self.log.info("Downloaded weather for {} in {:.1f}s.".format(day.strftime("%Y%m%d"), seconds), indent=2)
 
-            self.log.info("Interpolating V wind to SWAN grid.", indent=1)
-            v_data = weather.weather_files_to_grid(weather_folder, 'V', self.params["start"], self.params["end"], self.grid, 1, False)
+            self.log.info("Interpolating U and V wind to SWAN grid.", indent=1)
+            wind = weather.weather_files_to_grid(weather_folder, ['U', 'V'], self.params["start"], self.params["end"], self.grid, cache=weights_cache)
 
             self.log.info("Writing vector wind field to wind.wnd.", indent=1)
-            weather.write_swan_wind(os.path.join(self.simulation_dir, "wind.wnd"), u_data, v_data)
+            weather.write_swan_wind(os.path.join(self.simulation_dir, "wind.wnd"), wind['U'], wind['V'])
 
             shutil.rmtree(weather_folder)
             self.log.end_stage()
@@ -1141,12 +1056,16 @@ class SWAN(object):
             self.log.error()
             raise
 
+    def file_cache(self, name):
+        if "cache" in self.params and self.params["cache"]:
+            self.log.info("Using {} cache: {}".format(name, os.path.join(self.params["cache"], name)), indent=1)
+            return FileCache(os.path.join(self.params["cache"], name))
+        return False
+
     def update_control_file(self):
         try:
             self.log.begin_stage("Updating SWAN control file.")
             template_path = os.path.join(self.simulation_dir, "control.swn")
-            with open(template_path, 'r') as f:
-                template = f.read()
 
             sp = self.properties["spectral"]
             ph = self.properties["physics"]
@@ -1220,11 +1139,7 @@ class SWAN(object):
                 "!output_dt!": str(int(op.get("frequency", ts))),
             }
 
-            for key, value in replacements.items():
-                template = template.replace(key, value)
-
-            with open(template_path, 'w') as f:
-                f.write(template)
+            render_template(template_path, replacements)
 
             self.log.info("Written control file for {} ({} grid).".format(lake_name, self.grid.grid_type), indent=1)
             self.log.end_stage()
@@ -1235,20 +1150,19 @@ class SWAN(object):
     def upload_data(self):
         try:
             self.log.begin_stage("Uploading simulation inputs to S3 bucket.")
-            self.log.info("Zipping simulation folder.", indent=1)
-            zipfile = self.simulation_dir + ".zip"
-            if os.path.isfile(zipfile):
-                self.log.info("Removing existing zip file.", indent=2)
-                os.remove(zipfile)
-            shutil.make_archive(self.simulation_dir, 'zip', self.simulation_dir)
-            self.log.info("Uploading file to bucket.", indent=1)
             upload_path = os.path.join("simulations",
                                        self.params["model"].split("/")[0],
                                        "simulation-files",
-                                       os.path.basename(zipfile))
-            upload_file(zipfile, self.params["bucket"], object_name=upload_path)
-            self.log.info("Removing zip file.", indent=1)
-            os.remove(zipfile)
+                                       os.path.basename(self.simulation_dir) + ".zip")
+            static, static_prefix = None, None
+            if self.params.get("static_dedup", False):
+                static = static_files(self.simulation_dir, static_folders(self.params["model"]))
+                static_prefix = "simulations/{}/static-files".format(self.params["model"].split("/")[0])
+                self.log.info("Referencing {} unchanged static files from {}".format(len(static), static_prefix), indent=1)
+            self.log.info("Streaming zipped simulation folder to {}".format(upload_path), indent=1)
+            uploaded = upload_folder_zip(self.simulation_dir, self.params["bucket"], upload_path, static=static, static_prefix=static_prefix)
+            if static:
+                self.log.info("Uploaded {} new static files.".format(uploaded), indent=2)
             self.log.end_stage()
         except Exception as e:
             self.log.error()
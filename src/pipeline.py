@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import uuid
+import threading
+from cache import cache_key
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+PIPELINE_VERSION = 3
+STAGES_FILE = ".stages.json"
+
+
+class Pipeline(object):
+    """
+    Runs the setup stages of a model as a dependency graph and checkpoints them in {simulation_dir}/.stages.json.
+
+    Stages are model methods added with the stages they depend on (after), they are started as soon as those have
+    completed so independent stages run concurrently on a pool of threads. Each stage records its wall time and a
+    key, the hash of the parameters and inputs it reads chained to the tokens of its dependencies, rooted in the
+    static model files. A checkpointed stage also records the model attributes it sets and a new token every time
+    it runs. With resume a checkpointed stage whose key is unchanged is skipped and its attributes restored, so
+    only failed or changed stages and the stages depending on them are rerun. Stages added with checkpoint=False
+    (loading state, rendering templates, collecting the restart file) are cheap and always run, their token is
+    derived from their key and outputs so a different outcome, e.g. a restart file that has since appeared, reruns
+    the stages depending on them. Stages that start process pools create them from a forkserver context, forking
+    a stage thread could copy locks (http, logging, stdout) held by the other stages into the children.
+    """
+
+    def __init__(self, model, root, resume=False, threads=4):
+        self.model = model
+        self.file = os.path.join(model.simulation_dir, STAGES_FILE)
+        self.root = cache_key("pipeline", PIPELINE_VERSION, model.docker, root)
+        self.resume = resume
+        self.threads = threads
+        self.stages = {}
+        self.tokens = {}
+        self.markers = {}
+        self.lock = threading.Lock()
+        if resume:
+            self.markers = self.load()
+
+    def load(self):
+        """Markers of a previous run, empty if there are none or they were written by another pipeline version."""
+        if not os.path.isfile(self.file):
+            return {}
+        try:
+            with open(self.file, "r") as f:
+                data = json.load(f)
+        except ValueError:
+            return {}
+        if not isinstance(data, dict) or data.get("version") != PIPELINE_VERSION or not isinstance(data.get("stages"), dict):
+            self.model.log.info("Ignoring stage markers from another pipeline version in {}".format(self.file), indent=1)
+            return {}
+        return data["stages"]
+
+    def add(self, stage, after=(), params=(), inputs=(), outputs=(), checkpoint=True):
+        after = [dependency.__name__ for dependency in after]
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError("Stage {} depends on {}, which has not been added.".format(stage.__name__, dependency))
+        self.stages[stage.__name__] = {"stage": stage, "after": after, "params": list(params), "inputs": list(inputs),
+                                       "outputs": list(outputs), "checkpoint": checkpoint}
+
+    def save(self):
+        with open(self.file + ".tmp", "w") as f:
+            json.dump({"version": PIPELINE_VERSION, "stages": self.markers}, f, indent=1)
+        os.replace(self.file + ".tmp", self.file)
+
+    def call(self, name):
+        stage = self.stages[name]
+        key = cache_key(self.root, name, [self.tokens[dependency] for dependency in stage["after"]],
+                        [self.model.params.get(p) for p in stage["params"]], stage["inputs"])
+        marker = self.markers.get(name, False)
+        if self.resume and stage["checkpoint"] and marker and marker["key"] == key:
+            self.model.log.begin_stage("Skipping {}, completed in a previous run with the same inputs.".format(name))
+            for attribute, value in marker["outputs"].items():
+                setattr(self.model, attribute, value)
+            self.tokens[name] = marker["token"]
+            self.model.log.end_stage()
+            return None
+        with self.lock:
+            self.markers.pop(name, None)
+            self.save()
+        start = time.time()
+        stage["stage"]()
+        seconds = time.time() - start
+        outputs = {attribute: getattr(self.model, attribute) for attribute in stage["outputs"]}
+        self.tokens[name] = uuid.uuid4().hex if stage["checkpoint"] else cache_key(key, outputs)
+        with self.lock:
+            self.markers[name] = {"key": key, "token": self.tokens[name], "seconds": round(seconds, 3), "outputs": outputs}
+            self.save()
+        return seconds
+
+    def execute(self):
+        """Run every added stage that has not run yet, raising the first error once the running stages have finished."""
+        pending = [name for name in self.stages if name not in self.tokens]
+        running = {}
+        errors = []
+        seconds = {}
+        start = time.time()
+        with ThreadPoolExecutor(self.threads) as executor:
+            while pending or running:
+                if not errors:
+                    for name in [n for n in pending if all(d in self.tokens for d in self.stages[n]["after"])]:
+                        pending.remove(name)
+                        running[executor.submit(self.call, name)] = name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        seconds[name] = future.result()
+                    except Exception as e:
+                        errors.append(e)
+        if errors:
+            raise errors[0]
+        self.model.log.info("Stage wall times ({:.1f}s elapsed): {}".format(
+            time.time() - start, ", ".join("{} {}".format(name, "skipped" if s is None else "{:.1f}s".format(s)) for name, s in seconds.items())))
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
+import fcntl
+import tempfile
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from functions import logger, download_data
+from diagnostics import Diagnostics, render_river_inputs
 
 
 def empty_arrays(parameters, start, end, no_data=0.0):
@@ -49,33 +54,155 @@ def download_bafu_hydrodata_measured(api, station_id, parameter, start_date, end
         return False
 
 
-def download_bafu_hydrodata(parameters, start, end, api, today, log=logger):
+def hydrodata_to_arrays(data):
+    """Convert a hydrodata JSON response to time (UTC datetime64) and float values, dropping invalid timestamps."""
+    time = pd.to_datetime(pd.Series(data["time"]), errors="coerce", utc=True)
+    values = pd.to_numeric(pd.Series(data["variable"]["data"]), errors="coerce").to_numpy(dtype=float)
+    valid = time.notna().to_numpy()
+    return np.array(time[valid].dt.tz_convert(None), dtype="datetime64[s]"), values[valid]
+
+
+def hydrodata_series_folder(store, station_id, parameter):
+    return os.path.join(store, str(station_id), parameter)
+
+
+@contextmanager
+def hydrodata_lock(folder):
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hydrodata_months(days):
+    months = {}
+    for day in days:
+        months.setdefault(day.strftime("%Y%m"), []).append(day)
+    return months
+
+
+def read_hydrodata_month(folder, month):
+    file = os.path.join(folder, "{}.npz".format(month))
+    if not os.path.isfile(file):
+        return {"time": np.array([], dtype="datetime64[s]"), "values": np.array([], dtype=float), "days": np.array([], dtype="datetime64[D]")}
+    with np.load(file) as f:
+        return {key: f[key] for key in ["time", "values", "days"]}
+
+
+def hydrodata_missing_days(folder, days):
+    """Days without a final (complete) copy in the station store."""
+    covered = set()
+    for month in hydrodata_months(days):
+        covered.update(read_hydrodata_month(folder, month)["days"].tolist())
+    return [day for day in days if day.date() not in covered]
+
+
+def store_hydrodata(folder, time, values, days, today):
+    """
+    Merge the data downloaded for days into the monthly files of a series, replacing what was stored for
+    those days. Only days that had ended a full day before today are marked final and never requested again.
+    """
+    final = today.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    with hydrodata_lock(folder):
+        for month, month_days in hydrodata_months(days).items():
+            fetched = np.array([day.strftime("%Y-%m-%d") for day in month_days], dtype="datetime64[D]")
+            old = read_hydrodata_month(folder, month)
+            keep = ~np.isin(old["time"].astype("datetime64[D]"), fetched)
+            new = np.isin(time.astype("datetime64[D]"), fetched)
+            t = np.concatenate((old["time"][keep], time[new]))
+            order = np.argsort(t, kind="stable")
+            covered = np.union1d(old["days"], np.array([day.strftime("%Y-%m-%d") for day in month_days if day < final], dtype="datetime64[D]"))
+            fd, temp = tempfile.mkstemp(dir=folder, suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, time=t[order], values=np.concatenate((old["values"][keep], values[new]))[order], days=covered)
+            os.replace(temp, os.path.join(folder, "{}.npz".format(month)))
+
+
+def read_hydrodata(folder, days):
+    time = []
+    values = []
+    for month, month_days in hydrodata_months(days).items():
+        data = read_hydrodata_month(folder, month)
+        select = np.isin(data["time"].astype("datetime64[D]"), np.array([day.strftime("%Y-%m-%d") for day in month_days], dtype="datetime64[D]"))
+        time.append(data["time"][select])
+        values.append(data["values"][select])
+    return np.concatenate(time), np.concatenate(values)
+
+
+def plan_hydrodata_requests(days):
+    """Group days into runs of consecutive days, one request each."""
+    requests = []
+    for day in days:
+        if requests and day - requests[-1][-1] == timedelta(days=1):
+            requests[-1].append(day)
+        else:
+            requests.append([day])
+    return requests
+
+
+def download_bafu_hydrodata(parameters, start, end, api, today, log=logger, store=False, parallel_n=8):
+    """
+    Collect measured station data from start to end. With a store (folder) the data is kept in a local
+    time series store partitioned by station, parameter and month, and only the days missing from it are
+    downloaded. Requests for all stations run concurrently on parallel_n threads.
+    """
     forecast = False
     if end.strftime("%Y%m%d") == today.strftime("%Y%m%d") or end > today:
         forecast = True
         end = today - timedelta(days=1)
 
+    days = [datetime(start.year, start.month, start.day) + timedelta(days=x) for x in range((end.date() - start.date()).days + 1)]
+    series = []
+    requests = []
     for station in parameters["stations"]:
         for parameter_type in ["flow", "temperature", "level"]:
             if parameter_type in station and station[parameter_type]["download"]:
-                log.info("Downloading {} from {} ({}) from {} to {}"
-                         .format(station[parameter_type]["parameter"],
-                                 station["name"],
-                                 station["id"],
-                                 start.strftime("%Y%m%d"),
-                                 end.strftime("%Y%m%d")),
-                         indent=2)
-                data = download_bafu_hydrodata_measured(api,
-                                                        station["id"],
-                                                        station[parameter_type]["parameter"],
-                                                        start.strftime("%Y%m%d"),
-                                                        end.strftime("%Y%m%d"), log)
-                if data:
-                    station[parameter_type]["data"] = data
+                folder = hydrodata_series_folder(store, station["id"], station[parameter_type]["parameter"]) if store else False
+                missing = hydrodata_missing_days(folder, days) if store else days
+                if store and len(missing) < len(days):
+                    log.info("{} of {} days of {} from {} ({}) in the station store"
+                             .format(len(days) - len(missing), len(days), station[parameter_type]["parameter"],
+                                     station["name"], station["id"]), indent=2)
+                series.append((station, parameter_type, folder))
+                requests = requests + [(station, parameter_type, folder, run) for run in plan_hydrodata_requests(missing)]
 
                 if forecast and "forecast" in station[parameter_type]:
                     log.warning("Forecast collection not yet implemented, data will be extrapolated.", indent=2)
 
+    def request(station, parameter_type, folder, run):
+        log.info("Downloading {} from {} ({}) from {} to {}"
+                 .format(station[parameter_type]["parameter"],
+                         station["name"],
+                         station["id"],
+                         run[0].strftime("%Y%m%d"),
+                         run[-1].strftime("%Y%m%d")),
+                 indent=2)
+        data = download_bafu_hydrodata_measured(api,
+                                                station["id"],
+                                                station[parameter_type]["parameter"],
+                                                run[0].strftime("%Y%m%d"),
+                                                run[-1].strftime("%Y%m%d"), log)
+        if data and folder:
+            time, values = hydrodata_to_arrays(data)
+            store_hydrodata(folder, time, values, run, today)
+        return data
+
+    with ThreadPoolExecutor(max(1, min(parallel_n, len(requests)))) as executor:
+        responses = list(executor.map(lambda r: request(*r), requests))
+
+    for station, parameter_type, folder in series:
+        if folder:
+            time, values = read_hydrodata(folder, days)
+            if len(time) > 0:
+                station[parameter_type]["data"] = {"time": time.astype("datetime64[ns]"), "variable": {"data": values}}
+        else:
+            data = next((d for (s, p, f, run), d in zip(requests, responses) if s is station and p == parameter_type), False)
+            if data:
+                station[parameter_type]["data"] = data
+
     return parameters
 
 
@@ -192,40 +319,50 @@ def forecast_fixed(df):
     return df
 
 
-def flow_balance(parameters, folder, log=logger, plot=False):
+def flow_balance(parameters, folder, log=logger, plot=False, diagnostics=False):
     if parameters["river_balance_method"] == "outflow_from_total_inflow":
-        parameters = outflow_from_total_inflow(parameters, folder, log, plot)
+        parameters = outflow_from_total_inflow(parameters, folder, log, plot, diagnostics)
     else:
         raise ValueError("Unrecognised flow balance method: {}".format(parameters["river_balance_method"]))
     return parameters
 
 
-def outflow_from_total_inflow(parameters, folder, log, plot):
+def station_arrays(parameters, time, parameter_types=["flow", "temperature"]):
+    """
+    Align the cleaned station series on time in one (time, station, parameter) array, NaN where a station
+    has no value. Returns the station index (id -> column), the array and a (station, parameter) mask of
+    the series that have data.
+    """
+    index = {station["id"]: i for i, station in enumerate(parameters["stations"])}
+    values = np.full((len(time), len(index), len(parameter_types)), np.nan)
+    available = np.zeros((len(index), len(parameter_types)), dtype=bool)
+    target = pd.DatetimeIndex(time)
+    for station in parameters["stations"]:
+        for j, parameter_type in enumerate(parameter_types):
+            if parameter_type in station and "data" in station[parameter_type]:
+                df = station[parameter_type]["data"]
+                position = pd.DatetimeIndex(df["ds"]).get_indexer(target)
+                found = position >= 0
+                values[found, index[station["id"]], j] = np.asarray(df["y"], dtype=float)[position[found]]
+                available[index[station["id"]], j] = True
+    return index, values, available
+
+
+def outflow_from_total_inflow(parameters, folder, log, plot, diagnostics=False):
     log.info("Calculate outflow based on total inflows and set emtpy inflows to 0.", indent=2)
     time = parameters["rivers"][0]["data"]["time"]
+    index, values, available = station_arrays(parameters, time)
     outflow = np.zeros(len(time))
     for river in parameters["rivers"]:
         if len(river["stations"]) == 0:
             continue
-        flow = np.zeros(len(time))
-        temperature = []
-        for station in river["stations"]:
-            station_data = next(item for item in parameters["stations"] if item["id"] == station["id"])
-            if "flow" in station_data and "data" in station_data["flow"]:
-                df = pd.DataFrame(time.copy())
-                df.columns = ["ds"]
-                df = df.merge(station_data["flow"]["data"], on='ds', how='left')
-                f = np.array(df["y"])
-                flow[~np.isnan(f)] = flow[~np.isnan(f)] + (f[~np.isnan(f)] * station["factor"])
-            if "temperature" in station_data and "data" in station_data["temperature"]:
-                df = pd.DataFrame(time.copy())
-                df.columns = ["ds"]
-                df = df.merge(station_data["temperature"]["data"], on='ds', how='left')
-                temperature.append(np.array(df["y"]))
-        temperature = np.array(temperature)
+        columns = np.array([index[station["id"]] for station in river["stations"]])
+        factors = np.array([station["factor"] for station in river["stations"]], dtype=float)
+        flow = np.nansum(values[:, columns, 0] * factors, axis=1)
         out_temperature = np.array(river["data"]["temperature"])
-        if len(temperature) != 0:
-            temperature = np.nanmean(temperature, axis=0)
+        columns = columns[available[columns, 1]]
+        if len(columns) != 0:
+            temperature = np.nanmean(values[:, columns, 1], axis=1)
             out_temperature[~np.isnan(temperature)] = temperature[~np.isnan(temperature)]
         river["data"]["temperature"] = out_temperature
         river["data"]["flow"] = flow
@@ -235,18 +372,14 @@ def outflow_from_total_inflow(parameters, folder, log, plot):
             river["data"]["flow"] = outflow
 
     log.info("Generating plot of river inputs and outputs.", indent=2)
-    fig, (ax1, ax2) = plt.subplots(1, 2)
-    fig.suptitle('Model river inputs.')
-    ax1.title.set_text('Flow (m3/s)')
-    ax2.title.set_text('Temperature (°C)')
-    for river in parameters["rivers"]:
-        ax1.plot(river["data"]["time"], river["data"]["flow"], label="{} ({})".format(river["name"], river["type"]))
-        ax2.plot(river["data"]["time"], river["data"]["temperature"], label="{} ({})".format(river["name"], river["type"]))
-    plt.legend()
-    fig.set_size_inches(18.5, 10.5)
-    plt.savefig(os.path.join(folder, "river_inputs.png"))
+    diagnostics = diagnostics or Diagnostics(processes=0)
+    rivers = [{"name": river["name"], "type": river["type"], "time": np.asarray(river["data"]["time"]),
+               "flow": np.asarray(river["data"]["flow"]), "temperature": np.asarray(river["data"]["temperature"])}
+              for river in parameters["rivers"]]
     if plot:
-        plt.show()
+        render_river_inputs(os.path.join(folder, "river_inputs.png"), rivers, show=True)
+    else:
+        diagnostics.figure(render_river_inputs, os.path.join(folder, "river_inputs.png"), rivers)
     return parameters
 
 
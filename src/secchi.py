@@ -1,52 +1,40 @@
 import pytz
 import numpy as np
 from datetime import datetime, timedelta
+from functions import format_ascii_grid
 
 
 def write_fixed_secchi_to_file(file, value, scaling_factor, start, end, cols, rows, origin=datetime(2008, 3, 1, tzinfo=pytz.utc)):
-    grid = np.ones((rows, cols))
-    grid[:] = value * scaling_factor
+    grid = format_ascii_grid(np.full((rows, cols), value * scaling_factor), fmt='%.2f')
     start_diff = (start.replace(tzinfo=pytz.UTC) - origin).total_seconds() / 3600
     end_diff = ((end.replace(tzinfo=pytz.UTC) - origin) + timedelta(days=1)).total_seconds() / 3600
+    out = []
+    for diff in [start_diff, end_diff]:
+        out.append("TIME = " + str(diff) + "0 hours since " + origin.strftime("%Y-%m-%d %H:%M:%S") + " +00:00\n")
+        out.append(grid)
     with open(file, "a") as f:
-        time_str = "TIME = " + str(start_diff) + "0 hours since " + origin.strftime(
-            "%Y-%m-%d %H:%M:%S") + " +00:00"
-        f.write(time_str)
-        f.write("\n")
-        np.savetxt(f, grid, fmt='%.2f')
-
-        time_str = "TIME = " + str(end_diff) + "0 hours since " + origin.strftime(
-            "%Y-%m-%d %H:%M:%S") + " +00:00"
-        f.write(time_str)
-        f.write("\n")
-        np.savetxt(f, grid, fmt='%.2f')
+        f.write("".join(out))
 
 
 def write_monthly_secchi_to_file(file, values, scaling_factor, start, end, cols, rows, origin=datetime(2008, 3, 1, tzinfo=pytz.utc)):
-    grid = np.ones((rows, cols))
     days = int((end - start).total_seconds() / (3600 * 24))
     start_diff = (start.replace(tzinfo=pytz.UTC) - origin).total_seconds() / 3600
     end_diff = ((end.replace(tzinfo=pytz.UTC) - origin) + timedelta(days=1)).total_seconds() / 3600
 
+    # Grids are constant within a month, so each month is only formatted once
+    grids = {}
+
+    def monthly_grid(month):
+        if month not in grids:
+            grids[month] = format_ascii_grid(np.full((rows, cols), values[month - 1] * scaling_factor), fmt='%.2f')
+        return grids[month]
+
+    timesteps = [(start_diff, start.month)]
+    timesteps += [(start_diff + i * 24, (start + timedelta(days=i)).month) for i in range(1, days + 1)]
+    timesteps.append((end_diff, end.month))
+    out = []
+    for diff, month in timesteps:
+        out.append("TIME = " + str(diff) + "0 hours since " + origin.strftime("%Y-%m-%d %H:%M:%S") + " +00:00\n")
+        out.append(monthly_grid(month))
     with open(file, "a") as f:
-        time_str = "TIME = " + str(start_diff) + "0 hours since " + origin.strftime(
-            "%Y-%m-%d %H:%M:%S") + " +00:00"
-        f.write(time_str)
-        f.write("\n")
-        grid[:] = values[start.month - 1] * scaling_factor
-        np.savetxt(f, grid, fmt='%.2f')
-
-        for i in range(1, days + 1):
-            time_str = "TIME = " + str(start_diff + i * 24) + "0 hours since " + origin.strftime(
-                "%Y-%m-%d %H:%M:%S") + " +00:00"
-            f.write(time_str)
-            f.write("\n")
-            grid[:] = values[(start + timedelta(days=i)).month - 1] * scaling_factor
-            np.savetxt(f, grid, fmt='%.2f')
-
-        time_str = "TIME = " + str(end_diff) + "0 hours since " + origin.strftime(
-            "%Y-%m-%d %H:%M:%S") + " +00:00"
-        f.write(time_str)
-        f.write("\n")
-        grid[:] = values[end.month - 1] * scaling_factor
-        np.savetxt(f, grid, fmt='%.2f')
+        f.write("".join(out))
@@ -1,18 +1,133 @@
 # -*- coding: utf-8 -*-
 import os
 import glob as glob
-import json
 import pytz
+import shutil
+import hashlib
 import numpy as np
 import pandas as pd
 import xarray as xr
-from multiprocessing import Pool
-from scipy.interpolate import griddata
+from time import perf_counter
+from collections import deque
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csr_matrix
+from scipy.spatial import Delaunay, cKDTree
 from datetime import datetime, timedelta
-from functions import latlng_to_ch1903, latlng_to_utm, download_data
+from functions import latlng_to_ch1903, latlng_to_utm, download_data, load_npz, format_ascii_grid
+from cache import cache_key
 
+ICON_START = datetime(2024, 7, 30)
+FORECAST_TTL = 3600
+interpolation_weights_memo = {}
+meteo_transform_memo = {}
 
-def write_weather_data_to_file(time, var, lat, lng, gxx, gyy, system, properties, folder, no_data_value, origin=datetime(2008, 3, 1, tzinfo=pytz.utc), method='linear', warning=print):
+
+class InterpolationWeights(object):
+    """
+    Interpolation from scattered source points to fixed target points, precomputed as a sparse
+    (targets x sources) matrix so that a whole (time, sources) block is interpolated in one product.
+
+    Results are bit identical to scipy.interpolate.griddata: for linear, each row holds the barycentric
+    weights of the enclosing Delaunay simplex in vertex order (zero weights are kept so NaNs propagate the
+    same way) and targets outside the convex hull are NaN. For nearest, each row selects the closest source.
+    """
+
+    def __init__(self, method, shape, data, indices, indptr, mask):
+        self.method = method
+        self.shape = tuple(int(n) for n in shape)
+        self.mask = np.asarray(mask, dtype=bool)
+        self.matrix = csr_matrix((np.asarray(data), np.asarray(indices), np.asarray(indptr)), shape=(self.mask.size, self.sources))
+
+    @classmethod
+    def build(cls, points, xi, method="linear"):
+        points = np.ascontiguousarray(np.column_stack([np.asarray(p, dtype=float).flatten() for p in points]))
+        shape = np.asarray(xi[0]).shape
+        xi = np.column_stack([np.broadcast_to(np.asarray(x, dtype=float), shape).flatten() for x in xi])
+        if method == "linear":
+            tri = Delaunay(points)
+            simplex = tri.find_simplex(xi)
+            mask = simplex == -1
+            inside = ~mask
+            transform = tri.transform[simplex[inside]]
+            delta = xi[inside] - transform[:, 2, :]
+            c0 = transform[:, 0, 0] * delta[:, 0] + transform[:, 0, 1] * delta[:, 1]
+            c1 = transform[:, 1, 0] * delta[:, 0] + transform[:, 1, 1] * delta[:, 1]
+            c2 = 1.0 - c0 - c1
+            data = np.column_stack((c0, c1, c2)).flatten()
+            indices = tri.simplices[simplex[inside]].flatten()
+            counts = np.where(inside, 3, 0)
+        elif method == "nearest":
+            dist, index = cKDTree(points).query(xi)
+            mask = ~np.isfinite(dist)
+            data = np.ones(np.sum(~mask))
+            indices = index[~mask]
+            counts = np.where(mask, 0, 1)
+        else:
+            raise ValueError("Interpolation method {} not implemented.".format(method))
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return cls(method, (len(points),) + shape, data, indices, indptr, mask)
+
+    @property
+    def sources(self):
+        return self.shape[0]
+
+    def apply(self, values):
+        """Interpolate values (time, sources) or (sources,) to (time,) + target shape"""
+        values = np.asarray(values, dtype=float)
+        block = values.reshape(-1, self.sources)
+        if self.method == "nearest":
+            out = np.full((block.shape[0], self.mask.size), np.nan)
+            out[:, ~self.mask] = block[:, self.matrix.indices]
+        else:
+            out = self.matrix.dot(np.ascontiguousarray(block.T)).T
+            out[:, self.mask] = np.nan
+        return out.reshape(values.shape[:-1] + self.shape[1:])
+
+    def save(self, file):
+        with open(file, "wb") as f:
+            np.savez(f, method=np.array(self.method), shape=np.array(self.shape), data=self.matrix.data,
+                     indices=self.matrix.indices, indptr=self.matrix.indptr, mask=self.mask)
+
+    @classmethod
+    def load(cls, file):
+        arrays = load_npz(file)
+        return cls(str(arrays["method"]), arrays["shape"], arrays["data"], arrays["indices"], arrays["indptr"], arrays["mask"])
+
+
+def array_digest(*arrays):
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        digest.update(str(array.shape).encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def interpolation_weights(points, xi, method="linear", cache=False):
+    """
+    Weights for griddata(points, values, xi, method), reused within the process and, if a FileCache is
+    given, across runs.
+    """
+    key = cache_key("weights", method, array_digest(*points), array_digest(*xi))
+    if key in interpolation_weights_memo:
+        return interpolation_weights_memo[key]
+    path = cache.get(key) if cache else False
+    if path:
+        weights = InterpolationWeights.load(path)
+    else:
+        weights = InterpolationWeights.build(points, xi, method=method)
+        if cache:
+            temp = cache.temporary_file()
+            weights.save(temp)
+            cache.put(key, temp, move=True)
+    if len(interpolation_weights_memo) > 16:
+        interpolation_weights_memo.clear()
+    interpolation_weights_memo[key] = weights
+    return weights
+
+
+def write_weather_data_to_file(time, var, lat, lng, gxx, gyy, system, properties, folder, no_data_value, origin=datetime(2008, 3, 1, tzinfo=pytz.utc), method='linear', warning=print, cache=False):
     var = np.array(var)
     var = np.array(pd.to_numeric(var.flatten(), errors='coerce'), dtype=float).reshape(var.shape)
     var = var + properties["adjust"]
@@ -25,143 +140,463 @@ def write_weather_data_to_file(time, var, lat, lng, gxx, gyy, system, properties
         warning("{} values detected above allowable max of {}{}, setting values to max."
                 .format(properties["parameter"], properties["min"], properties["unit"]))
     time = np.array(pd.to_datetime(time, utc=True).tz_convert(None), dtype="datetime64")
-    lat = np.array(lat)
-    lng = np.array(lng)
-    if system == "WGS84":
-        mx, my = latlng_to_ch1903(lat, lng)
-    elif system == "CH1903":
-        mx, my = latlng_to_ch1903(lat, lng)
-    elif system == "UTM":
-        mx, my, zone_number, zone_letter = latlng_to_utm(lat, lng)
-    else:
-        raise ValueError("{} not implemented as a coordinate system.".format(system))
-    mxx, myy = mx.flatten(), my.flatten()
-    if np.nanmax(gxx) > np.nanmax(mxx) or np.nanmax(gyy) > np.nanmax(myy) or np.nanmin(gxx) < np.nanmin(mxx) or np.nanmin(gyy) < np.nanmin(myy):
+    transform = meteo_transform(lat, lng, system, gxx, gyy, warning=warning)
+    if transform["exceeds"]:
         method = 'nearest'
-        warning("Lake grid area exceeds model weather area")
+    weights = interpolation_weights((transform["x"], transform["y"]), (gxx, gyy), method=method, cache=cache)
+    grid_interp = weights.apply(var.reshape(len(time), -1))
+    grid_interp[np.isnan(grid_interp)] = no_data_value
+    headers = []
+    for i in range(len(time)):
+        diff = datetime.fromtimestamp(int((time[i].astype('datetime64[s]') - np.datetime64('1970-01-01T00:00:00', 's')) / np.timedelta64(1, 's')), pytz.utc) - origin
+        hours = diff.total_seconds() / 3600
+        headers.append("TIME = " + str(hours) + "0 hours since " + origin.strftime("%Y-%m-%d %H:%M:%S") + " +00:00\n")
+        v = var[i].flatten()
+        if len(v[~np.isnan(v)]) == 0:
+            warning("Zero valid points, timestep will be no_data values only.")
     with open(os.path.join(folder, properties["filename"]), "a") as f:
-        for i in range(len(time)):
-            diff = datetime.fromtimestamp(int((time[i].astype('datetime64[s]') - np.datetime64('1970-01-01T00:00:00', 's')) / np.timedelta64(1, 's')), pytz.utc) - origin
-            hours = diff.total_seconds() / 3600
-            time_str = "TIME = " + str(hours) + "0 hours since " + origin.strftime(
-                "%Y-%m-%d %H:%M:%S") + " +00:00"
-            f.write(time_str)
-            v = var[i].flatten()
-            if len(v[~np.isnan(v)]) == 0:
-                warning("Zero valid points, timestep will be no_data values only.")
-            grid_interp = griddata((mxx, myy), v, (gxx, gyy), method=method)
-            grid_interp[np.isnan(grid_interp)] = no_data_value
-            f.write("\n")
-            np.savetxt(f, np.flip(grid_interp, 0), fmt='%.2f')
-
-
-def download_meteolakes_cosmo_area(minx, miny, maxx, maxy, day, variables, api, today, download=False):
-    download_file = False
-    if download:
-        os.makedirs(download, exist_ok=True)
-        download_file = os.path.join(download, "{}_{}.json".format(day.strftime("%Y%m%d"), day.strftime("%Y%m%d")))
-    if day.strftime("%Y%m%d") != today.strftime("%Y%m%d"):
-        # /meteoswiss/cosmo/area/reanalysis/{model}/{start_date}/{end_date}/{ll_lat}/{ll_lng}/{ur_lat}/{ur_lng}
-        query = "{}/meteoswiss/cosmo/area/reanalysis/VNXQ34/{}/{}/{}/{}/{}/{}?{}"
-        query = query.format(api, day.strftime("%Y%m%d"), day.strftime("%Y%m%d"), minx, miny, maxx, maxy,
-                             "&".join(["variables=" + item for item in variables]))
-        data = download_data(query, download=download_file)
-        if data == False:
-            raise ValueError("Unable to download data.")
-    else:
-        # /meteoswiss/cosmo/area/forecast/{model}/{date}/{ll_lat}/{ll_lng}/{ur_lat}/{ur_lng}
-        query = "{}/meteoswiss/cosmo/area/forecast/VNXZ32/{}/{}/{}/{}/{}?{}"
-        query = query.format(api, day.strftime("%Y%m%d"), minx, miny, maxx, maxy,
-                             "&".join(["variables=" + item for item in variables]))
-        data = download_data(query, download=download_file)
-        if data:
-            for key in list(data.keys()):
-                if "_MEAN" in key:
-                    data[key.replace("_MEAN", "")] = data.pop(key)
+        f.write(format_ascii_grid(np.flip(grid_interp, 1), fmt='%.2f', headers=headers))
+
+
+def meteo_transform(lat, lng, system, gxx, gyy, warning=print):
+    """
+    Meteo points projected to the lake grid coordinate system, flattened, and whether the lake grid exceeds
+    the area they cover. Computed once per source grid, system and lake grid, the warning is only raised then.
+    """
+    lat = np.asarray(lat)
+    lng = np.asarray(lng)
+    key = (array_digest(lat, lng), system, array_digest(gxx, gyy))
+    if key not in meteo_transform_memo:
+        if system == "WGS84":
+            mx, my = latlng_to_ch1903(lat, lng)
+        elif system == "CH1903":
+            mx, my = latlng_to_ch1903(lat, lng)
+        elif system == "UTM":
+            mx, my, zone_number, zone_letter = latlng_to_utm(lat, lng)
         else:
-            raise ValueError("Unable to download data.")
-    return data
+            raise ValueError("{} not implemented as a coordinate system.".format(system))
+        mxx, myy = mx.flatten(), my.flatten()
+        exceeds = bool(np.nanmax(gxx) > np.nanmax(mxx) or np.nanmax(gyy) > np.nanmax(myy) or np.nanmin(gxx) < np.nanmin(mxx) or np.nanmin(gyy) < np.nanmin(myy))
+        if exceeds:
+            warning("Lake grid area exceeds model weather area")
+        if len(meteo_transform_memo) > 16:
+            meteo_transform_memo.clear()
+        meteo_transform_memo[key] = {"x": mxx, "y": myy, "exceeds": exceeds}
+    return meteo_transform_memo[key]
+
+
+def write_weather_files_to_file(files, gxx, gyy, system, properties, folder, no_data_value, cache=False):
+    """
+    Append the parameter of one Delft3D meteo file from each daily weather file in turn, so one process can
+    own one output file. Returns the warnings instead of logging them.
+    """
+    warnings = []
+    for file in files:
+        data = read_meteolakes_file(file)
+        write_weather_data_to_file(data["time"], data[properties["parameter"]], data["lat"], data["lng"], gxx, gyy, system,
+                                   properties, folder, no_data_value, warning=warnings.append, cache=cache)
+    return warnings
+
+
+METEOLAKES_MODELS = {"cosmo": {"reanalysis": "VNXQ34", "forecast": "VNXZ32"},
+                     "icon": {"reanalysis": "kenda-ch1", "forecast": "icon-ch2-eps"}}
+
+
+def meteolakes_source(day):
+    if day >= ICON_START:
+        return "icon"
+    else:
+        return "cosmo"
+
+
+def meteolakes_day_key(source, minx, miny, maxx, maxy, day, variables, today):
+    forecast = day.strftime("%Y%m%d") == today.strftime("%Y%m%d")
+    model = METEOLAKES_MODELS[source]["forecast" if forecast else "reanalysis"]
+    return cache_key(source, model, day.strftime("%Y%m%d"), [minx, miny, maxx, maxy], sorted(variables), "npz")
 
 
-def download_meteolakes_icon_area(minx, miny, maxx, maxy, day, variables, api, today, download=False):
-    download_file = False
+def meteolakes_download_file(download, day):
     if download:
         os.makedirs(download, exist_ok=True)
-        download_file = os.path.join(download, "{}_{}.json".format(day.strftime("%Y%m%d"), day.strftime("%Y%m%d")))
+        return os.path.join(download, "{}_{}.npz".format(day.strftime("%Y%m%d"), day.strftime("%Y%m%d")))
+    return False
+
+
+def meteolakes_to_arrays(data):
+    """
+    Convert a meteolakes JSON response to arrays: time (UTC datetime64), lat and lng plus one float32
+    array (time, y, x) per variable. Missing values become NaN.
+    """
+    arrays = {"time": np.array(pd.to_datetime(data["time"], utc=True).tz_convert(None), dtype="datetime64[s]"),
+              "lat": np.array(data["lat"], dtype=float),
+              "lng": np.array(data["lng"], dtype=float)}
+    variables = dict(data["variables"]) if "variables" in data else {}
+    variables.update({key: values for key, values in data.items() if isinstance(values, dict) and "data" in values})
+    for key, values in variables.items():
+        arrays[key] = np.array(values["data"], dtype=np.float32)
+    return arrays
+
+
+def write_meteolakes_file(data, file):
+    """Uncompressed so the arrays can be memory-mapped by read_meteolakes_file"""
+    with open(file, "wb") as f:
+        np.savez(f, **data)
+
+
+def read_meteolakes_file(file):
+    return load_npz(file)
+
+
+def load_meteolakes_day(key, download_file=False, cache=False):
+    if not cache:
+        return False
+    path = cache.get(key)
+    if not path:
+        return False
+    if download_file:
+        shutil.copyfile(path, download_file)
+    return read_meteolakes_file(path)
+
+
+def store_meteolakes_day(data, key, download_file=False, cache=False, ttl=None):
+    """Write one day of data to the download folder and the FileCache. Entries without a ttl never expire."""
+    if cache:
+        temp = cache.temporary_file()
+        write_meteolakes_file(data, temp)
+        path = cache.put(key, temp, ttl=ttl, move=True)
+        if download_file:
+            shutil.copyfile(path, download_file)
+    elif download_file:
+        write_meteolakes_file(data, download_file)
+
+
+def split_meteolakes_days(data, days):
+    """
+    Split multi-day arrays (see meteolakes_to_arrays) into one set of arrays per day, in the order of days.
+    Timestamps are assigned to the last requested day on or before their (UTC) date.
+    """
+    dates = data["time"].astype("datetime64[D]")
+    index = np.searchsorted(np.array([day.strftime("%Y-%m-%d") for day in days], dtype="datetime64[D]"), dates, side="right") - 1
+    index = np.clip(index, 0, len(days) - 1)
+    out = []
+    for i, day in enumerate(days):
+        idx = np.where(index == i)[0]
+        if len(idx) == 0:
+            raise ValueError("No data returned for {}.".format(day.strftime("%Y%m%d")))
+        out.append({key: values if key in ["lat", "lng"] else values[idx] for key, values in data.items()})
+    return out
+
+
+def download_meteolakes_reanalysis(source, minx, miny, maxx, maxy, start, end, variables, api):
+    # /meteoswiss/{source}/area/reanalysis/{model}/{start_date}/{end_date}/{ll_lat}/{ll_lng}/{ur_lat}/{ur_lng}
+    query = "{}/meteoswiss/{}/area/reanalysis/{}/{}/{}/{}/{}/{}/{}?{}"
+    query = query.format(api, source, METEOLAKES_MODELS[source]["reanalysis"], start.strftime("%Y%m%d"),
+                         end.strftime("%Y%m%d"), minx, miny, maxx, maxy,
+                         "&".join(["variables=" + item for item in variables]))
+    data = download_data(query)
+    if data == False:
+        raise ValueError("Unable to download data.")
+    return meteolakes_to_arrays(data)
+
+
+def download_meteolakes_forecast(source, minx, miny, maxx, maxy, day, variables, api):
+    # /meteoswiss/{source}/area/forecast/{model}/{date}/{ll_lat}/{ll_lng}/{ur_lat}/{ur_lng}
+    query = "{}/meteoswiss/{}/area/forecast/{}/{}/{}/{}/{}/{}?{}"
+    query = query.format(api, source, METEOLAKES_MODELS[source]["forecast"], day.strftime("%Y%m%d"),
+                         minx, miny, maxx, maxy, "&".join(["variables=" + item for item in variables]))
+    data = download_data(query)
+    if data:
+        for key in list(data.keys()):
+            if "_MEAN" in key:
+                data[key.replace("_MEAN", "")] = data.pop(key)
+    else:
+        raise ValueError("Unable to download data.")
+    return meteolakes_to_arrays(data)
+
+
+def download_meteolakes_area(minx, miny, maxx, maxy, day, variables, api, today, download=False, cache=False, source=False):
+    if not source:
+        source = meteolakes_source(day)
+    download_file = meteolakes_download_file(download, day)
+    key = meteolakes_day_key(source, minx, miny, maxx, maxy, day, variables, today)
+    data = load_meteolakes_day(key, download_file=download_file, cache=cache)
+    if data is not False:
+        return data
     if day.strftime("%Y%m%d") != today.strftime("%Y%m%d"):
-        # /meteoswiss/icon/area/reanalysis/{model}/{start_date}/{end_date}/{ll_lat}/{ll_lng}/{ur_lat}/{ur_lng}
-        query = "{}/meteoswiss/icon/area/reanalysis/kenda-ch1/{}/{}/{}/{}/{}/{}?{}"
-        query = query.format(api, day.strftime("%Y%m%d"), day.strftime("%Y%m%d"), minx, miny, maxx, maxy,
-                             "&".join(["variables=" + item for item in variables]))
-        data = download_data(query, download=download_file)
-        if data == False:
-            raise ValueError("Unable to download data.")
+        data = download_meteolakes_reanalysis(source, minx, miny, maxx, maxy, day, day, variables, api)
+        data = split_meteolakes_days(data, [day])[0]
+        store_meteolakes_day(data, key, download_file=download_file, cache=cache)
     else:
-        # /meteoswiss/icon/area/forecast/{model}/{date}/{ll_lat}/{ll_lng}/{ur_lat}/{ur_lng}
-        query = "{}/meteoswiss/icon/area/forecast/icon-ch2-eps/{}/{}/{}/{}/{}?{}"
-        query = query.format(api, day.strftime("%Y%m%d"), minx, miny, maxx, maxy,
-                             "&".join(["variables=" + item for item in variables]))
-        data = download_data(query, download=download_file)
-        if data:
-            for key in list(data.keys()):
-                if "_MEAN" in key:
-                    data[key.replace("_MEAN", "")] = data.pop(key)
-        else:
-            raise ValueError("Unable to download data.")
+        data = download_meteolakes_forecast(source, minx, miny, maxx, maxy, day, variables, api)
+        store_meteolakes_day(data, key, download_file=download_file, cache=cache, ttl=FORECAST_TTL)
+    return data
+
+
+def download_meteolakes_cosmo_area(minx, miny, maxx, maxy, day, variables, api, today, download=False, cache=False):
+    return download_meteolakes_area(minx, miny, maxx, maxy, day, variables, api, today, download=download, cache=cache, source="cosmo")
+
+
+def download_meteolakes_icon_area(minx, miny, maxx, maxy, day, variables, api, today, download=False, cache=False):
+    return download_meteolakes_area(minx, miny, maxx, maxy, day, variables, api, today, download=download, cache=cache, source="icon")
+
+
+def download_meteolakes_area_range(minx, miny, maxx, maxy, days, variables, api, today, download=False, cache=False):
+    """
+    Download consecutive reanalysis days from the same source with a single request.
+    The response is split back into one data structure per day, each stored like a single day download.
+    """
+    source = meteolakes_source(days[0])
+    data = download_meteolakes_reanalysis(source, minx, miny, maxx, maxy, days[0], days[-1], variables, api)
+    data = split_meteolakes_days(data, days)
+    for day, day_data in zip(days, data):
+        key = meteolakes_day_key(source, minx, miny, maxx, maxy, day, variables, today)
+        store_meteolakes_day(day_data, key, download_file=meteolakes_download_file(download, day), cache=cache)
     return data
 
 
+def meteolakes_chunk_days(minx, miny, maxx, maxy, variables, max_days=10, max_size=100 * 1024 ** 2,
+                          resolution=0.01, timesteps=24, value_size=12):
+    """Number of days per request such that the expected JSON payload stays below max_size bytes."""
+    points = (abs(maxx - minx) / resolution + 1) * (abs(maxy - miny) / resolution + 1)
+    day_size = points * len(variables) * timesteps * value_size
+    return int(max(1, min(max_days, max_size // day_size)))
+
+
+def plan_meteolakes_requests(days, today, max_days, cached=lambda day: False):
+    """
+    Group days into requests: runs of consecutive uncached reanalysis days from the same source of up to
+    max_days days, the forecast for today and cached days each on their own.
+    """
+    requests = []
+    run = []
+    for day in days:
+        single = day.strftime("%Y%m%d") == today.strftime("%Y%m%d") or cached(day)
+        if run and (single or len(run) >= max_days or meteolakes_source(day) != meteolakes_source(run[-1])
+                    or day - run[-1] != timedelta(days=1)):
+            requests.append(run)
+            run = []
+        if single:
+            requests.append([day])
+        else:
+            run.append(day)
+    if run:
+        requests.append(run)
+    return requests
+
+
+def download_meteolakes_area_days(minx, miny, maxx, maxy, days, variables, api, today, download=False, cache=False, parallel_n=8, max_days=False):
+    """
+    Download the meteo area for each day using a bounded pool of worker threads, consecutive reanalysis days are
+    requested as ranges (see plan_meteolakes_requests). Yields (day, data, seconds) in the order of days where
+    seconds is the latency of the request that fetched the day, at most 2 * parallel_n requests are held in memory.
+    """
+    if not max_days:
+        max_days = meteolakes_chunk_days(minx, miny, maxx, maxy, variables)
+
+    def cached(day):
+        return bool(cache) and bool(cache.get(meteolakes_day_key(meteolakes_source(day), minx, miny, maxx, maxy, day, variables, today)))
+
+    def fetch(request):
+        start = perf_counter()
+        if len(request) == 1:
+            data = [download_meteolakes_area(minx, miny, maxx, maxy, request[0], variables, api, today, download=download, cache=cache)]
+        else:
+            data = download_meteolakes_area_range(minx, miny, maxx, maxy, request, variables, api, today, download=download, cache=cache)
+        return data, perf_counter() - start
+
+    requests = plan_meteolakes_requests(days, today, max_days, cached=cached)
+    with ThreadPoolExecutor(max_workers=max(1, min(parallel_n, len(requests)))) as executor:
+        pending = deque()
+        for request in requests:
+            pending.append((request, executor.submit(fetch, request)))
+            while len(pending) >= 2 * parallel_n or (pending and request is requests[-1]):
+                done, future = pending.popleft()
+                data, seconds = future.result()
+                for day, day_data in zip(done, data):
+                    yield day, day_data, seconds
+
+
 def download_meteolakes_cosmo_point(x, y, start, end, variables, api, today):
     print("download_meteolakes_cosmo_point not currently implemented")
 
 
-def weather_files_to_grid(folder, variable, start_date, end_date, mitgcm_grid, parallel_n, zero_nan_slice):
-    files = glob.glob(os.path.join(folder, f'*.json'))
+def weather_files_to_grid(folder, variables, start_date, end_date, mitgcm_grid, parallel_n=None, zero_nan_slice=False, cache=False):
+    """
+    Interpolate variables from the daily weather files in folder to the grid and to hourly timesteps from
+    start_date to end_date, reading each file once for all variables. Files are processed by parallel_n worker
+    processes (default: one per core). Timesteps where a variable in zero_nan_slice (list, or True for all) is
+    NaN everywhere are set to 0.
+    Returns a dict of (T, Y, X) DataArrays, or a single DataArray if variables is a string.
+    """
+    single = isinstance(variables, str)
+    if single:
+        variables = [variables]
+    if zero_nan_slice is True:
+        zero_nan_slice = variables
+    elif not zero_nan_slice:
+        zero_nan_slice = []
+    files = glob.glob(os.path.join(folder, f'*.npz'))
     files.sort()
-    with Pool(parallel_n) as pool:
-        all_data = pool.starmap(interp_to_grid, [(file, variable, mitgcm_grid) for file in files])
-    all_data = xr.concat(all_data, dim='T').sortby('T')
-    unique_values, unique_ind = np.unique(all_data['T'].values, return_index=True)
-    all_data_cleaned = all_data.isel(T=np.sort(unique_ind))
+    if parallel_n is None:
+        parallel_n = os.cpu_count() or 1
+    parallel_n = max(1, min(parallel_n, len(files)))
+    if parallel_n == 1:
+        results = [interp_file_to_arrays(file, variables, mitgcm_grid.lat_grid, mitgcm_grid.lon_grid, cache) for file in files]
+    else:
+        first = read_meteolakes_file(files[0])
+        interpolation_weights((first['lat'], first['lng']), (mitgcm_grid.lat_grid, mitgcm_grid.lon_grid), method="linear", cache=cache)
+        with multiprocessing.get_context("forkserver").Pool(parallel_n, initializer=init_interp_worker, initargs=(mitgcm_grid.lat_grid, mitgcm_grid.lon_grid, cache, dict(interpolation_weights_memo))) as pool:
+            results = pool.starmap(interp_file_worker, [(file, variables) for file in files])
+    times = np.concatenate([result[0] for result in results])
+    data = np.concatenate([result[1] for result in results], axis=1)
+    order = np.argsort(times, kind="stable")
+    unique_values, unique_ind = np.unique(times[order], return_index=True)
+    all_data_cleaned = xr.Dataset(
+        {variable: (["T", "Y", "X"], data[i, order[unique_ind]]) for i, variable in enumerate(variables)},
+        coords={"X": mitgcm_grid.x, "Y": mitgcm_grid.y, "T": unique_values}
+    )
     datetime_list = pd.date_range(start=start_date, end=end_date, freq="h").to_list()
     interp_data = all_data_cleaned.interp({'T': datetime_list})
-    if zero_nan_slice:
-        all_nan_mask = interp_data.isnull().all(dim=['Y', 'X'])  # shape: (T,)
-        all_nan_mask_expanded = all_nan_mask.broadcast_like(interp_data)
-        interp_data = interp_data.where(~all_nan_mask_expanded, 0)
-    return interp_data.transpose('T', 'Y', 'X')
+    out = {}
+    for variable in variables:
+        data = interp_data[variable]
+        if variable in zero_nan_slice:
+            all_nan_mask = data.isnull().all(dim=['Y', 'X'])  # shape: (T,)
+            all_nan_mask_expanded = all_nan_mask.broadcast_like(data)
+            data = data.where(~all_nan_mask_expanded, 0)
+        out[variable] = data.transpose('T', 'Y', 'X')
+    if single:
+        return out[variables[0]]
+    return out
 
 
-def interp_to_grid(json_file: str, variable: str, mitgcm_grid):
-    with open(json_file, "r", encoding="utf-8") as file:
-        json_data = json.load(file)
+interp_worker = {}
 
-    parsed_times = pd.to_datetime(
-        np.array(json_data).item().get('time')
-        ).tz_localize(None)
 
-    lat, lon = np.array(json_data['lat']), np.array(json_data['lng'])
-    coord_raw_data = np.column_stack((lat.flatten(), lon.flatten()))
+def init_interp_worker(lat_grid, lon_grid, cache, weights):
+    """
+    Pool initializer, the target grid and the weights already built by the parent are sent to each worker
+    once rather than with every file.
+    """
+    interp_worker["lat_grid"] = lat_grid
+    interp_worker["lon_grid"] = lon_grid
+    interp_worker["cache"] = cache
+    interpolation_weights_memo.update(weights)
 
-    if variable in json_data:
-        data = np.array(json_data[variable]["data"])
-    elif "variables" in json_data and variable in json_data["variables"]:
-        data = np.array(json_data["variables"][variable]["data"])
-    else:
-        raise ValueError("Parameter {} not in downloaded data.".format(variable))
 
-    data_interp = [
-        xr.DataArray(
-            griddata(coord_raw_data, data[i].flatten(),
-                     (mitgcm_grid.lat_grid, mitgcm_grid.lon_grid),
-                     method="linear"),
-            dims=["Y", "X"],
-            coords={"X": mitgcm_grid.x, "Y": mitgcm_grid.y, "T": time_i}
-        )
-        for i, time_i in enumerate(parsed_times)
-    ]
+def interp_file_worker(weather_file, variables):
+    return interp_file_to_arrays(weather_file, variables, interp_worker["lat_grid"], interp_worker["lon_grid"], interp_worker["cache"])
+
+
+def interp_file_to_arrays(weather_file, variables, lat_grid, lon_grid, cache=False):
+    """Returns the sorted times (datetime64[ns]) and a (variable, T, Y, X) array interpolated to the grid."""
+    weather_data = read_meteolakes_file(weather_file)
+    times = weather_data["time"].astype("datetime64[ns]")
+    for variable in variables:
+        if variable not in weather_data:
+            raise ValueError("Parameter {} not in downloaded data.".format(variable))
+    data = np.stack([weather_data[variable] for variable in variables])
+    weights = interpolation_weights((weather_data['lat'], weather_data['lng']), (lat_grid, lon_grid), method="linear", cache=cache)
+    data = weights.apply(data.reshape(len(variables) * len(times), -1)).reshape((len(variables), len(times)) + lat_grid.shape)
+    order = np.argsort(times, kind="stable")
+    return times[order], data[:, order]
+
+
+def interp_to_grid(weather_file: str, variables, mitgcm_grid, cache=False):
+    """Returns a Dataset with the variables interpolated to the grid, or a DataArray if variables is a string."""
+    single = isinstance(variables, str)
+    if single:
+        variables = [variables]
+    times, data = interp_file_to_arrays(weather_file, variables, mitgcm_grid.lat_grid, mitgcm_grid.lon_grid, cache=cache)
+    data_interp = xr.Dataset(
+        {variable: (["T", "Y", "X"], data[i]) for i, variable in enumerate(variables)},
+        coords={"X": mitgcm_grid.x, "Y": mitgcm_grid.y, "T": times}
+    )
+    if single:
+        return data_interp[variables[0]]
+    return data_interp
+
+
+def hourly_time_interpolation(times, start_date, end_date):
+    """
+    Brackets and positions for linear interpolation of sorted unique times to hourly timesteps, matching
+    DataArray.interp (xarray restricts the source to the neighbourhood of the target and scipy's interp1d
+    then works on nanoseconds since the first remaining time). Targets outside the source times are invalid.
+    """
+    datetime_list = pd.date_range(start=start_date, end=end_date, freq="h").values.astype("datetime64[ns]")
+    imin, imax = pd.Index(times).get_indexer(pd.Index([datetime_list.min(), datetime_list.max()]), method="nearest")
+    offset = max(imin - 2, 0)
+    local = times[offset:imax + 2]
+    x = (local - local.min()).astype(np.float64)
+    x_new = (datetime_list - local.min()).astype(np.float64)
+    hi = np.clip(np.searchsorted(x, x_new), 1, len(x) - 1)
+    lo = hi - 1
+    valid = (x_new >= x[0]) & (x_new <= x[-1])
+    return lo + offset, hi + offset, x[lo], x[hi], x_new, valid
+
+
+def stream_weather_files_to_binary(folder, variables, start_date, end_date, mitgcm_grid, binary_folder, endian_type=">f8", zero_nan_slice=None, derived=None, chunk=24, cache=False):
+    """
+    Same output as weather_files_to_grid followed by write_binary, but written chunk timesteps at a time into
+    preallocated memory mapped binary files, so memory use does not depend on the length of the simulation.
+    variables maps variable names to output names, zero_nan_slice is as in weather_files_to_grid, derived maps
+    output names to functions of a dict of (T, Y, X) arrays for the chunk.
+    """
+    files = glob.glob(os.path.join(folder, f'*.npz'))
+    files.sort()
+    names = list(variables.keys())
+    if zero_nan_slice is True:
+        zero_nan_slice = names
+    elif not zero_nan_slice:
+        zero_nan_slice = []
+    if derived is None:
+        derived = {}
+    weather_data = [read_meteolakes_file(file) for file in files]
+    for data in weather_data:
+        for variable in names:
+            if variable not in data:
+                raise ValueError("Parameter {} not in downloaded data.".format(variable))
+
+    rows = [np.argsort(data["time"].astype("datetime64[ns]"), kind="stable") for data in weather_data]
+    times = np.concatenate([data["time"].astype("datetime64[ns]")[r] for data, r in zip(weather_data, rows)])
+    source = np.concatenate([np.column_stack((np.full(len(r), i), r)) for i, r in enumerate(rows)])
+    order = np.argsort(times, kind="stable")
+    times, unique_ind = np.unique(times[order], return_index=True)
+    source = source[order][unique_ind]
+
+    lo, hi, x_lo, x_hi, x_new, valid = hourly_time_interpolation(times, start_date, end_date)
+    shape = mitgcm_grid.lat_grid.shape
+    outputs = {}
+    for output in list(variables.values()) + list(derived.keys()):
+        outputs[output] = np.memmap(os.path.join(binary_folder, f'{output}.bin'), dtype=endian_type, mode="w+", shape=(len(x_new),) + shape)
+
+    for start in range(0, len(x_new), chunk):
+        end = min(start + chunk, len(x_new))
+        needed = np.unique(np.concatenate((lo[start:end], hi[start:end])))
+        grids = np.full((len(names), len(needed)) + shape, np.nan)
+        for i in np.unique(source[needed, 0]):
+            select = source[needed, 0] == i
+            data = weather_data[i]
+            weights = interpolation_weights((data["lat"], data["lng"]), (mitgcm_grid.lat_grid, mitgcm_grid.lon_grid), method="linear", cache=cache)
+            values = np.stack([data[variable][source[needed[select], 1]] for variable in names])
+            grids[:, select] = weights.apply(values.reshape(len(names) * np.sum(select), -1)).reshape((len(names), np.sum(select)) + shape)
+        y_lo = grids[:, np.searchsorted(needed, lo[start:end])]
+        y_hi = grids[:, np.searchsorted(needed, hi[start:end])]
+        factor = (x_new[start:end] - x_lo[start:end])[None, :, None, None]
+        slope = (y_hi - y_lo) / (x_hi[start:end] - x_lo[start:end])[None, :, None, None]
+        values = slope * factor + y_lo
+        values[:, ~valid[start:end]] = np.nan
+        chunk_grids = {}
+        for i, variable in enumerate(names):
+            if variable in zero_nan_slice:
+                values[i, np.all(np.isnan(values[i]), axis=(1, 2))] = 0
+            chunk_grids[variable] = values[i]
+            outputs[variables[variable]][start:end] = values[i]
+        for output, function in derived.items():
+            outputs[output][start:end] = function(chunk_grids)
 
-    return xr.concat(data_interp, dim="T").sortby("T")
+    for output in outputs.values():
+        output.flush()
 
 
 def write_binary(filename, data, endian_type=">f8"):
@@ -206,8 +641,4 @@ def write_swan_wind(filepath, u_data, v_data):
     u = _oriented(u_data)
     v = _oriented(v_data)
     with open(filepath, 'w') as f:
-        for t in range(u.shape[0]):
-            for block in (u, v):
-                for j in range(block.shape[1]):
-                    f.write(' '.join('{:.4f}'.format(val) for val in block[t, j, :]))
-                    f.write('\n')
+        f.write(format_ascii_grid(np.concatenate((u, v), axis=1), fmt='%.4f'))
@@ -0,0 +1,46 @@
+import os
+import time
+from cache import FileCache
+
+
+def write(folder, name, size):
+    path = os.path.join(str(folder), name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+
+def age(path, seconds):
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+
+def test_recently_used_entries_are_not_evicted(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), max_size=150, grace=60)
+    old = cache.put("aa", write(tmp_path, "a", 100))
+    age(old, 120)
+    recent = cache.put("bb", write(tmp_path, "b", 100))
+    assert not os.path.exists(old)
+    assert cache.get("bb") == recent
+    # An entry that was just read survives even though the cache is over its limit
+    cache.put("cc", write(tmp_path, "c", 100))
+    assert os.path.isfile(recent)
+
+
+def test_put_scans_only_when_over_limit_or_stale(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), max_size=1000, grace=60)
+    cache.put("aa", write(tmp_path, "a", 100))
+    scanned = cache.usage()["scanned"]
+    cache.put("bb", write(tmp_path, "b", 100))
+    cache.put("bb", write(tmp_path, "b", 50))
+    assert cache.usage() == {"total": 150, "scanned": scanned}
+
+
+def test_stale_part_files_are_removed(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), grace=60)
+    stale = cache.temporary_file()
+    age(stale, 120)
+    fresh = cache.temporary_file()
+    with cache.lock():
+        cache.evict()
+    assert not os.path.exists(stale) and os.path.exists(fresh)
@@ -0,0 +1,33 @@
+import os
+import json
+import numpy as np
+import pytest
+from functions import mitgcm_size_overlap, mitgcm_decomposition, optimise_mitgcm_decomposition
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "mitgcm")
+
+
+def lake_bathymetry(lake):
+    with open(os.path.join(STATIC, lake, "grid", "parameters.json"), "r") as f:
+        parameters = json.load(f)
+    bathy = np.fromfile(os.path.join(STATIC, lake, "binary_data", "bathy.bin"), dtype=">f8")
+    return bathy.reshape((int(parameters["Ny"]), int(parameters["Nx"])))
+
+
+def test_size_overlap():
+    assert mitgcm_size_overlap(os.path.join(STATIC, "default", "code", "SIZE.h")) == (3, 3)
+
+
+@pytest.mark.parametrize("cores", [4, 16, 64, 256])
+def test_optimised_tiles_are_not_narrower_than_overlap(cores):
+    bathy = lake_bathymetry("geneva_1000")
+    overlap = mitgcm_size_overlap(os.path.join(STATIC, "default", "code", "SIZE.h"))
+    decomposition = optimise_mitgcm_decomposition(bathy, cores, overlap=overlap)
+    assert decomposition["sNx"] >= overlap[0] and decomposition["sNy"] >= overlap[1]
+    assert decomposition["active"] <= cores
+    assert bathy.shape == (decomposition["nPy"] * decomposition["sNy"], decomposition["nPx"] * decomposition["sNx"])
+
+
+def test_manual_tiles_narrower_than_overlap_are_rejected():
+    with pytest.raises(ValueError):
+        mitgcm_decomposition(lake_bathymetry("geneva_1000"), 10, 13, overlap=(3, 3))
@@ -0,0 +1,20 @@
+import subprocess
+from types import SimpleNamespace
+import functions
+
+
+def test_remove_old_docker_images_only_matches_the_lake(monkeypatch):
+    images = ["eawag/mitgcm:67z_geneva_{}".format(c * 12) for c in "abcd"] + \
+             ["eawag/mitgcm:67z_geneva_1000_{}".format(c * 12) for c in "abcd"]
+    removed = []
+
+    def run(command, **kwargs):
+        if command[:3] == ["docker", "image", "ls"]:
+            return SimpleNamespace(returncode=0, stdout="\n".join(images))
+        removed.append(command[2])
+        return SimpleNamespace(returncode=0)
+
+    monkeypatch.setattr(subprocess, "run", run)
+    assert functions.remove_old_docker_images("eawag/mitgcm:67z_geneva_", ["eawag/mitgcm:67z_geneva_" + "a" * 12], n=1) == \
+        ["eawag/mitgcm:67z_geneva_" + c * 12 for c in "bcd"]
+    assert removed == ["eawag/mitgcm:67z_geneva_" + c * 12 for c in "bcd"]
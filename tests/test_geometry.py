@@ -0,0 +1,29 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import geometry
+from cache import FileCache
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "static", "mitgcm")
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_mitgcm_grid_reads_dz_csv(tmp_path, cached):
+    cache = FileCache(str(tmp_path / "cache")) if cached else False
+    grid, _ = geometry.mitgcm_grid(os.path.join(STATIC, "geneva_1000", "grid"), cache=cache)
+    assert grid.dz.shape == (100,) and grid.dz[0] == 0.5
+    assert grid.parameters["Nx"] == 70
+
+
+def test_dz_npy_is_preferred_and_matches_csv():
+    npy, _ = geometry.mitgcm_grid(os.path.join(STATIC, "neuchatel", "grid"))
+    assert np.allclose(npy.dz, np.round(np.loadtxt(os.path.join(STATIC, "neuchatel", "grid", "dz.csv"), delimiter=",", encoding="utf-8-sig").ravel(), 3))
+
+
+def test_missing_grid_file_is_reported(tmp_path):
+    folder = str(tmp_path / "grid")
+    shutil.copytree(os.path.join(STATIC, "zug", "grid"), folder)
+    os.remove(os.path.join(folder, "dz.npy"))
+    with pytest.raises(FileNotFoundError, match="Missing grid file: .*dz.npy"):
+        geometry.mitgcm_grid(folder)
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import pytest
+import numpy as np
+import weather
+import functions
+from functions import logger
+from diagnostics import Diagnostics, render_heatmaps
+from pipeline import Pipeline, STAGES_FILE, PIPELINE_VERSION
+
+
+class Model(object):
+    docker = "test"
+
+    def __init__(self, folder, params, fail=None, restart="restart.rst"):
+        self.simulation_dir = folder
+        self.params = params
+        self.log = logger()
+        self.fail = fail
+        self.calls = []
+        self.restart = restart
+        self.restart_file = ""
+
+    def stage(self, name):
+        self.calls.append(name)
+        if self.fail == name:
+            raise RuntimeError(name)
+
+    def load_properties(self):
+        self.stage("load_properties")
+
+    def collect_restart_file(self):
+        self.stage("collect_restart_file")
+        self.restart_file = self.restart
+
+    def weather_data_files(self):
+        self.stage("weather_data_files")
+
+    def river_data_files(self):
+        self.stage("river_data_files")
+
+    def upload_data(self):
+        self.stage("upload_data")
+
+
+def process(model, resume, restart_checkpoint=True):
+    stages = Pipeline(model, "root", resume=resume)
+    stages.add(model.load_properties, checkpoint=False)
+    stages.add(model.collect_restart_file, params=["start"], outputs=["restart_file"], checkpoint=restart_checkpoint)
+    stages.add(model.weather_data_files, after=[model.load_properties], params=["today"])
+    stages.add(model.river_data_files, after=[model.load_properties], params=["today"])
+    stages.add(model.upload_data, after=[model.collect_restart_file, model.weather_data_files, model.river_data_files], params=["bucket"])
+    stages.execute()
+    return model.calls
+
+
+def test_resume_reruns_failed_stage_and_dependents(tmp_path):
+    params = {"start": 1, "today": 1, "bucket": "a"}
+    with pytest.raises(RuntimeError):
+        process(Model(str(tmp_path), params, fail="river_data_files"), False)
+    model = Model(str(tmp_path), params)
+    assert sorted(process(model, True)) == ["load_properties", "river_data_files", "upload_data"]
+    assert model.restart_file == "restart.rst"
+    assert process(Model(str(tmp_path), params), True) == ["load_properties"]
+
+
+def test_changed_parameter_invalidates_dependents_only(tmp_path):
+    process(Model(str(tmp_path), {"start": 1, "today": 1, "bucket": "a"}), False)
+    calls = process(Model(str(tmp_path), {"start": 1, "today": 2, "bucket": "a"}), True)
+    assert sorted(calls) == ["load_properties", "river_data_files", "upload_data", "weather_data_files"]
+    calls = process(Model(str(tmp_path), {"start": 1, "today": 2, "bucket": "b"}), True)
+    assert sorted(calls) == ["load_properties", "upload_data"]
+
+
+def test_unchecked_stage_with_new_outputs_reruns_dependents(tmp_path):
+    params = {"start": 1, "today": 1, "bucket": "a"}
+    process(Model(str(tmp_path), params, restart=False), False, restart_checkpoint=False)
+    calls = process(Model(str(tmp_path), params, restart=False), True, restart_checkpoint=False)
+    assert sorted(calls) == ["collect_restart_file", "load_properties"]
+    calls = process(Model(str(tmp_path), params), True, restart_checkpoint=False)
+    assert sorted(calls) == ["collect_restart_file", "load_properties", "upload_data"]
+
+
+def test_without_resume_every_stage_runs(tmp_path):
+    params = {"start": 1, "today": 1, "bucket": "a"}
+    process(Model(str(tmp_path), params), False)
+    assert len(process(Model(str(tmp_path), params), False)) == 5
+
+
+@pytest.mark.parametrize("content", [[{"name": "collect_restart_file", "key": "k"}],
+                                     {"collect_restart_file": {"key": "k"}},
+                                     {"version": PIPELINE_VERSION - 1, "stages": {}},
+                                     "not json"])
+def test_markers_from_other_versions_are_discarded(tmp_path, content):
+    with open(os.path.join(str(tmp_path), STAGES_FILE), "w") as f:
+        f.write(content if isinstance(content, str) else json.dumps(content))
+    assert len(process(Model(str(tmp_path), {"start": 1, "today": 1, "bucket": "a"}), True)) == 5
+    with open(os.path.join(str(tmp_path), STAGES_FILE), "r") as f:
+        assert json.load(f)["version"] == PIPELINE_VERSION
+
+
+class PoolModel(Model):
+    """Two stages using process pools run next to a stage holding the http lock and writing to stdout."""
+
+    def __init__(self, folder, weather_folder, grid):
+        super().__init__(folder, {})
+        self.weather_folder = weather_folder
+        self.grid = grid
+        self.started = 0
+
+    def weather_data_files(self):
+        self.started += 1
+        self.wind = weather.weather_files_to_grid(self.weather_folder, ["U", "V"], np.datetime64("2024-01-01T02"), np.datetime64("2024-01-02T23"), self.grid, parallel_n=2)
+
+    def river_data_files(self):
+        self.started += 1
+        diagnostics = Diagnostics(processes=2)
+        for i in range(4):
+            diagnostics.figure(render_heatmaps, os.path.join(self.simulation_dir, "{}.png".format(i)), "Test", [("a", np.eye(4))], 1, 1)
+        diagnostics.close()
+
+    def load_properties(self):
+        while self.started < 2:
+            with functions.http_lock:
+                print("holding locks", flush=True)
+                time.sleep(0.001)
+
+
+def test_concurrent_pool_stages(tmp_path):
+    from test_weather import write_weather_file
+    folder = tmp_path / "weather"
+    folder.mkdir()
+    write_weather_file(str(folder), "2024-01-01", 24, ["U", "V", "GLOB"], 1)
+    write_weather_file(str(folder), "2024-01-02", 24, ["U", "V", "GLOB"], 2)
+    lon_grid, lat_grid = np.meshgrid(np.linspace(8.1, 8.4, 5), np.linspace(46.1, 46.4, 4))
+    grid = type("Grid", (object,), {"lat_grid": lat_grid, "lon_grid": lon_grid, "x": np.arange(5.0), "y": np.arange(4.0)})
+    model = PoolModel(str(tmp_path), str(folder), grid)
+    stages = Pipeline(model, "root", threads=3)
+    stages.add(model.load_properties, checkpoint=False)
+    stages.add(model.weather_data_files)
+    stages.add(model.river_data_files)
+    stages.execute()
+    assert model.wind["U"].shape == (46, 4, 5)
+    assert all(os.path.isfile(os.path.join(str(tmp_path), "{}.png".format(i))) for i in range(4))
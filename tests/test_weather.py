@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from datetime import datetime
+import weather
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "weather")
+
+
+def write_weather_file(folder, start, hours, variables, seed):
+    rng = np.random.default_rng(seed)
+    lng, lat = np.meshgrid(np.linspace(8.0, 8.5, 6), np.linspace(46.0, 46.5, 6))
+    time = np.datetime64(start, "ns") + np.arange(0, hours + 1, 3) * np.timedelta64(1, "h")
+    data = {"time": time, "lat": lat, "lng": lng}
+    for variable in variables:
+        data[variable] = rng.normal(10, 3, (len(time),) + lat.shape)
+    data["GLOB"][2] = np.nan
+    np.savez(os.path.join(folder, "{}.npz".format(start.replace("-", ""))), **data)
+
+
+@pytest.fixture
+def weather_folder(tmp_path):
+    folder = tmp_path / "weather"
+    folder.mkdir()
+    # Daily files overlap by one timestep, the streamed writer must drop the duplicate as weather_files_to_grid does
+    write_weather_file(str(folder), "2024-01-01", 24, ["U", "V", "GLOB"], 1)
+    write_weather_file(str(folder), "2024-01-02", 24, ["U", "V", "GLOB"], 2)
+    return str(folder)
+
+
+@pytest.fixture
+def grid():
+    lon_grid, lat_grid = np.meshgrid(np.linspace(8.1, 8.4, 5), np.linspace(46.1, 46.4, 4))
+    return SimpleNamespace(lat_grid=lat_grid, lon_grid=lon_grid, x=np.arange(5) * 100.0, y=np.arange(4) * 100.0)
+
+
+def golden(output):
+    """Output of the baseline weather_files_to_grid and write_binary for the weather_folder fixture."""
+    return np.fromfile(os.path.join(GOLDEN, "{}.bin".format(output)), dtype=">f8")
+
+
+def test_weather_files_to_grid_matches_baseline(weather_folder, grid):
+    start, end = datetime(2024, 1, 1, 2), datetime(2024, 1, 2, 23)
+    grids = weather.weather_files_to_grid(weather_folder, ["U", "V", "GLOB"], start, end, grid, parallel_n=1, zero_nan_slice=["GLOB"])
+    assert np.any((grids["GLOB"] == 0).all(dim=["Y", "X"]))
+    for variable, output in {"U": "u10", "V": "v10", "GLOB": "swdown"}.items():
+        np.testing.assert_allclose(grids[variable].values.ravel(), golden(output), rtol=1e-12, atol=1e-12, err_msg=output)
+
+
+def test_stream_weather_files_to_binary_matches_baseline(tmp_path, weather_folder, grid):
+    start, end = datetime(2024, 1, 1, 2), datetime(2024, 1, 2, 23)
+    variables = {"U": "u10", "V": "v10", "GLOB": "swdown"}
+    weather.stream_weather_files_to_binary(weather_folder, variables, start, end, grid, str(tmp_path), zero_nan_slice=["GLOB"],
+                                           derived={"speed": lambda grids: np.sqrt(grids["U"] ** 2 + grids["V"] ** 2)}, chunk=7)
+    expected = {output: golden(output) for output in variables.values()}
+    expected["speed"] = np.sqrt(expected["u10"] ** 2 + expected["v10"] ** 2)
+    for output, data in expected.items():
+        np.testing.assert_allclose(np.fromfile(str(tmp_path / "{}.bin".format(output)), dtype=">f8"), data, rtol=1e-12, atol=1e-12, err_msg=output)
+
+
+def test_stream_weather_files_to_binary_defaults(tmp_path, weather_folder, grid):
+    start, end = datetime(2024, 1, 1, 2), datetime(2024, 1, 1, 12)
+    weather.stream_weather_files_to_binary(weather_folder, {"U": "u10"}, start, end, grid, str(tmp_path))
+    data = np.fromfile(str(tmp_path / "u10.bin"), dtype=">f8").reshape((-1,) + grid.lat_grid.shape)
+    assert data.shape[0] == 11
+    assert not os.path.exists(str(tmp_path / "speed.bin"))